@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from control_thread import ControlThread
+
+
+class AsyncRuntime:
+    """Runs a ControlThread's TFmini-S reader, door contact, Wifi scanner, NeoPixel display, temperature monitor and
+    MQTT connection as tasks on one asyncio event loop instead of one OS thread each.
+
+    With NiceGUI the loop is the one ui.run() already starts, so listeners such as the web page gauges are called
+    on the same thread as the code that updates them and state changes happen in a deterministic order.  Calls
+    that block (Wifi scans, connecting to MQTT) go through a small executor.  The ControlThread must be
+    created with asyncio_mode=True and must not be started.  Stalls runs every stall of a garage the same way."""
+    def __init__(self, garage: ControlThread, executor_workers: int = 2):
+        """
+        Parameters
+        ----------
+        garage - ControlThread or Stalls - stall or stalls to run, created with asyncio_mode=True
+        executor_workers - int - number of threads used for blocking calls, defaults to 2
+        """
+        self.garage = garage
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='garage-blocking')
+        self.tasks = []
+
+    async def start(self) -> None:
+        """Creates the tasks on the running event loop and returns, use as a NiceGUI app.on_startup handler."""
+        event_loop = asyncio.get_running_loop()
+        logging.info('starting garage control tasks on the asyncio event loop')
+        self.garage.connect_listeners()
+        for runnable in self.garage.runnables():
+            task = event_loop.create_task(runnable.run_async(self.executor), name=type(runnable).__name__)
+            task.add_done_callback(self._task_done)
+            self.tasks.append(task)
+
+    async def run(self) -> None:
+        """Starts the tasks and waits until they have all finished, for running without the web interface."""
+        await self.start()
+        try:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            await self.stop()
+
+    async def stop(self) -> None:
+        """Cancels the tasks, then shuts down the garage so its devices are released."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.garage.shutdown()
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _task_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'{task.get_name()} task stopped', exc_info=task.exception())
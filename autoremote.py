@@ -1,22 +1,25 @@
-import logging
-
 import requests
 
+from notification_dispatcher import Notifier, NotificationError
 
-class Autoremote:
-    """Interacts with Tasker Autoremote to tell your phone the status of your garage door."""
-    def __init__(self, key):
-        self.key = key
 
-    def send_opened(self):
-        """Tell your phone the door was opened."""
-        self.__send_message__('garage-opened')
+class Autoremote(Notifier):
+    """Interacts with Tasker Autoremote to tell your phone the status of your garage door.  Messages such as
+    garage-opened and garage-closed are delivered through a NotificationDispatcher."""
+    name = 'autoremote'
+    URL = 'https://autoremotejoaomgcd.appspot.com/sendmessage'
 
-    def send_closed(self):
-        """Tell your phone the door was closed."""
-        self.__send_message__('garage-closed')
+    def __init__(self, key, url: str = URL):
+        """
+        Parameters
+        ----------
+        key - str - Tasker Autoremote key of your phone
+        url - str - Autoremote sendmessage URL, defaults to the Autoremote service
+        """
+        self.key = key
+        self.url = url
 
-    def __send_message__(self, msg):
-        r = requests.get(f'https://autoremotejoaomgcd.appspot.com/sendmessage?key={self.key}&message={msg}')
+    def send(self, session: requests.Session, message: str, timeout: float) -> None:
+        r = session.get(self.url, params={'key': self.key, 'message': message}, timeout=timeout)
         if r.status_code != 200:
-            logging.error(f'unable to send {msg} message to Autoremote ' + r.text)
+            raise NotificationError(f'Autoremote answered {r.status_code} {r.text[:200]}')
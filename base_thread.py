@@ -1,22 +1,133 @@
-from threading import Thread
+import asyncio
+import time
+from threading import Thread, Condition, Event, current_thread
 import logging
 
+from metrics import REGISTRY
+
 
 class BaseThread(Thread):
     """All the threads that monitor the door open/close status, light up the NeoPixel strip, monitor the CPU temperature,
     and scan the Wifi inherit this base thread that allows for stopping the thread with a call to shutdown().
     Helper method allows for listeners (functions) to be added and informed of messages or changes by
-    calling inform_listeners(message)."""
-    def __init__(self, *args, **kwargs):
+    calling inform_listeners(message).
+
+    Threads do not poll.  Subclasses implement step(), which does the work without blocking and returns how long
+    to wait before it is needed again.  loop() runs step() and then blocks in wait() until another thread calls
+    notify() because there is new data, or until that deadline passes.  sleep() returns early on shutdown() so
+    threads can be joined quickly.
+
+    The same step() can instead be run as a task on an asyncio event loop with run_async(), see AsyncRuntime."""
+    def __init__(self, *args, join_timeout: float = 2.0, min_period: float = 0.0, **kwargs):
         super(BaseThread, self).__init__(daemon=True)
         self.running = False
         self.listeners = list()
         self.last_message = None
+        self.join_timeout = join_timeout
+        self.min_period = min_period
+        self.wakeups = 0
+        self._last_step = 0.0
+        self._wakeup_condition = Condition()
+        self._wakeup_pending = False
+        self._shutdown_event = Event()
+        self._event_loop = None
+        self._async_wakeup = None
+        name = type(self).__name__
+        self.step_seconds = REGISTRY.histogram('garage_step_seconds', 'Seconds one step() of a thread takes',
+                                               thread=name)
+        REGISTRY.counter('garage_thread_wakeups_total', 'Number of times a thread woke up to do work',
+                         lambda: self.wakeups, thread=name)
 
     def run(self) -> None:
-        running = True
-        while running:
+        while self.running:
             self.loop()
+            self.wakeups += 1
+
+    def loop(self) -> None:
+        """Runs step() then waits for notify() or the number of seconds step() returned, but never runs step()
+        more often than every min_period seconds."""
+        started = time.monotonic()
+        timeout = self.step()
+        self.step_seconds.observe(time.monotonic() - started)
+        if self.min_period > 0:
+            elapsed = time.monotonic() - self._last_step
+            if elapsed < self.min_period:
+                self.sleep(self.min_period - elapsed)
+        self.wait(timeout)
+        self._last_step = time.monotonic()
+
+    def step(self):
+        """Does one round of work without blocking.
+
+        Returns
+        -------
+        seconds until step() needs to run again, or None to run again only when notify() is called
+        """
+        return None
+
+    async def run_async(self, executor=None) -> None:
+        """Runs step() as a task on the running asyncio event loop instead of in this thread.
+
+        Parameters
+        ----------
+        executor - concurrent.futures.Executor - executor for blocking calls, None uses the loop's default
+        """
+        self._attach(asyncio.get_running_loop())
+        while self.running:
+            started = time.monotonic()
+            timeout = self.step()
+            self.step_seconds.observe(time.monotonic() - started)
+            if self.min_period > 0:
+                elapsed = time.monotonic() - self._last_step
+                if elapsed < self.min_period:
+                    await asyncio.sleep(self.min_period - elapsed)
+            await self.wait_async(timeout)
+            self._last_step = time.monotonic()
+            self.wakeups += 1
+
+    def _attach(self, event_loop) -> None:
+        self._async_wakeup = asyncio.Event()
+        self._event_loop = event_loop
+        self.running = True
+
+    def notify(self, *args) -> None:
+        """Wakes up the thread if it is blocked in wait().  Accepts and ignores arguments so it can be used as a
+        listener.  Notifications are not lost if the thread is not waiting yet.  Safe to call from any thread."""
+        with self._wakeup_condition:
+            self._wakeup_pending = True
+            self._wakeup_condition.notify_all()
+        event_loop = self._event_loop
+        if event_loop is not None and not event_loop.is_closed():
+            event_loop.call_soon_threadsafe(self._async_wakeup.set)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Blocks until notify() is called, timeout seconds pass (None waits forever) or the thread is shutdown.
+
+        Returns
+        -------
+        True if woken up by notify(), False otherwise
+        """
+        with self._wakeup_condition:
+            if not self._wakeup_pending and self.running:
+                self._wakeup_condition.wait(timeout)
+            notified = self._wakeup_pending
+            self._wakeup_pending = False
+            return notified
+
+    async def wait_async(self, timeout: float = None) -> bool:
+        """Same as wait() for threads that are run with run_async()."""
+        if not self._async_wakeup.is_set() and self.running:
+            try:
+                await asyncio.wait_for(self._async_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        notified = self._async_wakeup.is_set()
+        self._async_wakeup.clear()
+        return notified
+
+    def sleep(self, seconds: float) -> None:
+        """Sleeps for the given number of seconds, returning early if the thread is shutdown."""
+        self._shutdown_event.wait(seconds)
 
     def inform_listeners(self, message) -> None:
         if message == self.last_message:
@@ -28,7 +139,53 @@ class BaseThread(Thread):
 
     def start(self) -> None:
         logging.info(f'{type(self)} started')
+        self.running = True
         super().start()
 
     def shutdown(self) -> None:
+        """Asks the thread to stop and waits up to join_timeout seconds for its current loop() to finish."""
         self.running = False
+        self._shutdown_event.set()
+        self.notify()
+        if self.is_alive() and current_thread() is not self:
+            self.join(self.join_timeout)
+            if self.is_alive():
+                logging.warning(f'{type(self)} did not stop within {self.join_timeout} seconds')
+
+
+class SamplingThread(BaseThread):
+    """A thread that takes a blocking sample() every period seconds and hands it to update().  When run with
+    run_async() the sample is taken on the executor so the event loop is never blocked, unless blocking is False
+    because sample() is as cheap as handing it to the executor."""
+    def __init__(self, period: float, *args, blocking: bool = True, **kwargs):
+        super(SamplingThread, self).__init__(*args, **kwargs)
+        self.period = period
+        self.blocking = blocking
+
+    def sample(self):
+        """Takes a sample, may block.  Returning None skips update()."""
+        return None
+
+    def update(self, value) -> None:
+        """Stores a new sample and informs listeners, must not block."""
+
+    def step(self):
+        value = self.sample()
+        if value is not None:
+            self.update(value)
+        return self.period
+
+    async def run_async(self, executor=None) -> None:
+        event_loop = asyncio.get_running_loop()
+        self._attach(event_loop)
+        while self.running:
+            if self.blocking:
+                value = await event_loop.run_in_executor(executor, self.sample)
+            else:
+                value = self.sample()
+            if value is not None:
+                started = time.monotonic()
+                self.update(value)
+                self.step_seconds.observe(time.monotonic() - started)
+            await self.wait_async(self.period)
+            self.wakeups += 1
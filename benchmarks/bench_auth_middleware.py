@@ -0,0 +1,176 @@
+"""Measures requests/s through the web site's AuthMiddleware, the legacy BaseHTTPMiddleware looping over
+passwords.json vs the ASGI middleware with CredentialIndex.
+
+The middleware runs in a Starlette app in front of a page and a static file, driven in-process by httpx so only the
+middleware and the framework are measured.  Every request carries HTTP Basic credentials of the last user in the file,
+the worst case of the legacy loop, and a session cookie; two out of three requests are for static files, about what
+loading a NiceGUI page takes.  "writes" counts how often the session storage was written, NiceGUI saves it to disk
+each time.
+
+    python3 benchmarks/bench_auth_middleware.py --requests 3000
+"""
+import argparse
+import asyncio
+import base64
+import os
+import secrets
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi.security.utils import get_authorization_scheme_param
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, RedirectResponse
+from starlette.routing import Route
+
+from credentials import CredentialIndex
+
+
+class SessionStorage(dict):
+    """app.storage.user stand-in that counts the writes NiceGUI would save to disk."""
+    writes = 0
+
+    def __setitem__(self, key, value):
+        SessionStorage.writes += 1
+        super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        SessionStorage.writes += 1
+        super().update(*args, **kwargs)
+
+
+sessions = {}
+
+
+def storage(request: Request) -> SessionStorage:
+    return sessions.setdefault(request.cookies.get('id'), SessionStorage())
+
+
+def legacy_middleware(passwords: dict):
+    class AuthMiddleware(BaseHTTPMiddleware):
+        """AuthMiddleware as gui.create_pages had it."""
+        def authorize_digest(self, request: Request):
+            authorization = request.headers.get("Authorization")
+            if authorization:
+                scheme, credentials = get_authorization_scheme_param(authorization)
+                for expected_username, expected_password in passwords.items():
+                    expected_token = base64.standard_b64encode(
+                        bytes(f"{expected_username}:{expected_password}", encoding="UTF-8")
+                    )
+                    correct_token = secrets.compare_digest(
+                        bytes(credentials, encoding="UTF-8"),
+                        expected_token
+                    )
+                    if correct_token:
+                        storage(request).update({'username': expected_username, 'authenticated': True})
+                        break
+
+        async def dispatch(self, request: Request, call_next):
+            self.authorize_digest(request)
+            if not storage(request).get('authenticated', False):
+                if request.url.path == '/':
+                    storage(request)['referrer_path'] = request.url.path
+                    return RedirectResponse('/login')
+            return await call_next(request)
+    return AuthMiddleware
+
+
+def index_middleware(passwords: dict):
+    credentials = CredentialIndex(passwords)
+
+    class AuthMiddleware:
+        """AuthMiddleware as gui.create_pages has it."""
+        def __init__(self, app):
+            self.app = app
+
+        def authorize_basic(self, request: Request):
+            username = credentials.authorize(request.headers.get("Authorization"))
+            if username is not None:
+                credentials.remember(storage(request), username)
+
+        async def __call__(self, scope, receive, send):
+            if scope['type'] != 'http' or credentials.is_static(scope['path']):
+                await self.app(scope, receive, send)
+                return
+            request = Request(scope)
+            self.authorize_basic(request)
+            if not storage(request).get('authenticated', False):
+                if request.url.path == '/':
+                    storage(request)['referrer_path'] = request.url.path
+                    await RedirectResponse('/login')(scope, receive, send)
+                    return
+            await self.app(scope, receive, send)
+    return AuthMiddleware
+
+
+async def page(request):
+    return PlainTextResponse('page')
+
+
+async def static(request):
+    return PlainTextResponse('static')
+
+
+async def run(middleware, users: int, requests: int) -> (float, int):
+    """Returns requests/s and session storage writes."""
+    passwords = {f'user{i}': f'password{i}' for i in range(users)}
+    app = Starlette(routes=[Route('/', page), Route('/static/Open.jpg', static),
+                            Route('/_nicegui/1.4.37/static/quasar.js', static)],
+                    middleware=[Middleware(middleware(passwords))])
+    token = base64.standard_b64encode(f'user{users - 1}:password{users - 1}'.encode()).decode()
+    headers = {'Authorization': f'Basic {token}'}
+    paths = ['/', '/static/Open.jpg', '/_nicegui/1.4.37/static/quasar.js']
+    sessions.clear()
+    SessionStorage.writes = 0
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://garage-pi',
+                                 cookies={'id': 'browser'}) as http:
+        for i in range(100):
+            await http.get(paths[i % 3], headers=headers)
+        SessionStorage.writes = 0
+        start = time.perf_counter()
+        for i in range(requests):
+            response = await http.get(paths[i % 3], headers=headers)
+            assert response.status_code == 200
+        elapsed = time.perf_counter() - start
+    return requests / elapsed, SessionStorage.writes
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--requests', type=int, default=3000, help='requests per run, defaults to 3000')
+    options = p.parse_args()
+
+    print(f'{"users":>6} {"impl":>7} {"requests/s":>11} {"writes":>7} {"us per check":>13}')
+    for users in (1, 10, 100):
+        for impl, middleware in (('legacy', legacy_middleware), ('index', index_middleware)):
+            rate, writes = asyncio.run(run(middleware, users, options.requests))
+            check = check_cost(impl, users)
+            print(f'{users:>6} {impl:>7} {rate:>11.0f} {writes:>7} {check * 1e6:>13.1f}')
+
+
+def check_cost(impl: str, users: int, checks: int = 2000) -> float:
+    """Returns the seconds one Authorization header check takes on its own."""
+    passwords = {f'user{i}': f'password{i}' for i in range(users)}
+    token = base64.standard_b64encode(f'user{users - 1}:password{users - 1}'.encode())
+    if impl == 'index':
+        credentials = CredentialIndex(passwords)
+        header = f'Basic {token.decode()}'
+        start = time.perf_counter()
+        for _ in range(checks):
+            credentials.authorize(header)
+        return (time.perf_counter() - start) / checks
+    start = time.perf_counter()
+    for _ in range(checks):
+        for username, password in passwords.items():
+            if secrets.compare_digest(token, base64.standard_b64encode(f'{username}:{password}'.encode())):
+                break
+    return (time.perf_counter() - start) / checks
+
+
+if __name__ == '__main__':
+    main()
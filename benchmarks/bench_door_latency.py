@@ -0,0 +1,114 @@
+"""Measures how long a door opened or closed by hand takes to show up as a new DoorStatus, polling vs edges.
+
+A gpiozero mock pin plays the door contact.  Each cycle opens the door, waits for OPENING, lets the door finish moving
+and closes it again, waiting for CLOSED.  With --bounce every change is a burst of three flips 0.5 ms apart, the way a
+reed contact bounces.  "polling" is DoorStatusThread with the edge callbacks disconnected, reading the pin once a
+second like DoorStatusThread.loop used to; "edges" is DoorStatusThread as Garage-Pi runs it.
+
+    python3 benchmarks/bench_door_latency.py --cycles 20 --bounce
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulation import mock_gpio
+
+from door_status_thread import DoorStatusThread, DoorStatus
+
+
+class Recorder:
+    """Records (time.monotonic(), status) of every door status the thread reports."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.statuses = []
+
+    def __call__(self, status: DoorStatus) -> None:
+        with self.condition:
+            self.statuses.append((time.monotonic(), status))
+            self.condition.notify_all()
+
+    def wait_for(self, status: DoorStatus, after: int, timeout: float = 3.0):
+        """Returns the time status was reported at index after or later, None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for when, reported in self.statuses[after:]:
+                    if reported == status:
+                        return when
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+
+def change(pin, high: bool, bounce: bool) -> float:
+    """Drives the pin high or low and returns the time.monotonic() of the first edge."""
+    drive, other = (pin.drive_high, pin.drive_low) if high else (pin.drive_low, pin.drive_high)
+    started = time.monotonic()
+    drive()
+    if bounce:
+        time.sleep(0.0005)
+        other()
+        time.sleep(0.0005)
+        drive()
+    return started
+
+
+def run(gpio, pin_number: int, edges: bool, cycles: int, bounce: bool, seed: int) -> (list, int, int):
+    """Returns the detection latencies, the number of status reports and the number expected."""
+    rnd = random.Random(seed)
+    pin = gpio.pin(pin_number)
+    door = DoorStatusThread(gpio_pin=pin_number, door_movement_delay=0.05, opening_delay=0.0,
+                            poll_interval=1.0)
+    if not edges:
+        door.button.when_pressed = None
+        door.button.when_released = None
+    pin.drive_low()  # closed
+    recorder = Recorder()
+    door.listeners.append(recorder)
+    door.start()
+    recorder.wait_for(DoorStatus.CLOSED, 0)
+    latencies = []
+    expected = len(recorder.statuses)
+    for _ in range(cycles):
+        for high, status, settled in ((True, DoorStatus.OPENING, DoorStatus.OPEN), (False, DoorStatus.CLOSED, None)):
+            # a whole poll interval of spread so the polling thread is caught at every phase
+            time.sleep(rnd.uniform(0.05, 1.05))
+            index = len(recorder.statuses)
+            started = change(pin, high, bounce)
+            reported = recorder.wait_for(status, index)
+            if reported is not None:
+                latencies.append(reported - started)
+            expected += 1
+            if settled is not None:
+                recorder.wait_for(settled, index)
+                expected += 1
+    time.sleep(0.1)
+    door.shutdown()
+    door.join(2.0)
+    return latencies, len(recorder.statuses), expected
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--cycles', type=int, default=10, help='open/close cycles per mode, defaults to 10')
+    p.add_argument('--bounce', action='store_true', help='make every change bounce')
+    options = p.parse_args()
+
+    gpio = mock_gpio()
+    print(f'{"mode":<8} {"mean ms":>8} {"p50 ms":>8} {"max ms":>8} {"reports":>8} {"expected":>9}')
+    for pin_number, (name, edges) in enumerate((('polling', False), ('edges', True)), start=20):
+        latencies, reports, expected = run(gpio, pin_number, edges, options.cycles, options.bounce, 1)
+        print(f'{name:<8} {statistics.mean(latencies) * 1000:>8.1f} {statistics.median(latencies) * 1000:>8.1f} '
+              f'{max(latencies) * 1000:>8.1f} {reports:>8} {expected:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Runs a whole garage stall against simulated hardware and reports sensor-to-LED and sensor-to-MQTT latency, CPU
+and memory.
+
+ControlThread is wired to the parts in simulation.py: a pty TFmini-S playing a car entering, parking and leaving,
+gpiozero mock pins for the door contact and relay, a recording NeoPixel strip, a fake Wifi cell source and a local
+MQTT broker.  Latency is measured from the moment a frame is written to the pty until the LED frame or the MQTT
+distance message it caused arrives; the frame's sequence number travels in its strength field.  The per-stage
+histograms Garage-Pi exports at /metrics, which start when the serial port is read, are printed as well.
+
+    python3 benchmarks/bench_end_to_end.py --loops 2 --rate 100
+    python3 benchmarks/bench_end_to_end.py --asyncio
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulation import SimulatedTfmini, RecordingNeoPixel, FakeWifi, MqttBroker, approach_profile, mock_gpio, rss_mb
+
+from control_thread import ControlThread
+from metrics import stage_latency
+
+
+class LatencyProbe:
+    """Follows sequence numbers from the TFmini-S frames through ControlThread to the LED strip and MQTT."""
+    def __init__(self, tfmini: SimulatedTfmini):
+        self.tfmini = tfmini
+        self.control_sequence = None
+        self.display_sequence = None
+        self.mqtt_sequences = {}  # payload -> sequence of the reading that was published
+        self.led_latencies = []
+        self.mqtt_latencies = []
+        self.measured_leds = set()
+
+    def attach(self, garage: ControlThread) -> None:
+        read = garage.tfminis.read
+
+        def probed_read():
+            reading = read()
+            if reading is not None:
+                self.control_sequence = reading['strength']
+            return reading
+        garage.tfminis.read = probed_read
+
+        set_reading = garage.display.set_reading
+
+        def probed_set_reading(distance, speed, received=None):
+            self.display_sequence = self.control_sequence
+            set_reading(distance, speed, received)
+        garage.display.set_reading = probed_set_reading
+
+        if garage.home_assistant is not None:
+            publish_telemetry = garage.home_assistant.publish_telemetry
+
+            def probed_publish_telemetry(key, value, received=None):
+                if key == 'current_distance':
+                    self.mqtt_sequences[f'{value:.0f}'] = self.control_sequence
+                publish_telemetry(key, value, received)
+            garage.home_assistant.publish_telemetry = probed_publish_telemetry
+
+    def on_led_write(self, when: float, frame: bytes) -> None:
+        if not self.tfmini.is_alive():
+            # frames after the last reading come from timeouts and shutdown, not from a reading
+            return
+        sequence = self.display_sequence
+        if sequence is not None and sequence not in self.measured_leds and sequence in self.tfmini.sent:
+            self.measured_leds.add(sequence)
+            self.led_latencies.append(when - self.tfmini.sent[sequence])
+
+    def on_publish(self, when: float, topic: str, payload: str) -> None:
+        if topic.endswith('garage_current_distance/state'):
+            sequence = self.mqtt_sequences.get(payload)
+            if sequence is not None and sequence in self.tfmini.sent:
+                self.mqtt_latencies.append(when - self.tfmini.sent[sequence])
+
+
+def percentiles(values: list) -> str:
+    if len(values) < 2:
+        return f'{"n/a":>8} {"n/a":>8} {"n/a":>8} {"n/a":>8} {len(values):>6}'
+    q = statistics.quantiles(values, n=100, method='inclusive')
+    return f'{q[49] * 1000:>8.1f} {q[94] * 1000:>8.1f} {q[98] * 1000:>8.1f} {max(values) * 1000:>8.1f} {len(values):>6}'
+
+
+def run_asyncio(garage: ControlThread) -> (threading.Thread, callable):
+    """Runs garage with AsyncRuntime on an event loop in another thread, returns the thread and a stop function."""
+    from async_runtime import AsyncRuntime
+    runtime = AsyncRuntime(garage)
+    event_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=event_loop.run_until_complete, args=(runtime.run(),), daemon=True)
+    thread.start()
+
+    def stop():
+        for task in runtime.tasks:
+            event_loop.call_soon_threadsafe(task.cancel)
+        thread.join(5.0)
+    return thread, stop
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--rate', type=float, default=100.0, help='TFmini-S frames per second, defaults to 100')
+    p.add_argument('--loops', type=int, default=1, help='times to play the enter/park/leave profile, defaults to 1')
+    p.add_argument('--asyncio', action='store_true', help='run the stall with AsyncRuntime instead of threads')
+    p.add_argument('--verbose', action='store_true', help='show Garage-Pi logging')
+    options = p.parse_args()
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+
+    gpio = mock_gpio()
+    door_contact = gpio.pin(2)
+    door_contact.drive_low()  # door closed
+    tfmini = SimulatedTfmini(approach_profile(), rate=options.rate, loops=options.loops)
+    probe = LatencyProbe(tfmini)
+    broker = MqttBroker(on_publish=probe.on_publish)
+    broker.start()
+    pixels = RecordingNeoPixel(on_write=probe.on_led_write)
+    wifi = FakeWifi('Car')
+
+    with tempfile.TemporaryDirectory() as directory:
+        garage = ControlThread(ssids=['Car'], tfmini_port=tfmini.port, mqtt_server='127.0.0.1', mqtt_port=broker.port,
+                               db_file=os.path.join(directory, 'garage_vars'),
+                               history_dir=os.path.join(directory, 'history'), pixels=pixels,
+                               pixel_write=pixels.write, asyncio_mode=options.asyncio)
+        garage.wifi_scanner.scan = wifi.scan
+        garage.wifi_scanner.event_monitor = None
+        probe.attach(garage)
+        if options.asyncio:
+            _, stop = run_asyncio(garage)
+        else:
+            garage.start()
+            stop = garage.shutdown
+        time.sleep(1.0)  # let everything connect and settle
+
+        rss_start = rss_mb()
+        cpu_start = time.process_time()
+        started = time.monotonic()
+        tfmini.start()
+        # the door opens and the car's Wifi shows up shortly before it enters, and it leaves the same way
+        time.sleep(1.0)
+        door_contact.drive_high()
+        wifi.present = True
+        tfmini.join()
+        wifi.present = False
+        door_contact.drive_low()
+        time.sleep(1.0)
+        elapsed = time.monotonic() - started
+        cpu = time.process_time() - cpu_start
+        stop()
+
+    tfmini.close()
+    broker.close()
+    mode = 'asyncio' if options.asyncio else 'threads'
+    print(f'{options.loops} enter/park/leave loops at {options.rate:g} frames/s, {tfmini.frames} frames, {mode}')
+    print(f'{"latency ms":<16} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8} {"count":>6}')
+    print(f'{"sensor to LED":<16} {percentiles(probe.led_latencies)}')
+    print(f'{"sensor to MQTT":<16} {percentiles(probe.mqtt_latencies)}')
+    print('stage latency from serial read, as exported at /metrics (bucket upper bounds)')
+    for stage in ('control', 'led', 'mqtt'):
+        histogram = stage_latency(stage)
+        p50, p99 = histogram.quantile(0.5), histogram.quantile(0.99)
+        if p50 is not None:
+            print(f'{stage:<16} p50 <= {p50 * 1000:g} ms, p99 <= {p99 * 1000:g} ms, {histogram.count} readings')
+    print(f'CPU: {cpu / elapsed * 100:.1f} % of one core ({cpu / elapsed * 1000:.0f} ms CPU per second)')
+    print(f'RSS: {rss_start:.1f} MiB at start, {rss_mb():.1f} MiB at end, '
+          f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB peak')
+    print(f'LED frames sent: {len(pixels.frames)}, MQTT messages: {len(broker.messages)}, Wifi scans: {wifi.scans}')
+
+
+if __name__ == '__main__':
+    main()
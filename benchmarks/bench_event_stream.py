@@ -0,0 +1,194 @@
+"""Load test of the /api/events server-sent event stream with up to 50 subscribers.
+
+A simulated stall publishes 100 distance readings a second, a door change every 2 seconds and a temperature every
+second, through the EventStream Garage-Pi uses, behind uvicorn on localhost.  The subscribers run in a separate
+process so the server CPU is measured on its own; each asks for --rate distance events a second.  One subscriber
+drops its connection halfway and reconnects with Last-Event-ID, the way EventSource does.
+
+"lag" is the delay from publish() to a subscriber parsing the event, not counting events replayed after the
+reconnect.  "missed" counts door and temperature events a subscriber never got, there should be none, including for
+the one that reconnected.  CPU is the server process including the simulated stall, which is the "0 subscribers" row.
+
+    python3 benchmarks/bench_event_stream.py --subscribers 50 --rate 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from starlette.responses import StreamingResponse
+
+from car_status import CarStatus
+from door_status_thread import DoorStatus
+from event_stream import EventStream
+from garage_state import GarageState
+
+
+def stall() -> SimpleNamespace:
+    """The parts of ControlThread EventStream and GarageState look at."""
+    garage = SimpleNamespace(door_status=SimpleNamespace(door_status=DoorStatus.CLOSED, listeners=[]),
+                             db={'car_status': CarStatus.AWAY}, tfminis=object(),
+                             tracker=SimpleNamespace(estimate=None), current_distance=390, speed=0.0, display=SimpleNamespace(park_distance=94),
+                             temperature_monitor=SimpleNamespace(temperature=45.0, listeners=[]), wifi_scanner=None,
+                             listeners=[])
+    garage.state = GarageState(garage)
+    garage.state.refresh()
+    return garage
+
+
+def play(garage: SimpleNamespace, stream: EventStream, seconds: float, published: list) -> None:
+    """Publishes readings at 100/s for seconds, appends the ids of door and temperature events to published."""
+    start = next_reading = time.monotonic()
+    i = 0
+    while next_reading - start < seconds:
+        garage.current_distance = 390 - i % 300
+        for listener in garage.listeners:
+            listener(garage.current_distance)
+        middle = 1.0 <= next_reading - start <= seconds - 1.0  # every subscriber is connected
+        if middle and i % 200 == 0:
+            status = DoorStatus.OPEN if garage.door_status.door_status == DoorStatus.CLOSED else DoorStatus.CLOSED
+            garage.door_status.door_status = status
+            for listener in garage.door_status.listeners:
+                listener(status)
+            published.append(stream.event_id(stream.sequence))
+        if middle and i % 100 == 50:
+            for listener in garage.temperature_monitor.listeners:
+                listener(45.0 + i % 7)
+            published.append(stream.event_id(stream.sequence))
+        garage.state.refresh()
+        i += 1
+        next_reading += 0.01
+        time.sleep(max(next_reading - time.monotonic(), 0))
+
+
+def create_app(stream: EventStream) -> FastAPI:
+    """The /api/events route of gui.create_pages without the rest of the web site."""
+    app = FastAPI(on_startup=[stream.start])
+
+    @app.get('/api/events')
+    async def api_events(request: Request, rate: float = 10.0):
+        last_event_id = request.headers.get('last-event-id', request.query_params.get('last_event_id'))
+        return StreamingResponse(stream.subscribe(last_event_id, rate), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return app
+
+
+async def subscriber(http: httpx.AsyncClient, rate: float, until: float, drop_at: float, result: dict) -> None:
+    """Reads events until time.time() reaches until, reconnecting with Last-Event-ID once at drop_at if given."""
+    last_event_id = None
+    connected = time.time()
+    while time.time() < until:
+        headers = {'Last-Event-ID': last_event_id} if last_event_id is not None else {}
+        async with http.stream('GET', '/api/events', params={'rate': rate}, headers=headers) as response:
+            event_type = None
+            async for line in response.aiter_lines():
+                now = time.time()
+                if line.startswith('id: '):
+                    last_event_id = line[4:]
+                elif line.startswith('event: '):
+                    event_type = line[7:]
+                elif line.startswith('data: '):
+                    result['events'] += 1
+                    result['bytes'] += len(line)
+                    published = json.loads(line[6:])['time']
+                    # events replayed after a reconnect are late by design
+                    if event_type != 'state' and published >= connected:
+                        result['lags'].append(now - published)
+                    if event_type in ('door', 'temperature'):
+                        result['ids'].append(last_event_id)
+                if now >= until or (drop_at is not None and now >= drop_at):
+                    break
+        if drop_at is not None and time.time() >= drop_at:
+            drop_at = None
+            await asyncio.sleep(0.5)  # EventSource waits before reconnecting
+            connected = time.time()
+
+
+def subscribers(port: int, count: int, rate: float, seconds: float, results) -> None:
+    """Runs count subscribers for seconds and puts what each saw on results."""
+    async def main():
+        limits = httpx.Limits(max_connections=count + 1)
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', limits=limits, timeout=None) as http:
+            until = time.time() + seconds
+            found = [{'events': 0, 'bytes': 0, 'lags': [], 'ids': []} for _ in range(count)]
+            drop_at = time.time() + seconds / 2
+            await asyncio.gather(*[subscriber(http, rate, until, drop_at if i == 0 else None, result)
+                                   for i, result in enumerate(found)])
+            return found
+    results.put(asyncio.run(main()))
+
+
+def run(count: int, rate: float, seconds: float) -> dict:
+    garage = stall()
+    stream = EventStream()
+    stream.connect(garage)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_app(stream), host='127.0.0.1', port=port, log_level='warning'))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    clients = None
+    if count > 0:
+        clients = context.Process(target=subscribers, args=(port, count, rate, seconds, results))
+        clients.start()
+        time.sleep(0.5)  # connected
+    published = []
+    cpu = time.process_time()
+    play(garage, stream, seconds, published)
+    cpu = time.process_time() - cpu
+    found = results.get() if clients is not None else []
+    if clients is not None:
+        clients.join()
+    server.should_exit = True
+    server_thread.join(5.0)
+    lags = sorted(lag for result in found for lag in result['lags'])
+    return {
+        'cpu': cpu / seconds,
+        'events': sum(result['events'] for result in found) / seconds,
+        'bytes': sum(result['bytes'] for result in found) / seconds,
+        'lags': lags,
+        'missed': sum(len(set(published) - set(result['ids'])) for result in found),
+        'resumed_missed': len(set(published) - set(found[0]['ids'])) if found else 0,
+        'stats': stream.stats()
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--subscribers', type=int, default=50, help='most subscribers to test with, defaults to 50')
+    p.add_argument('--rate', type=float, default=10.0, help='distance events per second per subscriber, defaults to 10')
+    p.add_argument('--seconds', type=float, default=10.0, help='seconds per run, defaults to 10')
+    options = p.parse_args()
+
+    print(f'{"subscribers":>11} {"CPU":>7} {"events/s":>9} {"kB/s":>7} {"lag p50":>9} {"lag p99":>9} {"lag max":>9} '
+          f'{"missed":>7}')
+    for count in sorted({0, 1, 10, options.subscribers}):
+        result = run(count, options.rate, options.seconds)
+        lags = result['lags']
+        latency = (f'{lags[len(lags) // 2] * 1000:>6.1f} ms {lags[int(len(lags) * 0.99)] * 1000:>6.1f} ms '
+                   f'{lags[-1] * 1000:>6.1f} ms' if lags else f'{"":>29}')
+        print(f'{count:>11} {result["cpu"] * 100:>6.1f}% {result["events"]:>9.0f} {result["bytes"] / 1000:>7.1f} '
+              f'{latency} {result["missed"]:>7}')
+    print(f'reconnecting subscriber missed {result["resumed_missed"]} door/temperature events, '
+          f'{result["stats"]["dropped"]} distance events dropped for the rate')
+
+
+if __name__ == '__main__':
+    main()
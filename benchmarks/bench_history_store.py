@@ -0,0 +1,70 @@
+"""Measures HistoryStore ingest cost, disk usage and downsampled query time for distance readings.
+
+Simulates --days of TFmini-S distance readings at --rate readings/s (a parked car with noise and a few arrivals and
+departures per day) into a temporary directory, then queries the last hour, day and week in 500 buckets, once with
+the store that wrote the data and once with a freshly opened one.  The defaults take about a minute on a Pi Zero 2W;
+use --days 7 for a full week.
+
+    python3 benchmarks/bench_history_store.py --days 1 --rate 10
+"""
+import argparse
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_store import HistoryStore, Series
+
+
+def distance(t: float, rnd: random.Random) -> float:
+    """Parked at 94 cm most of the time, away (390 cm) for a few hours a day, with sensor noise."""
+    away = math.sin(t / 86400 * 2 * math.pi * 3) > 0.6
+    return (390.0 if away else 94.0) + rnd.gauss(0, 1.0)
+
+
+def timed_query(store: HistoryStore, end: float, seconds: float) -> (float, int):
+    start = time.perf_counter()
+    buckets = store.query('distance', end - seconds, end, 500)
+    return time.perf_counter() - start, sum(count for _, _, _, _, count in buckets)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--days', type=float, default=1.0, help='days of readings to simulate, defaults to 1')
+    p.add_argument('--rate', type=float, default=10.0, help='readings per second, defaults to 10')
+    options = p.parse_args()
+
+    rnd = random.Random(1)
+    points = int(options.days * 86400 * options.rate)
+    end = time.time()
+    start = end - points / options.rate
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore(directory, series=[Series('distance')], retention_days=options.days + 1)
+        cpu_start = time.process_time()
+        for i in range(points):
+            t = start + i / options.rate
+            store.append('distance', distance(t, rnd), t)
+        store.flush()
+        cpu = time.process_time() - cpu_start
+        disk = store.stats()['disk_usage']
+        print(f'ingest: {points} readings, {cpu / points * 1e6:.2f} us CPU/reading '
+              f'({cpu / (points / options.rate) * 100:.4f} % of one core at {options.rate:g} Hz)')
+        print(f'disk:   {disk / 1e6:.1f} MB, {disk / points:.2f} bytes/reading')
+        print(f'peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+        reopened = HistoryStore(directory, series=[Series('distance')], retention_days=options.days + 1)
+        for name, s in (('writer', store), ('reopened', reopened)):
+            for label, seconds in (('hour', 3600), ('day', 86400), ('week', 7 * 86400)):
+                elapsed, count = timed_query(s, end, seconds)
+                print(f'query {name:>8} last {label:<4}: {elapsed * 1000:8.1f} ms for {count} readings in 500 buckets')
+        reopened.close()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Measures idle CPU and wake-ups per second of the garage threads, old sleep-polling loops vs BaseThread waits.
+
+Nothing is happening during the measurement: the TFmini-S pty sends no frames, the door contact does not change
+and no readings reach the display.  TfminisThread and DoorStatusThread are the real classes (the door contact uses
+gpiozero's mock pin factory when not running on a Pi).  ControlThread, NeoPixelDisplayThread and
+TemperatureMonitorThread need the Pi hardware, so their loops are represented by threads that wait the same way.
+
+    python3 benchmarks/bench_idle_wakeups.py --seconds 10
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial
+from gpiozero import Button, Device
+from gpiozero.pins.mock import MockFactory
+
+from base_thread import BaseThread
+from door_status_thread import DoorStatusThread
+from tfminis_thread import TfminisThread
+
+
+class LegacyLoop(threading.Thread):
+    """Runs body() followed by time.sleep(period) forever, the way every thread used to."""
+    def __init__(self, name: str, period: float, body=None):
+        super().__init__(daemon=True, name=name)
+        self.period = period
+        self.body = body
+        self.wakeups = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            if self.body is not None:
+                self.body()
+            if self.period > 0:
+                time.sleep(self.period)
+            self.wakeups += 1
+
+    def shutdown(self):
+        self.running = False
+
+
+class WaitingLoop(BaseThread):
+    """Blocks in wait() with the given timeout, None waits until notified."""
+    def __init__(self, name: str, timeout: float = None, sleep: float = None):
+        super().__init__()
+        self.name = name
+        self.timeout = timeout
+        self.period = sleep
+
+    def loop(self):
+        if self.period is not None:
+            self.sleep(self.period)
+        else:
+            self.wait(self.timeout)
+
+
+def legacy_threads(port: str, pin: int) -> list:
+    tfmini = serial.Serial(port, 115200)
+    button = Button(pin)
+
+    def tfmini_body():
+        if tfmini.in_waiting > 8:
+            tfmini.read(9)
+            tfmini.reset_input_buffer()
+
+    return [
+        LegacyLoop('TfminisThread', 0.0, tfmini_body),
+        LegacyLoop('DoorStatusThread', 1.0, lambda: button.is_pressed),
+        LegacyLoop('ControlThread', 0.1),
+        LegacyLoop('NeoPixelDisplayThread', 0.1),
+        LegacyLoop('TemperatureMonitorThread', 5.0),
+    ]
+
+
+def event_threads(port: str, pin: int) -> list:
+    tfmini = TfminisThread(port=port)
+    tfmini.name = 'TfminisThread'
+    door = DoorStatusThread(gpio_pin=pin)
+    door.name = 'DoorStatusThread'
+    return [
+        tfmini,
+        door,
+        WaitingLoop('ControlThread', timeout=1.0),
+        WaitingLoop('NeoPixelDisplayThread'),
+        WaitingLoop('TemperatureMonitorThread', sleep=5.0),
+    ]
+
+
+def measure(threads: list, seconds: float) -> (float, dict):
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)  # let the threads settle
+    start_wakeups = {thread.name: thread.wakeups for thread in threads}
+    start_cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - start_cpu
+    wakeups = {thread.name: (thread.wakeups - start_wakeups[thread.name]) / seconds for thread in threads}
+    started = time.monotonic()
+    for thread in threads:
+        thread.shutdown()
+    return cpu / seconds * 100, wakeups, time.monotonic() - started
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--seconds', type=float, default=10.0, help='seconds to measure each runtime, defaults to 10')
+    p.add_argument('--door_status_pin', type=int, default=2, help='door contact pin, defaults to 2')
+    options = p.parse_args()
+
+    if os.environ.get('GPIOZERO_PIN_FACTORY') is None:
+        Device.pin_factory = MockFactory()
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+
+    results = {}
+    for name, factory in (('sleep-polling', legacy_threads), ('event-driven', event_threads)):
+        results[name] = measure(factory(port, options.door_status_pin), options.seconds)
+        Device.pin_factory.reset()
+
+    names = list(results['sleep-polling'][1].keys())
+    print(f'{"thread":<26} {"before wakeups/s":>17} {"after wakeups/s":>16}')
+    for name in names:
+        print(f'{name:<26} {results["sleep-polling"][1][name]:>17.1f} {results["event-driven"][1][name]:>16.1f}')
+    print(f'{"process CPU %":<26} {results["sleep-polling"][0]:>17.1f} {results["event-driven"][0]:>16.1f}')
+    print(f'{"shutdown seconds":<26} {"never stops":>17} {results["event-driven"][2]:>16.2f}')
+    os.close(master)
+    os.close(slave)
+
+
+if __name__ == '__main__':
+    main()
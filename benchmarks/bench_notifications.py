@@ -0,0 +1,171 @@
+"""Measures how long a door change holds up the door contact thread to notify Autoremote, and what reaches it when
+the service is slow, down or hung.  "legacy" is the requests.get() Autoremote made on the door contact thread before,
+"dispatcher" is NotificationDispatcher.post() with Autoremote as a notifier.  The service is AutoremoteServer from
+benchmarks/simulation.py.
+
+    slow      - every answer takes --delay seconds, about a TLS handshake and a round trip to appspot from a Pi
+    outage    - the service answers 503 for 3 seconds while the door opens and closes twice
+    restart   - Garage-Pi is restarted while the service is down, the outbox delivers after the restart
+    hung      - the service never answers
+
+    python3 benchmarks/bench_notifications.py --delay 0.2
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import requests
+
+from simulation import AutoremoteServer
+
+from autoremote import Autoremote
+from notification_dispatcher import NotificationDispatcher
+from state_store import StateStore
+
+MESSAGES = ['garage-opened', 'garage-closed']
+
+
+def legacy_send(url: str, key: str, message: str) -> None:
+    """Autoremote.__send_message__ as it was, pointed at url."""
+    r = requests.get(f'{url}?key={key}&message={message}')
+    if r.status_code != 200:
+        print(f'unable to send {message} message to Autoremote ' + r.text)
+
+
+def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def dispatcher(server: AutoremoteServer, store=None, timeout: float = 5.0) -> NotificationDispatcher:
+    notifications = NotificationDispatcher(store=store, timeout=timeout, backoff=0.25, max_backoff=1.0)
+    notifications.add(Autoremote('key', url=server.url))
+    notifications.start()
+    return notifications
+
+
+def slow(delay: float, changes: int):
+    print(f'slow: {changes} door changes, service answers in {delay * 1000:.0f} ms')
+    print(f'{"impl":<11} {"blocked mean":>13} {"blocked max":>12} {"delivered":>10} {"connections":>12}')
+    server = AutoremoteServer(delay=delay)
+    server.start()
+    blocked = []
+    for i in range(changes):
+        started = time.perf_counter()
+        legacy_send(server.url, 'key', MESSAGES[i % 2])
+        blocked.append(time.perf_counter() - started)
+    print(f'{"legacy":<11} {statistics.mean(blocked) * 1000:>10.1f} ms {max(blocked) * 1000:>9.1f} ms '
+          f'{len(server.messages):>10} {server.connections:>12}')
+    server.close()
+
+    server = AutoremoteServer(delay=delay)
+    server.start()
+    notifications = dispatcher(server)
+    blocked = []
+    posted = []
+    for i in range(changes):
+        posted.append(time.monotonic())
+        started = time.perf_counter()
+        notifications.post(MESSAGES[i % 2])
+        blocked.append(time.perf_counter() - started)
+    wait_for(lambda: len(server.messages) == changes, changes * (delay + 1))
+    print(f'{"dispatcher":<11} {statistics.mean(blocked) * 1000:>10.3f} ms {max(blocked) * 1000:>9.3f} ms '
+          f'{len(server.messages):>10} {server.connections:>12}')
+    in_order = [message for _, _, message in server.messages] == [MESSAGES[i % 2] for i in range(changes)]
+    lags = [when - post for (when, _, _), post in zip(server.messages, posted)]
+    print(f'delivered in order: {in_order}, the last {max(lags):.2f} s after its door change, the changes came '
+          f'faster than the service answers')
+    notifications.shutdown()
+    server.close()
+
+
+def outage():
+    server = AutoremoteServer()
+    server.start()
+    notifications = dispatcher(server)
+    server.status = 503
+    started = time.monotonic()
+    for message in MESSAGES * 2:
+        notifications.post(message)
+        time.sleep(0.5)
+    time.sleep(max(3.0 - (time.monotonic() - started), 0))
+    server.status = 200
+    recovered = time.monotonic()
+    delivered = wait_for(lambda: len(server.messages) == 4, 5.0)
+    print(f'outage: {len(server.messages)} of 4 delivered {time.monotonic() - recovered:.2f} s after the service came '
+          f'back, in order: {[message for _, _, message in server.messages] == MESSAGES * 2}, '
+          f'{notifications.failed} failed attempts' + ('' if delivered else ', gave up waiting'))
+    notifications.shutdown()
+    server.close()
+
+
+def restart():
+    with tempfile.TemporaryDirectory() as directory:
+        server = AutoremoteServer()
+        server.start()
+        server.status = 503
+        store = StateStore(os.path.join(directory, 'garage'))
+        notifications = dispatcher(server, store)
+        for message in MESSAGES:
+            notifications.post(message)
+        wait_for(lambda: notifications.failed > 0, 2.0)
+        notifications.shutdown()
+        store.close()
+        outbox = len(StateStore(os.path.join(directory, 'garage')).get('outbox', []))
+
+        server.status = 200
+        store = StateStore(os.path.join(directory, 'garage'))
+        notifications = dispatcher(server, store)
+        wait_for(lambda: notifications.sent == 2, 5.0)
+        print(f'restart: {outbox} messages in the outbox, {len(server.messages)} delivered after the restart, '
+              f'outbox now {len(store.get("outbox", []))}')
+        notifications.shutdown()
+        store.close()
+        server.close()
+
+
+def hung():
+    server = AutoremoteServer()
+    server.start()
+    server.hang.set()
+    legacy = threading.Thread(target=legacy_send, args=(server.url, 'key', 'garage-opened'), daemon=True)
+    legacy.start()
+    legacy.join(3.0)
+    print(f'hung: legacy door contact thread {"still blocked after 3 s" if legacy.is_alive() else "returned"}')
+    notifications = dispatcher(server, timeout=1.0)
+    started = time.perf_counter()
+    notifications.post('garage-opened')
+    blocked = time.perf_counter() - started
+    wait_for(lambda: notifications.failed > 0, 3.0)
+    print(f'hung: dispatcher post() took {blocked * 1e6:.0f} us, the send timed out after '
+          f'{time.perf_counter() - started:.1f} s and is retried: {notifications.last_error is not None}')
+    server.close()
+    notifications.shutdown()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--delay', type=float, default=0.2, help='seconds the service takes to answer, defaults to 0.2')
+    p.add_argument('--changes', type=int, default=10, help='door changes in the slow test, defaults to 10')
+    options = p.parse_args()
+    logging.basicConfig(level=logging.ERROR)  # the retries are expected
+    slow(options.delay, options.changes)
+    outage()
+    restart()
+    hung()
+
+
+if __name__ == '__main__':
+    main()
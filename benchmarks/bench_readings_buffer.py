@@ -0,0 +1,81 @@
+"""Compares the per-reading cost of ControlThread's speed estimate before and after ReadingsBuffer.
+
+The legacy implementation is the np.append / boolean mask truncation / np.polyfit sequence that ControlThread.loop
+used to run for every reading.  Both are fed the same simulated approach at 10, 100 and 1000 samples/s.
+
+    python3 benchmarks/bench_readings_buffer.py --seconds 30
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from readings_buffer import ReadingsBuffer
+
+
+def legacy_truncate_time_series(arr: np.ndarray, seconds: float, now: float) -> np.ndarray:
+    return arr[arr[:, 0] >= now - seconds]
+
+
+def legacy_speed(arr: np.ndarray, now: float, period: float = 2.0) -> float:
+    truncated = legacy_truncate_time_series(arr, period, now)
+    if truncated.shape[0] < 2:
+        return -999.0
+    v, _ = np.polyfit(truncated[:, 0], truncated[:, 1], 1)
+    return v
+
+
+def approach(rate: int, seconds: float, seed: int = 1) -> list:
+    """Simulated car approaching at about 50 cm/s with sensor noise."""
+    rnd = random.Random(seed)
+    samples = []
+    for i in range(int(rate * seconds)):
+        t = 1000.0 + i / rate
+        samples.append((t, 390.0 - 50.0 * (i / rate) % 300.0 + 20.0 * math.sin(t) + rnd.gauss(0, 1.0)))
+    return samples
+
+
+def run_legacy(samples: list, size_in_seconds: float, rate: int) -> (float, float):
+    readings = np.zeros((0, 2))
+    v = 0.0
+    start = time.process_time()
+    for t, d in samples:
+        new_readings = np.append(readings, np.array([[t, d]]), axis=0)
+        readings = np.array(legacy_truncate_time_series(new_readings, size_in_seconds, t), copy=True)
+        v = legacy_speed(readings, t)
+    return time.process_time() - start, v
+
+
+def run_buffer(samples: list, size_in_seconds: float, rate: int) -> (float, float):
+    readings = ReadingsBuffer(capacity=int(rate * size_in_seconds) + 1, size_in_seconds=size_in_seconds)
+    v = 0.0
+    start = time.process_time()
+    for t, d in samples:
+        readings.append(d, t)
+        v = readings.speed(t)
+    return time.process_time() - start, v
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--seconds', type=float, default=30.0, help='seconds of readings to simulate, defaults to 30')
+    p.add_argument('--size_in_seconds', type=float, default=5.0, help='readings window, defaults to 5 seconds')
+    options = p.parse_args()
+
+    print(f'{"rate":>6} {"impl":>8} {"us/reading":>11} {"CPU %":>7} {"final speed":>12}')
+    for rate in (10, 100, 1000):
+        samples = approach(rate, options.seconds)
+        for name, run in (('legacy', run_legacy), ('buffer', run_buffer)):
+            cpu, v = run(samples, options.size_in_seconds, rate)
+            print(f'{rate:>6} {name:>8} {cpu / len(samples) * 1e6:>11.1f} {cpu / options.seconds * 100:>7.2f} '
+                  f'{v:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Measures what recording sessions costs, on disk and in CPU, and how fast SessionReplayer replays them.
+
+A session of --hours hours is recorded with a SessionRecorder the way ControlThread would record it, with the
+timestamps of the records set instead of waiting for them: 100 Hz TFmini-S frames with a bit of noise in distance and
+strength, one read per frame, 65535 (no target) while the car is away, the car Wifi scanned every second or every 30
+seconds while the car is parked behind a closed door.  Every hour the car is parked for 20 minutes, leaves (the door
+button is pressed from Home Assistant, the door opens and is closed behind it) and comes back 20 minutes later
+(Garage-Pi opened the door when it saw the car Wifi, the car parks and the door is closed).  "CPU/h" is the CPU time
+recording took per hour of session, the share of a core it takes at real time is that divided by 3600.
+
+The session is then replayed as fast as possible through a ControlThread, NeoPixelDisplayThread and HomeAssistant.
+"presses" are the door button presses of the replay, the recorded ones are in brackets.  Only the presses Garage-Pi
+made itself are replayed, one for each return of the car; the others were made from Home Assistant.
+
+    python3 benchmarks/bench_replay.py --hours 4
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulation import tfmini_frame
+
+PARK_DISTANCE = 94
+MAX_DISTANCE = 390
+
+
+def settings() -> dict:
+    """Returns what ControlThread.session_settings() would for the stall of the session."""
+    return {'park_distance': PARK_DISTANCE, 'max_distance': MAX_DISTANCE, 'ssids': ['Car'], 'num_pixels': 60,
+            'auto_open_via_wifi': True, 'auto_close_via_wifi': False, 'auto_open_cool_down': 300,
+            'door_movement_delay': 10, 'door_debounce': 0.005, 'period': 0.1, 'idle_timeout': 1.0,
+            'door_contact': True, 'wifi': ['Car'],
+            'db': {'last_found': 0, 'last_not_found': 0, 'last_parked': 0, 'last_exiting': 0, 'last_entering': 0,
+                   'car_status': 'PARKED'}}
+
+
+def hour_events() -> list:
+    """Returns (seconds into the hour, what, value) of what happens in an hour besides TFmini-S frames."""
+    leave = 20 * 60
+    back = 40 * 60
+    return [
+        (leave, 'relay', 'OPEN'),  # pressed from Home Assistant
+        (leave + 1.0, 'door', False),
+        (leave + 15.0, 'car', [(5.0, PARK_DISTANCE, MAX_DISTANCE), (0.0, MAX_DISTANCE, None)]),
+        (leave + 40.0, 'wifi', False),
+        (leave + 90.0, 'relay', 'CLOSE'),
+        (leave + 101.0, 'door', True),
+        (back, 'wifi', True),
+        (back + 2.3, 'relay', 'OPEN'),  # Garage-Pi saw the car Wifi
+        (back + 3.3, 'door', False),
+        (back + 20.0, 'car', [(5.0, MAX_DISTANCE, PARK_DISTANCE + 10), (2.0, PARK_DISTANCE + 10, PARK_DISTANCE)]),
+        (back + 120.0, 'relay', 'CLOSE'),
+        (back + 131.0, 'door', True),
+    ]
+
+
+def record(directory: str, hours: float, rate: float, start: float) -> dict:
+    """Records a session of hours hours starting at start (time.time() seconds) to directory."""
+    from door_control import DoorCommand
+    from session_recorder import RecordKind, SessionRecorder
+
+    random.seed(1)
+    recorder = SessionRecorder(directory, settings=settings)
+    events = sorted((hour * 3600 + t, what, value)
+                    for hour in range(int(hours + 1)) for t, what, value in hour_events())
+    distance = PARK_DISTANCE
+    moves = []  # (start, end, start distance, end distance or None once it is gone) of the car moving
+    wifi = True
+    fast = True
+    door_closed = True
+    next_scan = 0.0
+    cpu = time.process_time()
+    frame = 0
+    while frame < hours * 3600 * rate:
+        t = frame / rate
+        while events and events[0][0] <= t:
+            _, what, value = events.pop(0)
+            when = start + t
+            if what == 'relay':
+                recorder.append(RecordKind.RELAY, bytes([DoorCommand[value].value]), when)
+            elif what == 'door':
+                door_closed = value
+                recorder.append(RecordKind.DOOR, b'\1' if value else b'\0', when)
+            elif what == 'wifi':
+                wifi = value
+            elif what == 'car':
+                end = t
+                for seconds, begin, finish in value:
+                    moves.append((end, end + seconds, begin, finish))
+                    end += seconds
+        if moves and t >= moves[0][1]:
+            distance = moves.pop(0)[3]
+        elif moves and t >= moves[0][0] and moves[0][3] is not None:
+            begin, end, first, last = moves[0]
+            distance = first + (last - first) * (t - begin) / (end - begin)
+        if t >= next_scan:
+            recorder.append(RecordKind.WIFI, b'Car\t-61' if wifi else b'', start + t)
+            fast = not (door_closed and distance is not None and distance < PARK_DISTANCE + 5)
+            next_scan = t + (1.0 if fast else 30.0)
+        if distance is None:
+            data = tfmini_frame(65535, int(random.uniform(0, 100)), 2400)
+        else:
+            data = tfmini_frame(int(distance + random.gauss(0, 0.7)), int(2000 + random.gauss(0, 30)), 2400)
+        recorder.append(RecordKind.TFMINI, data, start + t)
+        frame += 1
+        if frame % int(rate * 60) == 0:
+            recorder.flush()  # ControlThread flushes every flush_interval
+    recorder.close()
+    cpu = time.process_time() - cpu
+    stats = recorder.stats()
+    stats.update({'cpu_per_hour': cpu / hours,
+                  'disk': sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)),
+                  'segments': len(recorder.segments())})
+    return stats
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--hours', type=float, default=4.0, help='hours of session to record and replay, defaults to 4')
+    p.add_argument('--rate', type=float, default=100.0, help='TFmini-S frames per second, defaults to 100')
+    options = p.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    from session_replay import SessionReplayer
+
+    with tempfile.TemporaryDirectory() as directory:
+        recorded = record(directory, options.hours, options.rate, time.time() - options.hours * 3600)
+        hours = options.hours
+        print(f'{"hours":>6} {"records":>9} {"raw MB":>7} {"disk MB":>8} {"MB/day":>7} {"ratio":>6} {"writes/h":>9} '
+              f'{"CPU/h":>7}')
+        print(f'{hours:>6g} {recorded["records"]:>9} {recorded["bytes_recorded"] / 1e6:>7.1f} '
+              f'{recorded["disk"] / 1e6:>8.2f} {recorded["disk"] / 1e6 * 24 / hours:>7.1f} '
+              f'{recorded["compression"]:>6.1f} {recorded["blocks_written"] / hours:>9.0f} '
+              f'{recorded["cpu_per_hour"]:>6.2f}s')
+
+        transitions = {}
+
+        def count(t: float, what: str, value: str) -> None:
+            transitions[what] = transitions.get(what, 0) + 1
+
+        replayed = SessionReplayer(directory, listener=count).run()
+        print()
+        print(f'{"replayed h":>10} {"seconds":>8} {"h/s":>6} {"readings":>9} {"presses":>9} {"door":>5} {"car":>5} '
+              f'{"leds":>5} {"mqtt":>5}')
+        print(f'{replayed["hours"]:>10.2f} {replayed["seconds"]:>8.1f} {replayed["hours_per_second"]:>6.2f} '
+              f'{replayed["readings"]:>9} {replayed["presses"]:>4} ({replayed["recorded_presses"]:>2}) '
+              f'{transitions.get("door", 0):>5} {transitions.get("car", 0):>5} {transitions.get("leds", 0):>5} '
+              f'{transitions.get("mqtt", 0):>5}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Measures how CPU, memory, MQTT connections and Wifi scans grow with the number of stalls, one process per stall
+as before vs every stall in one process with Stalls.
+
+Each stall gets a simulated TFmini-S playing a car entering, parking and leaving, its own mock door contact and relay,
+its own car Wifi and a 60 pixel recording NeoPixel strip (a 60 pixel segment of one strip with Stalls).  They all
+publish to one local MQTT broker.  The TFmini-S simulators and the broker run in this process, Garage-Pi runs in
+spawned processes, so CPU and RSS are Garage-Pi's alone; for "separate" they are the sums over the processes.
+"entities" counts the Home Assistant discovery configs the broker received, every stall has its own.
+
+    python3 benchmarks/bench_stalls.py --stalls 4 --seconds 18
+"""
+import argparse
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulation import SimulatedTfmini, RecordingNeoPixel, FakeWifi, MqttBroker, approach_profile, mock_gpio, rss_mb
+
+
+def garage_process(configs: list, shared: bool, broker_port: int, seconds: float, ready, go, results) -> None:
+    """Runs the stalls in configs, in one Stalls if shared, otherwise as a single ControlThread, and puts what it
+    cost on results."""
+    logging.basicConfig(level=logging.WARNING)
+    from control_thread import ControlThread
+    from stalls import Stalls
+
+    gpio = mock_gpio()
+    for config in configs:
+        gpio.pin(config['door_status_pin']).drive_low()  # door closed
+    wifis = [FakeWifi(ssid) for config in configs for ssid in config['ssids']]
+
+    def scan(interface: str) -> list:
+        return [cell for wifi in wifis for cell in wifi.scan(interface)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        pixels = RecordingNeoPixel()
+        if shared:
+            garage = Stalls(configs, num_pixels=60 * len(configs), mqtt_server='127.0.0.1', mqtt_port=broker_port,
+                            db_file=os.path.join(directory, 'garage_vars'),
+                            history_dir=os.path.join(directory, 'history'), pixels=pixels, pixel_write=pixels.write)
+        else:
+            config = dict(configs[0])
+            del config['name']
+            garage = ControlThread(mqtt_server='127.0.0.1', mqtt_port=broker_port,
+                                   db_file=os.path.join(directory, 'garage_vars'),
+                                   history_dir=os.path.join(directory, 'history'), pixels=pixels,
+                                   pixel_write=pixels.write, **config)
+        garage.wifi_scanner.scan = scan
+        garage.wifi_scanner.event_monitor = None
+        garage.start()
+        time.sleep(1.0)  # let everything connect and settle
+        ready.put(True)
+        go.wait()
+
+        cpu = time.process_time()
+        for config in configs:
+            gpio.pin(config['door_status_pin']).drive_high()  # door open
+        for wifi in wifis:
+            wifi.present = True
+        time.sleep(seconds)
+        cpu = time.process_time() - cpu
+        results.put({'cpu': cpu / seconds, 'rss': rss_mb(),
+                     'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                     'scans': garage.wifi_scanner.scans, 'frames': len(pixels.frames)})
+        garage.shutdown()
+
+
+def run(count: int, shared: bool, seconds: float, rate: float) -> dict:
+    broker = MqttBroker()
+    broker.start()
+    loops = math.ceil(seconds / sum(duration for duration, _, _ in approach_profile()))
+    tfminis = [SimulatedTfmini(approach_profile(), rate=rate, loops=loops) for _ in range(count)]
+    configs = [{'name': f'stall{i}', 'tfmini_port': tfmini.port, 'door_status_pin': 2 + i,
+                'door_control_pin': 17 + i, 'ssids': [f'Car{i}']} for i, tfmini in enumerate(tfminis)]
+    context = multiprocessing.get_context('spawn')
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    groups = [configs] if shared else [[config] for config in configs]
+    processes = [context.Process(target=garage_process, args=(group, shared, broker.port, seconds, ready, go, results))
+                 for group in groups]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+    go.set()
+    for tfmini in tfminis:
+        tfmini.start()
+    found = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    for tfmini in tfminis:
+        tfmini.close()
+    broker.close()
+    return {
+        'cpu': sum(result['cpu'] for result in found),
+        'rss': sum(result['rss'] for result in found),
+        'peak': sum(result['peak'] for result in found),
+        'scans': sum(result['scans'] for result in found),
+        'frames': sum(result['frames'] for result in found),
+        'connections': broker.connections,
+        'entities': len({topic for _, topic, _ in broker.messages if topic.endswith('/config')}),
+        'processes': len(processes)
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--stalls', type=int, default=4, help='most stalls to test with, at most 8, defaults to 4')
+    p.add_argument('--seconds', type=float, default=18.0, help='seconds per run, defaults to 18, one enter/park/leave')
+    p.add_argument('--rate', type=float, default=100.0, help='TFmini-S frames per second per stall, defaults to 100')
+    options = p.parse_args()
+
+    print(f'{"stalls":>6} {"mode":>9} {"procs":>6} {"CPU":>7} {"RSS MiB":>8} {"peak MiB":>9} {"MQTT conns":>11} '
+          f'{"entities":>9} {"Wifi scans":>11} {"LED frames":>11}')
+    counts = sorted({1, 2, min(options.stalls, 8)} | ({4} if options.stalls >= 4 else set()))
+    for count in counts:
+        for shared in (False, True):
+            result = run(count, shared, options.seconds, options.rate)
+            mode = 'stalls' if shared else 'separate'
+            print(f'{count:>6} {mode:>9} {result["processes"]:>6} {result["cpu"] * 100:>6.1f}% {result["rss"]:>8.1f} '
+                  f'{result["peak"]:>9.1f} {result["connections"]:>11} {result["entities"]:>9} '
+                  f'{result["scans"]:>11} {result["frames"]:>11}')
+
+
+if __name__ == '__main__':
+    main()
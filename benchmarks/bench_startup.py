@@ -0,0 +1,147 @@
+"""Measures how long after Garage-Pi is started the parking guide and the web site respond, starting everything in
+the order garage.py used to vs the staged startup.
+
+    legacy - the web site, MQTT, Wifi and notification modules are imported first, then ControlThread is built,
+             connecting to MQTT, started, and the web site is set up
+    staged - ControlThread(staged_startup=True) is built with only the TFmini-S, LED and door contact modules and
+             started, then MQTT and notifications start on a thread while the web site is imported
+
+Each run is a new Python process on simulated hardware, a SimulatedTfmini, a RecordingNeoPixel and gpiozero's mock
+pins, with a local MqttBroker, the same way garage.py would be started.  The times are seconds from starting the
+process until the first LED frame, the first TFmini-S reading reaching the stall, the first MQTT message and the
+first answer from /door-status.  The Wifi scanner is disabled, it would scan the real interface.
+
+    python3 benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+EVENTS = ['led', 'reading', 'mqtt', 'http']
+
+
+def once(event: str):
+    """Returns a listener that prints the time.monotonic() it is first called at for the parent to read."""
+    reported = []
+
+    def report(*args):
+        if not reported:
+            reported.append(True)
+            print(f'event {event} {time.monotonic()}', flush=True)
+    return report
+
+
+def garage_process(mode: str, directory: str, tfmini_port: str, mqtt_port: int, web_port: int) -> None:
+    """Starts Garage-Pi the way garage.py does in mode, runs until it is terminated."""
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    staged = mode == 'staged'
+    if not staged:
+        import gui
+        from nicegui import app, ui
+        # control_thread imported these before the staged startup
+        import autoremote, home_assistant, notification_dispatcher, wifi_scan_thread
+    from simulation import RecordingNeoPixel, mock_gpio
+    from control_thread import ControlThread
+
+    mock_gpio().pin(2).drive_low()  # door closed
+    pixels = RecordingNeoPixel(on_write=once('led'))
+    garage = ControlThread(ssids=['Car'], wlan_interface=None, tfmini_port=tfmini_port, mqtt_server='127.0.0.1',
+                           mqtt_port=mqtt_port, db_file=os.path.join(directory, 'garage_vars'),
+                           history_dir=os.path.join(directory, 'history'), pixels=pixels, pixel_write=pixels.write,
+                           staged_startup=staged)
+    garage.tfminis.listeners.append(once('reading'))
+    garage.start()
+    if staged:
+        threading.Thread(target=garage.start_services, name='services', daemon=True).start()
+        import gui
+        from nicegui import app, ui
+        garage.local_services_started.wait()
+    gui.create_pages(garage, {}, lambda: None, lambda: None)
+    ui.run(host='127.0.0.1', port=web_port, reload=False, show=False, storage_secret='bench',
+           show_welcome_message=False)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(mode: str, timeout: float) -> dict:
+    """Starts one Garage-Pi process and returns the seconds until each event that happened."""
+    from simulation import MqttBroker, SimulatedTfmini
+
+    broker = MqttBroker()
+    broker.start()
+    tfmini = SimulatedTfmini([(timeout + 5.0, 300, 300)])
+    tfmini.start()
+    web_port = free_port()
+    times = {}
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', json.dumps(
+            [mode, directory, tfmini.port, broker.port, web_port])], stdout=subprocess.PIPE, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        def read_events():
+            for line in process.stdout:
+                if line.startswith('event '):
+                    _, event, when = line.split()
+                    times.setdefault(event, float(when) - started)
+        reader = threading.Thread(target=read_events, daemon=True)
+        reader.start()
+
+        deadline = started + timeout
+        while 'http' not in times and time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{web_port}/door-status', timeout=1.0) as response:
+                    response.read()
+                times['http'] = time.monotonic() - started
+            except OSError:
+                time.sleep(0.005)
+        while len(times) < len(EVENTS) and time.monotonic() < deadline:
+            if broker.messages and 'mqtt' not in times:
+                times['mqtt'] = broker.messages[0][0] - started
+            time.sleep(0.01)
+        process.terminate()
+        process.wait(10)
+    tfmini.close()
+    broker.close()
+    return times
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--runs', type=int, default=5, help='processes started per mode, defaults to 5')
+    p.add_argument('--timeout', type=float, default=30.0, help='most seconds to wait for a run, defaults to 30')
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    options = p.parse_args()
+    if options.child is not None:
+        garage_process(*json.loads(options.child))
+        return
+
+    print(f'median of {options.runs} runs, seconds from starting the process')
+    print(f'{"startup":<8} {"first LED":>10} {"reading":>8} {"MQTT":>8} {"HTTP":>8}')
+    for mode in ('legacy', 'staged'):
+        runs = [run(mode, options.timeout) for _ in range(options.runs)]
+        medians = []
+        for event in EVENTS:
+            seconds = [times[event] for times in runs if event in times]
+            medians.append(f'{statistics.median(seconds):.3f}' if len(seconds) == len(runs) else 'missed')
+        print(f'{mode:<8} {medians[0]:>10} {medians[1]:>8} {medians[2]:>8} {medians[3]:>8}')
+
+
+if __name__ == '__main__':
+    main()
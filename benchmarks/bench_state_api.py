@@ -0,0 +1,154 @@
+"""Measures what /api/state costs and how fresh it is for clients polling, polling with ETags and long-polling.
+
+A stall plays benchmarks/simulation.approach_profile() with 1 cm of noise at 100 readings/s while GarageState.refresh()
+runs after every reading, the way ControlThread.step() calls it.  --clients clients fetch the state through the
+/api/state handler for the whole profile:
+    poll        - GET once a second, no If-None-Match
+    conditional - GET once a second with the last ETag, unchanged states are answered with 304
+    long-poll   - GET with the last ETag and ?wait=30, answered as soon as there is a new version
+"lag" is the delay from a version being made to a client first seeing it or a later one.  CPU is the process CPU per request while
+the simulated stall runs as well, so it includes the refreshes.
+
+    python3 benchmarks/bench_state_api.py --clients 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from fastapi import FastAPI, Request
+from starlette.responses import Response
+
+from simulation import approach_profile
+
+from car_status import CarStatus
+from distance_tracker import DistanceTracker
+from door_status_thread import DoorStatus
+from garage_state import GarageState
+
+RATE = 100
+
+
+def stall() -> SimpleNamespace:
+    """The parts of ControlThread GarageState looks at."""
+    return SimpleNamespace(door_status=SimpleNamespace(door_status=DoorStatus.OPEN), db={'car_status': CarStatus.AWAY},
+                           tfminis=object(), tracker=DistanceTracker(), current_distance=390, speed=0.0,
+                           display=SimpleNamespace(park_distance=94),
+                           temperature_monitor=SimpleNamespace(temperature=45.0), wifi_scanner=None)
+
+
+def play(garage: SimpleNamespace, state: GarageState, made: dict) -> None:
+    """Moves the car through the approach profile, refreshing the state after every reading.  made[version] is the
+    time.time() each version was made at."""
+    rnd = random.Random(1)
+    next_reading = time.monotonic()
+    for seconds, start, end in approach_profile():
+        count = int(seconds * RATE)
+        for i in range(count):
+            garage.current_distance = round(start + (end - start) * i / count + rnd.gauss(0, 1.0))
+            garage.tracker.update(garage.current_distance, 1000, time.monotonic())
+            garage.speed = garage.tracker.speed()
+            if state.refresh():
+                made[state.version] = time.time()
+            next_reading += 1.0 / RATE
+            time.sleep(max(next_reading - time.monotonic(), 0))
+
+
+def create_app(state: GarageState) -> FastAPI:
+    """The /api/state route of gui.create_pages without the rest of the web site."""
+    app = FastAPI()
+
+    @app.get('/api/state')
+    async def api_state(request: Request, wait: float = 0.0):
+        status, etag, body = await state.respond_async(request.headers.get('if-none-match'), wait)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if status == 304:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type='application/json', headers=headers)
+    return app
+
+
+async def client(http: httpx.AsyncClient, mode: str, stop: threading.Event, seen: dict, offset: float) -> list:
+    """Fetches the state until stop is set, returns the time.time() and version of every new version received."""
+    await asyncio.sleep(offset)
+    etag = None
+    received = []
+    while not stop.is_set():
+        headers = {'If-None-Match': etag} if etag is not None and mode != 'poll' else {}
+        params = {'wait': 30} if mode == 'long-poll' else {}
+        response = await http.get('/api/state', headers=headers, params=params)
+        seen['requests'] += 1
+        seen['bytes'] += len(response.content) + sum(len(k) + len(v) for k, v in response.headers.items())
+        if response.status_code == 200:
+            etag = response.headers['etag']
+            received.append((time.time(), response.json()['version']))
+        else:
+            seen['not_modified'] += 1
+        if mode != 'long-poll':
+            await asyncio.sleep(1.0)
+    return received
+
+
+def lags(made: dict, received: list) -> list:
+    """Returns the delay until received holds each version in made or a later one."""
+    result = []
+    for version, when in made.items():
+        for seen_at, seen_version in received:
+            if seen_version >= version:
+                result.append(max(seen_at - when, 0.0))
+                break
+    return result
+
+
+async def run(mode: str, clients: int) -> dict:
+    garage = stall()
+    state = GarageState(garage)
+    state.refresh()
+    made = {}
+    stop = threading.Event()
+    seen = {'requests': 0, 'not_modified': 0, 'bytes': 0}
+    transport = httpx.ASGITransport(app=create_app(state))
+    async with httpx.AsyncClient(transport=transport, base_url='http://garage-pi') as http:
+        player = threading.Thread(target=play, args=(garage, state, made))
+        cpu = time.process_time()
+        tasks = [asyncio.create_task(client(http, mode, stop, seen, i / clients)) for i in range(clients)]
+        await asyncio.sleep(1.0)  # every client has its first state
+        player.start()
+        await asyncio.get_running_loop().run_in_executor(None, player.join)
+        stop.set()
+        garage.door_status.door_status = DoorStatus.CLOSED
+        state.refresh()  # releases the long-polls
+        received = await asyncio.gather(*tasks)
+        cpu = time.process_time() - cpu
+    seen['versions'] = len(made)
+    seen['lags'] = [lag for r in received for lag in lags(made, r)]
+    seen['cpu'] = cpu
+    return seen
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--clients', type=int, default=10, help='clients fetching the state, defaults to 10')
+    options = p.parse_args()
+
+    print(f'{"mode":<12} {"requests":>9} {"304s":>6} {"kB":>8} {"versions":>9} {"lag p50":>9} {"lag max":>9} '
+          f'{"CPU/req":>9}')
+    for mode in ('poll', 'conditional', 'long-poll'):
+        seen = asyncio.run(run(mode, options.clients))
+        lags = seen['lags']
+        print(f'{mode:<12} {seen["requests"]:>9} {seen["not_modified"]:>6} {seen["bytes"] / 1000:>8.1f} '
+              f'{seen["versions"]:>9} {statistics.median(lags) * 1000:>6.0f} ms {max(lags) * 1000:>6.0f} ms '
+              f'{seen["cpu"] / seen["requests"] * 1000:>6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Throughput benchmark for the TFmini-S frame parser.
+
+Frames are written to one end of a pty pair and read back in bulk from the other end, the same way
+TfminisThread reads /dev/ttyS0.  Some frames are corrupted on purpose so resynchronization is exercised.
+
+    python3 benchmarks/bench_tfmini_parser.py --frames 100000 --corrupt 0.01
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tfmini_parser import TfminiParser
+
+
+def make_frame(distance: int, strength: int, temperature: int = 0x0920) -> bytes:
+    frame = bytearray([0x59, 0x59, distance & 0xff, distance >> 8, strength & 0xff, strength >> 8,
+                       temperature & 0xff, temperature >> 8])
+    frame.append(sum(frame) & 0xff)
+    return bytes(frame)
+
+
+def make_stream(frames: int, corrupt: float, seed: int = 1) -> (bytes, int):
+    """Returns a byte stream of frames and the number of frames that were left intact."""
+    rnd = random.Random(seed)
+    chunks = []
+    good = 0
+    for i in range(frames):
+        frame = bytearray(make_frame(30 + i % 360, 1000 + i % 200))
+        if rnd.random() < corrupt:
+            if rnd.random() < 0.5:
+                frame[rnd.randrange(2, 9)] ^= 0xff  # bad checksum
+            else:
+                frame = frame[rnd.randrange(1, 8):]  # truncated, next read starts mid-frame
+        else:
+            good += 1
+        chunks.append(bytes(frame))
+    return b''.join(chunks), good
+
+
+def writer(fd: int, stream: bytes, chunk_size: int):
+    view = memoryview(stream)
+    for i in range(0, len(stream), chunk_size):
+        os.write(fd, view[i:i + chunk_size])
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--frames', type=int, default=100000, help='number of frames to send, defaults to 100000')
+    p.add_argument('--corrupt', type=float, default=0.01, help='fraction of frames to corrupt, defaults to 0.01')
+    p.add_argument('--chunk', type=int, default=64, help='bytes per write to the pty, defaults to 64')
+    options = p.parse_args()
+
+    stream, good = make_stream(options.frames, options.corrupt)
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    parser = TfminiParser()
+    received = 0
+    thread = threading.Thread(target=writer, args=(master, stream, options.chunk), daemon=True)
+
+    start_cpu = time.thread_time()
+    start = time.perf_counter()
+    thread.start()
+    remaining = len(stream)
+    while remaining > 0:
+        data = os.read(slave, 4096)
+        remaining -= len(data)
+        received += len(parser.feed(data, time.monotonic()))
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+    thread.join()
+    os.close(master)
+    os.close(slave)
+
+    stats = parser.stats()
+    print(f'frames sent:         {options.frames} ({good} intact)')
+    print(f'frames parsed:       {received}')
+    print(f'resyncs:             {stats["resyncs"]}')
+    print(f'checksum failures:   {stats["checksum_failures"]}')
+    print(f'throughput:          {received / elapsed:,.0f} frames/s')
+    print(f'reader CPU / frame:  {cpu / max(received, 1) * 1e6:.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Measures CPU, threads and wake-ups of reading 1 to 8 TFmini-S sensors, one TfminisThread per sensor vs one
+TfminiReaderThread for all of them.
+
+Each sensor is a SimulatedTfmini sending --rate frames/s over its own pty, --corrupt of them with a bad checksum.
+The simulators run in this process, the readers in a spawned process, so the CPU is the readers' alone.
+"readings/s" reached a listener, "expected/s" is the frames with a good checksum sent per second and "checksum" is
+the failure rate the readers counted.
+
+    python3 benchmarks/bench_tfmini_reader.py --sensors 8 --seconds 10
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulation import SimulatedTfmini
+
+
+def reader_process(ports: list, selector: bool, seconds: float, ready, go, results) -> None:
+    """Reads ports with one TfminiReaderThread if selector, otherwise with a TfminisThread each, and puts what it
+    cost on results."""
+    logging.basicConfig(level=logging.WARNING)
+    from tfmini_reader_thread import TfminiReaderThread
+    from tfminis_thread import TfminisThread
+
+    received = [0]
+
+    def listener(reading):
+        received[0] += 1
+
+    if selector:
+        reader = TfminiReaderThread()
+        reader.listeners.append(listener)
+        threads = [reader]
+        parsers = [reader.add(f'tfmini{i}', port).parser for i, port in enumerate(ports)]
+    else:
+        threads = [TfminisThread(port=port) for port in ports]
+        parsers = [thread.parser for thread in threads]
+        for thread in threads:
+            thread.listeners.append(listener)
+    for thread in threads:
+        thread.start()
+    ready.put(True)
+    go.wait()
+    time.sleep(0.5)  # let the simulators get going
+
+    cpu = time.process_time()
+    wakeups = sum(thread.wakeups for thread in threads)
+    readings = received[0]
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    wakeups = sum(thread.wakeups for thread in threads) - wakeups
+    readings = received[0] - readings
+    frames = sum(parser.frames for parser in parsers)
+    failures = sum(parser.checksum_failures for parser in parsers)
+    results.put({'cpu': cpu / seconds, 'wakeups': wakeups / seconds, 'readings': readings / seconds,
+                 'threads': len(threads), 'checksum': failures / max(frames + failures, 1)})
+    for thread in threads:
+        thread.shutdown()
+
+
+def run(count: int, selector: bool, seconds: float, rate: float, corrupt: float) -> dict:
+    tfminis = [SimulatedTfmini([(seconds + 2.0, 300, 100)], rate=rate, corrupt=corrupt) for _ in range(count)]
+    context = multiprocessing.get_context('spawn')
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    process = context.Process(target=reader_process,
+                              args=([tfmini.port for tfmini in tfminis], selector, seconds, ready, go, results))
+    process.start()
+    ready.get()
+    for tfmini in tfminis:
+        tfmini.start()
+    go.set()
+    result = results.get()
+    process.join()
+    for tfmini in tfminis:
+        tfmini.close()
+    return result
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--sensors', type=int, default=8, help='most sensors to test with, defaults to 8')
+    p.add_argument('--seconds', type=float, default=10.0, help='seconds per run, defaults to 10')
+    p.add_argument('--rate', type=float, default=100.0, help='frames per second per sensor, defaults to 100')
+    p.add_argument('--corrupt', type=float, default=0.01, help='fraction of frames with a bad checksum, defaults to '
+                                                               '0.01')
+    options = p.parse_args()
+
+    print(f'{"sensors":>7} {"reader":>13} {"threads":>8} {"CPU":>7} {"wakeups/s":>10} {"readings/s":>11} '
+          f'{"expected/s":>11} {"checksum":>9}')
+    count = 1
+    while count <= options.sensors:
+        for selector in (False, True):
+            result = run(count, selector, options.seconds, options.rate, options.corrupt)
+            reader = 'selector' if selector else 'TfminisThread'
+            expected = count * options.rate * (1 - options.corrupt)
+            print(f'{count:>7} {reader:>13} {result["threads"]:>8} {result["cpu"] * 100:>6.1f}% '
+                  f'{result["wakeups"]:>10.0f} {result["readings"]:>11.0f} {expected:>11.0f} '
+                  f'{result["checksum"] * 100:>8.2f}%')
+        count *= 2
+
+
+if __name__ == '__main__':
+    main()
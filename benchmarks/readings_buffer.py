@@ -0,0 +1,159 @@
+import math
+import time
+from array import array
+
+from distance_tracker import RegressionSums
+
+
+class ReadingsBuffer:
+    """The speed estimate ControlThread used before DistanceTracker, kept as the baseline of bench_readings_buffer.py
+    and bench_distance_tracker.py.
+
+    Fixed capacity ring buffer of (time, distance) readings on the monotonic clock.
+
+    Running sums are kept up to date as readings are added and expire, so the least-squares speed over the last
+    speed_period seconds and the acceleration over the whole buffer are available in O(1) per reading instead of
+    re-fitting a line over a copy of the readings every time.
+    """
+    # Times are stored relative to origin; the sums are recomputed from a newer origin once the stored times grow
+    # past this many seconds so the squared terms do not lose precision.
+    REBASE_SECONDS = 60.0
+
+    def __init__(self, capacity: int = 1024, size_in_seconds: float = 5.0, speed_period: float = 2.0):
+        """
+        Parameters
+        ----------
+        capacity - int - maximum number of readings kept, oldest readings are dropped first, defaults to 1024
+        size_in_seconds - float - readings older than this are dropped, defaults to 5 seconds
+        speed_period - float - how many seconds of readings are used to compute speed, defaults to 2 seconds
+        """
+        self.capacity = capacity
+        self.size_in_seconds = size_in_seconds
+        self.speed_period = speed_period
+        self.times = array('d', bytes(8 * capacity))
+        self.distances = array('d', bytes(8 * capacity))
+        # velocity between a reading and the one before it, nan for the first reading
+        self.velocities = array('d', bytes(8 * capacity))
+        self.head = 0  # index of the oldest reading
+        self.count = 0
+        self.speed_tail = 0  # number of readings at the front of the buffer that are outside of speed_period
+        self.origin = 0.0
+        self.speed_sums = RegressionSums()
+        self.acceleration_sums = RegressionSums()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, distance: float, timestamp: float = None) -> None:
+        """Adds a reading taken at timestamp (time.monotonic() by default) and drops readings that have expired."""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self.count == 0:
+            self.origin = timestamp
+            velocity = math.nan
+        else:
+            last = self._index(self.count - 1)
+            dt = timestamp - self.times[last]
+            velocity = (distance - self.distances[last]) / dt if dt > 0 else 0.0
+        if self.count == self.capacity:
+            self._drop_oldest()
+        elif timestamp - self.origin > self.REBASE_SECONDS and self.count > 0:
+            self._rebase()
+        index = self._index(self.count)
+        self.times[index] = timestamp
+        self.distances[index] = distance
+        self.velocities[index] = velocity
+        self.count += 1
+        t = timestamp - self.origin
+        self.speed_sums.add(t, distance)
+        if velocity == velocity:
+            self.acceleration_sums.add(t, velocity)
+        self.expire(timestamp)
+
+    def expire(self, now: float = None) -> None:
+        """Drops readings older than size_in_seconds and moves readings older than speed_period out of the speed
+        window."""
+        if now is None:
+            now = time.monotonic()
+        start = now - self.size_in_seconds
+        while self.count > 0 and self.times[self.head] < start:
+            self._drop_oldest()
+        start = now - self.speed_period
+        while self.speed_tail < self.count:
+            index = self._index(self.speed_tail)
+            if self.times[index] >= start:
+                break
+            self.speed_sums.remove(self.times[index] - self.origin, self.distances[index])
+            self.speed_tail += 1
+
+    def speed(self, now: float = None) -> float:
+        """Returns the least-squares speed in centimeters per second over the last speed_period seconds or -999 if
+        there are not enough readings."""
+        self.expire(now)
+        return self.speed_sums.slope(-999.0)
+
+    def acceleration(self, now: float = None) -> float:
+        """Returns the least-squares slope of the velocities between readings in the buffer in cm/s^2."""
+        self.expire(now)
+        return self.acceleration_sums.slope(0.0)
+
+    def latest(self):
+        """Returns (time, distance) of the newest reading or None if the buffer is empty."""
+        if self.count == 0:
+            return None
+        index = self._index(self.count - 1)
+        return self.times[index], self.distances[index]
+
+    def readings(self) -> list:
+        """Returns a list of (time, distance) tuples from oldest to newest."""
+        return [(self.times[i], self.distances[i]) for i in map(self._index, range(self.count))]
+
+    def set_size_in_seconds(self, size: float) -> None:
+        self.size_in_seconds = size
+        self.expire()
+
+    def clear(self) -> None:
+        self.head = 0
+        self.count = 0
+        self.speed_tail = 0
+        self.speed_sums.clear()
+        self.acceleration_sums.clear()
+
+    def _index(self, offset: int) -> int:
+        return (self.head + offset) % self.capacity
+
+    def _drop_oldest(self) -> None:
+        index = self.head
+        t = self.times[index] - self.origin
+        if self.speed_tail > 0:
+            self.speed_tail -= 1
+        else:
+            self.speed_sums.remove(t, self.distances[index])
+        velocity = self.velocities[index]
+        if velocity == velocity:
+            self.acceleration_sums.remove(t, velocity)
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        if self.count > 0:
+            # the new oldest reading has no reading before it anymore
+            index = self.head
+            velocity = self.velocities[index]
+            if velocity == velocity:
+                self.acceleration_sums.remove(self.times[index] - self.origin, velocity)
+                self.velocities[index] = math.nan
+        else:
+            self.clear()
+
+    def _rebase(self) -> None:
+        """Recomputes the running sums relative to the oldest reading, which also flushes accumulated rounding."""
+        self.origin = self.times[self.head]
+        self.speed_sums.clear()
+        self.acceleration_sums.clear()
+        for offset in range(self.count):
+            index = self._index(offset)
+            t = self.times[index] - self.origin
+            if offset >= self.speed_tail:
+                self.speed_sums.add(t, self.distances[index])
+            velocity = self.velocities[index]
+            if velocity == velocity:
+                self.acceleration_sums.add(t, velocity)
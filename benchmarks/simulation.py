@@ -0,0 +1,307 @@
+"""Simulated Garage-Pi hardware so ControlThread can run on any Linux machine.
+
+    SimulatedTfmini   - pty pair the TfminisThread reads, plays scripted distance profiles as TFmini-S frames
+    RecordingNeoPixel - NeoPixel stand-in that records every frame sent to the strip
+    FakeWifi          - cell source for WifiScanThread whose car network can be switched on and off
+    MqttBroker        - minimal MQTT 3.1.1 broker that records what is published to it
+    AutoremoteServer  - local HTTP stand-in for the Autoremote service that can be made slow, failing or hung
+    mock_gpio()       - gpiozero mock pin factory for the door contact and relay
+
+Used by the bench_*.py scripts in this directory, not by Garage-Pi itself.
+"""
+import os
+import random
+import select
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import struct
+import threading
+import time
+import tty
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+from wifi import Cell
+
+
+def tfmini_frame(distance: int, strength: int = 0, temperature: int = 0) -> bytes:
+    """Returns the 9 byte TFmini-S frame for the given values."""
+    frame = bytes([0x59, 0x59, distance & 0xFF, distance >> 8 & 0xFF, strength & 0xFF, strength >> 8 & 0xFF,
+                   temperature & 0xFF, temperature >> 8 & 0xFF])
+    return frame + bytes([sum(frame) & 0xFF])
+
+
+def approach_profile(max_distance: int = 390, park_distance: int = 94) -> list:
+    """Returns (seconds, start distance, end distance) segments of a car entering, parking and leaving."""
+    return [
+        (2.0, max_distance, max_distance),  # nobody home
+        (5.0, max_distance, park_distance + 10),  # entering
+        (2.0, park_distance + 10, park_distance),  # creeping to the spot
+        (3.0, park_distance, park_distance),  # parked
+        (4.0, park_distance, max_distance),  # leaving
+        (2.0, max_distance, max_distance)
+    ]
+
+
+class SimulatedTfmini(threading.Thread):
+    """Writes TFmini-S frames at rate frames/s to a pty, port is the device name to give TfminisThread.
+
+    The strength field of each frame carries a sequence number and sent[sequence] is the time.monotonic() the frame
+    was written, so whoever sees a reading can tell how long ago it left the sensor.  A corrupt fraction of the
+    frames is sent with a bad checksum."""
+    def __init__(self, profile: list, rate: float = 100.0, loops: int = 1, corrupt: float = 0.0):
+        super().__init__(daemon=True, name='simulated-tfmini')
+        self.profile = profile
+        self.rate = rate
+        self.loops = loops
+        self.corrupt = corrupt
+        self.random = random.Random(len(profile))
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.sent = {}
+        self.frames = 0
+        self.running = True
+
+    def duration(self) -> float:
+        return sum(seconds for seconds, _, _ in self.profile) * self.loops
+
+    def run(self) -> None:
+        interval = 1.0 / self.rate
+        next_frame = time.monotonic()
+        for _ in range(self.loops):
+            for seconds, start, end in self.profile:
+                count = max(int(seconds * self.rate), 1)
+                for i in range(count):
+                    if not self.running:
+                        return
+                    # kept in the strength range Garage-Pi trusts, 100 up to 65534
+                    sequence = self.frames % 65000 + 100
+                    self.sent[sequence] = time.monotonic()
+                    frame = tfmini_frame(round(start + (end - start) * i / count), sequence)
+                    if self.corrupt > 0 and self.random.random() < self.corrupt:
+                        frame = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+                    os.write(self.master, frame)
+                    self.frames += 1
+                    next_frame += interval
+                    delay = next_frame - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+    def close(self) -> None:
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class RecordingNeoPixel:
+    """Stands in for neopixel.NeoPixel and neopixel_write, pass it as pixels and its write as write."""
+    def __init__(self, byteorder: str = 'GRB', on_write=None):
+        self.pin = 'simulated'
+        self.byteorder = byteorder
+        self.on_write = on_write
+        self.frames = []  # (time.monotonic(), frame)
+
+    def write(self, pin, frame: bytes) -> None:
+        now = time.monotonic()
+        self.frames.append((now, frame))
+        if self.on_write is not None:
+            self.on_write(now, frame)
+
+
+class FakeWifi:
+    """Cell source for WifiScanThread, the car's network is in range while present is True."""
+    def __init__(self, ssid: str, scan_seconds: float = 0.0):
+        self.ssid = ssid
+        self.scan_seconds = scan_seconds
+        self.present = False
+        self.scans = 0
+
+    def scan(self, interface: str) -> list:
+        self.scans += 1
+        if self.scan_seconds > 0:
+            time.sleep(self.scan_seconds)
+        cells = []
+        for ssid in ([self.ssid] if self.present else []) + ['Neighbor']:
+            cell = Cell()
+            cell.ssid = ssid
+            cell.address = '02:00:00:00:00:01'
+            cell.signal = -60
+            cells.append(cell)
+        return cells
+
+
+class _MqttHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        broker = self.server.broker
+        sock = self.request
+        buffer = b''
+        while broker.running:
+            readable, _, _ = select.select([sock], [], [], 0.2)
+            if not readable:
+                continue
+            data = sock.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while True:
+                packet = self._packet(buffer)
+                if packet is None:
+                    break
+                packet_type, flags, body, length = packet
+                buffer = buffer[length:]
+                if not self._handle(sock, packet_type, flags, body):
+                    return
+
+    @staticmethod
+    def _packet(buffer: bytes):
+        """Returns (type, flags, body, total length) of the first complete packet in buffer, or None."""
+        if len(buffer) < 2:
+            return None
+        remaining, multiplier, pos = 0, 1, 1
+        while True:
+            if pos >= len(buffer):
+                return None
+            byte = buffer[pos]
+            remaining += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            pos += 1
+            if byte & 0x80 == 0:
+                break
+        if len(buffer) < pos + remaining:
+            return None
+        return buffer[0] >> 4, buffer[0] & 0x0F, buffer[pos:pos + remaining], pos + remaining
+
+    def _handle(self, sock, packet_type: int, flags: int, body: bytes) -> bool:
+        broker = self.server.broker
+        if packet_type == 1:  # CONNECT
+            with broker.lock:
+                broker.connections += 1
+            sock.sendall(b'\x20\x02\x00\x00')
+        elif packet_type == 3:  # PUBLISH
+            received = time.monotonic()
+            topic_length = struct.unpack_from('>H', body)[0]
+            topic = body[2:2 + topic_length].decode()
+            pos = 2 + topic_length
+            qos = flags >> 1 & 0x03
+            if qos > 0:
+                packet_id = body[pos:pos + 2]
+                pos += 2
+                sock.sendall(b'\x40\x02' + packet_id)
+            broker.received(received, topic, body[pos:].decode())
+        elif packet_type == 8:  # SUBSCRIBE
+            packet_id = body[:2]
+            pos, granted = 2, b''
+            while pos < len(body):
+                topic_length = struct.unpack_from('>H', body, pos)[0]
+                pos += 2 + topic_length + 1
+                granted += b'\x00'
+            sock.sendall(bytes([0x90, 2 + len(granted)]) + packet_id + granted)
+        elif packet_type == 12:  # PINGREQ
+            sock.sendall(b'\xd0\x00')
+        elif packet_type == 14:  # DISCONNECT
+            return False
+        return True
+
+
+class MqttBroker:
+    """Accepts MQTT clients on 127.0.0.1:port (0 picks a free port) and records every publication as
+    (time.monotonic(), topic, payload) in messages and counts the clients that connected in connections.  Only QoS 0
+    and 1 without retained delivery are supported."""
+    def __init__(self, port: int = 0, on_publish=None):
+        self.on_publish = on_publish
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.running = True
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', port), _MqttHandler)
+        self.server.daemon_threads = True
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='mqtt-broker')
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def received(self, when: float, topic: str, payload: str) -> None:
+        self.messages.append((when, topic, payload))
+        if self.on_publish is not None:
+            self.on_publish(when, topic, payload)
+
+    def close(self) -> None:
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _AutoremoteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.stand_in.lock:
+            self.server.stand_in.connections += 1
+
+    def do_GET(self) -> None:
+        stand_in = self.server.stand_in
+        query = parse_qs(urlparse(self.path).query)
+        if stand_in.hang.is_set():
+            stand_in.hang_released.wait()
+        time.sleep(stand_in.delay)
+        status = stand_in.status
+        if status == 200:
+            stand_in.messages.append((time.monotonic(), query.get('key', [''])[0], query.get('message', [''])[0]))
+        body = b'OK' if status == 200 else b'Service Unavailable'
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            pass  # the client gave up waiting
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class AutoremoteServer:
+    """Answers Autoremote sendmessage requests on http://127.0.0.1:port/sendmessage (0 picks a free port) and
+    records (time.monotonic(), key, message) of every message it took in messages.  delay makes every answer slow,
+    status other than 200 makes it fail and hang.set() makes it not answer at all until close()."""
+    def __init__(self, port: int = 0, delay: float = 0.0):
+        self.delay = delay
+        self.status = 200
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.hang = threading.Event()
+        self.hang_released = threading.Event()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _AutoremoteHandler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.port = self.server.server_address[1]
+        self.url = f'http://127.0.0.1:{self.port}/sendmessage'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='autoremote')
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def close(self) -> None:
+        self.hang_released.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def mock_gpio() -> MockFactory:
+    """Makes gpiozero use mock pins, drive a door contact closed with factory.pin(n).drive_low()."""
+    if not isinstance(Device.pin_factory, MockFactory):
+        Device.pin_factory = MockFactory()
+    return Device.pin_factory
+
+
+def rss_mb() -> float:
+    """Returns the current resident set size of this process in MiB."""
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
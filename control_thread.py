@@ -1,21 +1,23 @@
 import logging
+import threading
 import time
-import shelve
+from concurrent.futures import Future
 
-import board
-import numpy as np
-
-from autoremote import Autoremote
 from base_thread import BaseThread
 from car_status import CarStatus
-from home_assistant import HomeAssistant
+from history_store import HistoryStore
 from home_assistant_controllable import HomeAssistantControllable
+from metrics import stage_latency
+from session_recorder import SessionRecorder
+from state_store import StateStore
+from tfmini_reader_thread import TfminiReaderThread
 from tfminis_thread import TfminisThread
-from door_control import DoorControl
+from door_control import DoorControl, DoorCommand
+from distance_tracker import DistanceTracker
 from door_status_thread import DoorStatusThread, DoorStatus
+from garage_state import GarageState
 from neopixel_display_thread import NeoPixelDisplayThread
 from temperature_monitor_thread import TemperatureMonitorThread
-from wifi_scan_thread import WifiScanThread
 
 
 class ControlThread(BaseThread, HomeAssistantControllable):
@@ -26,7 +28,7 @@ class ControlThread(BaseThread, HomeAssistantControllable):
                  ssids: [list] = None,
                  tfmini_port: str = '/dev/ttyS0',
                  tfmini_baud: int = 115200,
-                 neopixel_pin = board.D21,
+                 neopixel_pin = None,
                  num_pixels: int = 60,
                  door_status_pin: int = 2,
                  door_control_pin: int = 17,
@@ -41,7 +43,28 @@ class ControlThread(BaseThread, HomeAssistantControllable):
                  auto_open_cool_down: int = 300,
                  db_file: str = 'garage_vars',
                  door_movement_delay:int = 10,
-                 autoremote_key: str = None):
+                 door_debounce: float = 0.005,
+                 autoremote_key: str = None,
+                 period: float = 0.1,
+                 idle_timeout: float = 1.0,
+                 asyncio_mode: bool = False,
+                 db_flush_interval: float = 60.0,
+                 mqtt_json_state: bool = False,
+                 mqtt_coalesce_window: float = 0.25,
+                 mqtt_telemetry: bool = True,
+                 wifi_slow_scan_period: float = 30.0,
+                 history_dir: str = 'history',
+                 history_retention_days: float = 7.0,
+                 mqtt_port: int = 1883,
+                 pixels = None,
+                 pixel_write = None,
+                 name: str = None,
+                 wifi_scanner: 'WifiScanThread' = None,
+                 temperature_monitor: TemperatureMonitorThread = None,
+                 mqtt_connection: 'MqttConnection' = None,
+                 tfmini_reader: TfminiReaderThread = None,
+                 staged_startup: bool = False,
+                 record_dir: str = None):
         """Create a Garage Stall control thread with the given parameters for the sensors.
 
         Parameters
@@ -52,7 +75,7 @@ class ControlThread(BaseThread, HomeAssistantControllable):
         ssids - list(str) - Name of car wifis to look for, defaults to None
         tfmini_port - str - TFmini-S serial port connection, defaults to /dev/ttyS0, None disables
         tfmini_baud - int - TFmini-S baud rate, defaults to 115200
-        neopixel_pin - str - board.Pin for neopixel display, defaults to board.D21
+        neopixel_pin - board.Pin - pin of the neopixel display, defaults to board.D21
         num_pixels - int - number of neopixel pins to use, defaults to 60
         door_status_pin - int - GPIOzero pin number for monitoring garage door open/close status, defaults to 2
         door_control_pin - int - GPIOzero pin number for controlling garage door via relat, defaults to 17
@@ -67,54 +90,122 @@ class ControlThread(BaseThread, HomeAssistantControllable):
         auto_open_cool_down - int - number of seconds to wait after exiting before auto-opening garage when Wifi is
             seen, defaults to 300 (5 minutes)
         db_file - str - name of file to use for storage of persistent variables last_found, last_not_found, etc,
-            defaults to 'garage_vars' (.db is auto-appended)
+            defaults to 'garage_vars' (.journal is auto-appended)
         door_movement_delay - int - number of seconds to wait before considering open or close a failure if
             door_status_pin does not change, defaults to 10 seconds
+        door_debounce - float - seconds door_status_pin has to stay put after it changes before it is read, defaults
+            to 5 ms
         autoremote_key - str - Tasker autoremote key to send garage-opened and garage-closed messages to
+        period - float - minimum number of seconds between runs of the control loop, defaults to 0.1 seconds
+        idle_timeout - float - seconds to wait for a reading, door or Wifi change before running the control loop
+            anyway, defaults to 1 second
+        asyncio_mode - bool - True if AsyncRuntime will run this stall as asyncio tasks instead of starting threads,
+            MQTT then connects from the event loop instead of paho's network thread, defaults to False
+        db_flush_interval - float - maximum number of seconds changes to persistent variables are kept only in
+            memory, car_status changes are always written immediately, defaults to 60 seconds
+        mqtt_json_state - bool - True to publish the state to Home Assistant as one JSON message, defaults to False
+        mqtt_coalesce_window - float - minimum seconds between MQTT state publications, defaults to 0.25 seconds
+        mqtt_telemetry - bool - True to send distance, speed, CPU temperature and Wifi presence to Home Assistant,
+            defaults to True
+        wifi_slow_scan_period - float - seconds between Wifi scans while the car is parked and the door is closed,
+            defaults to 30 seconds
+        history_dir - str - directory to keep the history of distance, speed, strength, CPU temperature and door status
+            in, None disables, defaults to 'history'
+        history_retention_days - float - number of days of history to keep, defaults to 7
+        mqtt_port - int - port of the MQTT server, defaults to 1883
+        pixels - neopixel.NeoPixel - strip to draw on instead of creating one on neopixel_pin, for simulation
+        pixel_write - function(pin, bytes) - sends frames to pixels instead of neopixel_write, for simulation or for
+            a segment of a NeoPixelStrip shared with other stalls
+        name - str - name of the stall when one process runs several, added to its MQTT topics, defaults to None
+        wifi_scanner - WifiScanThread - scanner shared with other stalls instead of scanning on wlan_interface, it
+            has to scan for ssids as well, defaults to None
+        temperature_monitor - TemperatureMonitorThread - monitor shared with other stalls, defaults to None
+        mqtt_connection - MqttConnection - MQTT connection shared with other stalls instead of connecting to
+            mqtt_server, defaults to None
+        tfmini_reader - TfminiReaderThread - reader shared with other stalls that reads tfmini_port instead of a
+            TfminisThread of its own, defaults to None
+        staged_startup - bool - True to leave out the Wifi scanner, notifications and MQTT, and the imports they need,
+            until start_services() is called, so the TFmini-S, LEDs and door contact can be started without waiting
+            for them, start_services() alone then hooks up and starts the Wifi scanner and notifications, defaults
+            to False
+        record_dir - str - directory to record the TFmini-S bytes, door contact edges, car Wifi scans and door button
+            presses in for session_replay.py, kept for history_retention_days, None disables, defaults to None
+        Shared threads and connections are started and shut down by whoever created them, see Stalls.
         """
-        super(ControlThread, self).__init__()
+        super(ControlThread, self).__init__(min_period=period)
+        self.stall_name = name
+        if name is not None:
+            self.name = name  # names the thread, a Thread's name is never None
+        # started and shut down by whoever created them
+        self.shared = [thread for thread in (wifi_scanner, temperature_monitor) if thread is not None]
         self.max_distance = max_distance
         self.park_distance = park_distance
-        if tfmini_port is not None:
+        self.tfmini_reader = tfmini_reader
+        if tfmini_port is not None and tfmini_reader is not None:
+            self.tfminis = tfmini_reader.add(name if name is not None else tfmini_port, tfmini_port, tfmini_baud)
+        elif tfmini_port is not None:
             self.tfminis = TfminisThread(port=tfmini_port, baud=tfmini_baud)
         else:
             self.tfminis = None
             logging.info('TFmini-S disabled')
         self.wlan_interface = wlan_interface
         self.ssids = ssids
-        self.display = NeoPixelDisplayThread(max_distance = max_distance, pin=neopixel_pin, num_pixels=num_pixels)
-        self.door_status = DoorStatusThread(gpio_pin=door_status_pin, door_movement_delay=door_movement_delay)
-        if autoremote_key is not None:
-            self.autoremote = Autoremote(autoremote_key)
-        else:
-            self.autoremote = None
-        self.control = DoorControl(gpio_pin=door_control_pin)
-        if mqtt_server is not None:
-            self.home_assistant = HomeAssistant(self,
-                                                mqtt_server=mqtt_server,
-                                                mqtt_discovery_prefix=mqtt_discovery_prefix,
-                                                mqtt_device_id=mqtt_device_id,
-                                                mqtt_device_name=mqtt_device_name,
-                                                mqtt_username=mqtt_username,
-                                                mqtt_password=mqtt_password
-                                                )
-        else:
-            self.home_assistant = None
-        # readings array will have time in column 0 and distance in column 1
-        self.readings = np.zeros((0,2))
-        self.readings_size_in_seconds = 5.0
+        self.display = NeoPixelDisplayThread(max_distance = max_distance, pin=neopixel_pin, num_pixels=num_pixels,
+                                             pixels=pixels, write=pixel_write)
+        self.door_status = DoorStatusThread(gpio_pin=door_status_pin, door_movement_delay=door_movement_delay,
+                                            debounce=door_debounce)
+        self.control = DoorControl(gpio_pin=door_control_pin, resolve=self._resolve_command)
+        # created by create_services()
+        self.home_assistant = None
+        self.wifi_scanner = None
+        self.autoremote = None
+        self.notifications = None
+        self.early_notifications = []  # posted before there were notifications to post them to
+        self.services_lock = threading.Lock()
+        self.local_services_started = threading.Event()  # set by start_services()
+        # start_services() rather than run() hooks up and starts the Wifi scanner and notifications, whichever of
+        # start() and start_services() is called first
+        self.staged_startup = staged_startup
+        self.service_options = {
+            'wifi_scanner': wifi_scanner,
+            'wifi_slow_scan_period': wifi_slow_scan_period,
+            'autoremote_key': autoremote_key,
+            'home_assistant': dict(mqtt_server=mqtt_server,
+                                   mqtt_port=mqtt_port,
+                                   mqtt_discovery_prefix=mqtt_discovery_prefix,
+                                   mqtt_device_id=mqtt_device_id,
+                                   mqtt_device_name=mqtt_device_name,
+                                   mqtt_username=mqtt_username,
+                                   mqtt_password=mqtt_password,
+                                   connect=not asyncio_mode,
+                                   coalesce_window=mqtt_coalesce_window,
+                                   json_state=mqtt_json_state,
+                                   telemetry=mqtt_telemetry,
+                                   connection=mqtt_connection,
+                                   stall=name)
+        }
+        self.control_latency = stage_latency('control')
         self.speed = 0.0
-        if ssids is not None and self.wlan_interface is not None:
-            self.wifi_scanner = WifiScanThread(self.ssids, self.wlan_interface)
-        else:
-            self.wifi_scanner = None
-            logging.info('Wifi scanner disabled')
+        # filtered distance, speed and acceleration, updated by the TfminisThread for every frame
+        self.tracker = DistanceTracker()
         self.current_distance = 0.0
-        self.temperature_monitor = TemperatureMonitorThread()
+        self.last_reading_time = None
+        self.idle_timeout = idle_timeout
+        self.temperature_monitor = temperature_monitor if temperature_monitor is not None else \
+            TemperatureMonitorThread()
         self.auto_open_via_wifi = auto_open_via_wifi
         self.auto_close_via_wifi = auto_close_via_wifi
         self.auto_open_cool_down = auto_open_cool_down # seconds
-        self.db = shelve.open(db_file, writeback=True)
+        self.db = StateStore(db_file, flush_interval=db_flush_interval)
+        if history_dir is not None:
+            self.history = HistoryStore(history_dir, retention_days=history_retention_days)
+        else:
+            self.history = None
+        if record_dir is not None:
+            self.recorder = SessionRecorder(record_dir, settings=self.session_settings,
+                                            retention_days=history_retention_days)
+        else:
+            self.recorder = None
         if 'last_found' not in self.db:
             self.db['last_found'] = 0
             self.db['last_not_found'] = 0
@@ -122,31 +213,100 @@ class ControlThread(BaseThread, HomeAssistantControllable):
             self.db['last_exiting'] = 0
             self.db['last_entering'] = 0
             self.db['car_status'] = CarStatus.UNKNOWN
-            self.db.sync()
+            self.db.flush()
+        # JSON snapshot served at /api/state
+        self.state = GarageState(self)
+        if not staged_startup:
+            self.create_services()
+
+    def create_services(self) -> None:
+        """Creates the Wifi scanner, notifications and Home Assistant connection, importing what they need only
+        now.  Called by __init__ unless staged_startup is set, see start_services()."""
+        self._create_local_services()
+        self._create_home_assistant()
+
+    def start_services(self) -> None:
+        """Creates, hooks up and starts what staged_startup left out once the TFmini-S, LEDs and door contact are
+        running.  The Wifi scanner and notifications are started and local_services_started is set before MQTT is
+        connected, which can take a while.  Safe to call from any thread."""
+        self._create_local_services()
+        self._connect_wifi_listeners()
+        for thread in (self.wifi_scanner, self.notifications):
+            if thread is not None and thread not in self.shared:
+                thread.start()
+        self.local_services_started.set()
+        self._create_home_assistant()
+
+    def _create_local_services(self) -> None:
+        options = self.service_options
+        if options['wifi_scanner'] is not None:
+            self.wifi_scanner = options['wifi_scanner']
+        elif self.ssids is not None and self.wlan_interface is not None:
+            from wifi_scan_thread import WifiScanThread
+            self.wifi_scanner = WifiScanThread(self.ssids, self.wlan_interface,
+                                               slow_period=options['wifi_slow_scan_period'])
+        else:
+            logging.info('Wifi scanner disabled')
+        # delivers garage-opened and garage-closed off the door contact thread, undelivered ones are kept in the db
+        from notification_dispatcher import NotificationDispatcher
+        notifications = NotificationDispatcher(store=self.db)
+        if options['autoremote_key'] is not None:
+            from autoremote import Autoremote
+            self.autoremote = Autoremote(options['autoremote_key'])
+            notifications.add(self.autoremote)
+        with self.services_lock:
+            self.notifications = notifications
+            for message in self.early_notifications:
+                notifications.post(message)
+            self.early_notifications = []
+
+    def _create_home_assistant(self) -> None:
+        options = self.service_options['home_assistant']
+        if options['mqtt_server'] is not None or options['connection'] is not None:
+            from home_assistant import HomeAssistant
+            self.home_assistant = HomeAssistant(self, **options)
+
+    def post_notification(self, message: str) -> None:
+        """Posts message, such as garage-opened, to the notifications or keeps it until they are created."""
+        with self.services_lock:
+            if self.notifications is None:
+                self.early_notifications.append(message)
+                return
+        self.notifications.post(message)
 
-    def loop(self):
+    def step(self):
         reading = self.tfminis.read() if self.tfminis is not None else None
-        if reading is not None and reading['distance'] != 65535:
+        if reading is not None and reading['distance'] != 65535 and reading['time'] != self.last_reading_time:
+            self.last_reading_time = reading['time']
+            received = reading.get('received')
+            if received is not None:
+                self.control_latency.observe(time.monotonic() - received)
             self.current_distance = reading['distance']
-            new_readings = np.append(self.readings,
-                                     np.array([[time.time(), self.current_distance]]),
-                                     axis=0)
-            # We use copy=True to make sure original readings can be garbage collected
-            self.readings = np.array(truncate_time_series(
-                new_readings,
-                self.readings_size_in_seconds
-            ), copy=True)
-            self.speed = speed(self.readings)
-            #self.publish('car_speed', f'{self.speed}')
+            # the display decides parked, too close and moving on the filtered distance, so outliers don't flash it
+            estimate = self.tracker.current(received if received is not None else time.monotonic())
+            if estimate is not None:
+                self.speed = self.tracker.speed()
+                distance = estimate.distance
+            else:
+                # the tracker dropped the recent readings, e.g. a weak signal once the car left the beam
+                self.speed = -999.0
+                distance = self.current_distance
+            if self.history is not None:
+                self.history.append('distance', self.current_distance)
+                self.history.append('strength', reading['strength'])
+                if self.speed != -999.0:
+                    self.history.append('speed', self.speed)
+            if self.speed != -999.0:
+                self.publish_telemetry('car_speed', self.speed)
             #logging.info(f"distance={reading['distance']} cm, speed={self.speed}")
-            self.display.set_reading(self.current_distance, self.speed)
+            self.display.set_reading(distance, self.speed, received)
             self.inform_listeners(self.current_distance)
-            #self.publish('current_distance', str(reading['distance']))
+            self.publish_telemetry('current_distance', self.current_distance, received)
             if self.display.parked:
                 self._parked()
         # The following auto-open/close logic only works if both tfmini and wifi are enabled
         if self.wifi_scanner is not None and self.tfminis is not None:
-            if len(self.wifi_scanner.found()) > 0 and time.time() - self.db['last_not_found'] > 2.0: # secs
+            if len(self.wifi_scanner.found(self.ssids)) > 0 and time.time() - self.db['last_not_found'] > 2.0: # secs
                 # Car is in-range of Wifi for at least 2 seconds
                 self.db['last_found'] = time.time()
                 if self.display.parked:
@@ -154,41 +314,58 @@ class ControlThread(BaseThread, HomeAssistantControllable):
                 elif self.door_status.door_status == DoorStatus.OPEN:
                     if self.current_distance < self.max_distance:
                         if self.speed >= 2.0:
+                            self.db['last_exiting'] = time.time()
                             self.db['car_status'] = CarStatus.EXITING
                             self.publish_to_home_assistant()
                             #self.publish('car_status', self.db['car_status'].name)
-                            self.db['last_exiting'] = time.time()
                         elif self.speed <= -2.0:
+                            self.db['last_entering'] = time.time()
                             self.db['car_status'] = CarStatus.ENTERING
                             self.publish_to_home_assistant()
                             #self.publish('car_status', self.db['car_status'].name)
-                            self.db['last_entering'] = time.time()
                 elif self.door_status.door_status == DoorStatus.CLOSED:
                     # See the Wifi but the door is closed, maybe it just left or just arrived
                     if self.auto_open_via_wifi and time.time() - self.db['last_exiting'] > self.auto_open_cool_down:
                         self.open_garage('because Wifi is seen')
-                self.db.sync()
-            elif len(self.wifi_scanner.found()) == 0 and time.time() - self.db['last_found'] > 10.0 and \
+            elif len(self.wifi_scanner.found(self.ssids)) == 0 and time.time() - self.db['last_found'] > 10.0 and \
                     not self.display.parked:
                 # Car is out-of-range of Wifi for at least 10 seconds
-                self.db['car_status'] = CarStatus.AWAY
                 self.db['last_not_found'] = time.time()
-                self.db.sync()
+                self.db['car_status'] = CarStatus.AWAY
                 self.publish_to_home_assistant()
                 if self.auto_close_via_wifi and not self.display.parked and self.door_status == DoorStatus.OPEN:
                     self.close_garage('because Wifi not seen and car is not parked')
-        time.sleep(0.1)
+        if self.wifi_scanner is not None:
+            # nothing to look for while the car is parked behind a closed door, scan fast again once either changes
+            self.wifi_scanner.set_fast(self.db['car_status'] != CarStatus.PARKED or
+                                       self.door_status.door_status != DoorStatus.CLOSED, self)
+        self.db.flush_if_due()
+        if self.history is not None:
+            self.history.flush_if_due()
+        if self.recorder is not None:
+            self.recorder.flush_if_due()
+        self.state.refresh()
+        # wait for a new reading, door or Wifi change, loop() keeps this from running more often than min_period
+        return self.idle_timeout
 
     def _parked(self):
-        self.db['car_status'] = CarStatus.PARKED
+        # last_parked is written with the next flush, car_status is written when it changes
         self.db['last_parked'] = time.time()
-        self.db.sync()
+        self.db['car_status'] = CarStatus.PARKED
         self.publish_to_home_assistant()
 
     def publish_to_home_assistant(self):
         if self.home_assistant is not None:
             self.home_assistant.publish(self.door_status.door_status, self.db['car_status'], self.display.park_distance)
 
+    def track(self, reading: dict):
+        """Feeds every TFmini-S reading to the tracker, runs on the TfminisThread or TfminiReaderThread."""
+        self.tracker.update(reading['distance'], reading['strength'], reading.get('received', time.monotonic()))
+
+    def publish_telemetry(self, key: str, value, received: float = None):
+        if self.home_assistant is not None:
+            self.home_assistant.publish_telemetry(key, value, received)
+
     def set_park_distance(self, distance: float):
         if self.max_distance is None:
             logging.info(f'park_distance set to {distance}, ignoring because TFmini-S is disabled')
@@ -201,113 +378,149 @@ class ControlThread(BaseThread, HomeAssistantControllable):
             logging.warning(f'attempt to set distance to a value greater than {self.max_distance}')
         logging.info(f'park_distance set to {distance}, max is {self.max_distance}')
         self.display.park_distance = distance
+        self.state.refresh()
         self.publish_to_home_assistant()
 
-    def set_readings_size_in_seconds(self, size):
-        logging.info(f'readings_size_in_seconds set to {size}')
-        if size < 0:
-            size = 0
-            logging.warning(f'attempt to set readings_size_in_seconds to a value less than 0')
-        elif size > 60:
-            size = 60
-            logging.warning(f'attempt to set readings_size_in_seconds to a value greater than 60')
-        self.readings_size_in_seconds = size
+    def close_garage(self, reason='') -> Future:
+        """Queues closing the door, the returned future resolves to True once the button was pressed or False if the
+        door was not open."""
+        return self.control.submit(DoorCommand.CLOSE, reason)
 
-    def close_garage(self, reason=''):
-        if self.door_status.door_status == DoorStatus.OPEN:
-            logging.info(f'closing garage {reason}')
-            self.control.press()
-            self.door_status.close_started()
+    def open_garage(self, reason='') -> Future:
+        """Queues opening the door, the returned future resolves to True once the button was pressed or False if the
+        door was not closed."""
+        return self.control.submit(DoorCommand.OPEN, reason)
 
-    def open_garage(self, reason=''):
-        if self.door_status.door_status == DoorStatus.CLOSED:
-            logging.info(f'opening garage {reason}')
-            self.control.press()
+    def open_or_close(self, reason: str='') -> Future:
+        """Queues pressing the button if the door is open or closed, not while it is moving."""
+        return self.control.submit(DoorCommand.TOGGLE, reason)
+
+    def _resolve_command(self, command: DoorCommand):
+        """Called by DoorControl right before pressing the button for command."""
+        status = self.door_status.door_status
+        if status == DoorStatus.CLOSED and command in (DoorCommand.OPEN, DoorCommand.TOGGLE):
+            return DoorCommand.OPEN
+        if status == DoorStatus.OPEN and command in (DoorCommand.CLOSE, DoorCommand.TOGGLE):
+            return DoorCommand.CLOSE
+        return None
+
+    def session_settings(self) -> dict:
+        """Returns the settings and persistent variables a SessionReplayer sets up this stall with, recorded at the
+        start of every session segment."""
+        found = self.wifi_scanner.found(self.ssids) if self.wifi_scanner is not None else []
+        return {
+            'park_distance': self.display.park_distance,
+            'max_distance': self.max_distance,
+            'ssids': self.ssids,
+            'num_pixels': self.display.num_pixels,
+            'auto_open_via_wifi': self.auto_open_via_wifi,
+            'auto_close_via_wifi': self.auto_close_via_wifi,
+            'auto_open_cool_down': self.auto_open_cool_down,
+            'door_movement_delay': self.door_status.door_movement_delay,
+            'door_debounce': self.door_status.debounce,
+            'period': self.min_period,
+            'idle_timeout': self.idle_timeout,
+            'door_contact': self.door_status.button.is_pressed,
+            'wifi': [cell.ssid for cell in found],
+            'db': {key: self.db[key].name if key == 'car_status' else self.db[key]
+                   for key in ('last_found', 'last_not_found', 'last_parked', 'last_exiting', 'last_entering',
+                               'car_status')}
+        }
+
+    def _door_pressed(self, command: DoorCommand):
+        if command == DoorCommand.OPEN:
             self.door_status.open_started()
+        else:
+            self.door_status.close_started()
 
-    def open_or_close(self, reason: str=''):
-        if self.door_status.door_status == DoorStatus.OPEN:
-            self.close_garage(reason)
-        elif self.door_status.door_status == DoorStatus.CLOSED:
-            self.open_garage(reason)
+    def threads(self) -> list:
+        """Returns the sensor and display threads this stall depends on in the order they are started, without the
+        ones shared with other stalls and, with staged_startup, without the Wifi scanner and notifications."""
+        threads = []
+        if self.wifi_scanner is not None and not self.staged_startup:
+            threads.append(self.wifi_scanner)
+        if self.tfminis is not None and self.tfmini_reader is None:
+            threads.append(self.tfminis)
+        threads.append(self.display)
+        threads.append(self.temperature_monitor)
+        threads.append(self.door_status)
+        threads.append(self.control)
+        if self.notifications is not None and not self.staged_startup:
+            threads.append(self.notifications)
+        return [thread for thread in threads if thread not in self.shared]
 
-    def run(self):
-        if self.wifi_scanner is not None:
-            #self.wifi_scanner.listeners.append(lambda status: self.publish('wifi_found',
-            #                                                               len(self.wifi_scanner.found())>0))
-            self.wifi_scanner.start()
+    def runnables(self) -> list:
+        """Returns everything AsyncRuntime runs as a task for this stall."""
+        runnables = self.threads() + [self]
+        if self.home_assistant is not None:
+            runnables.append(self.home_assistant)
+        return runnables
+
+    def connect_listeners(self):
+        """Wakes up this stall when its sensors report something and publishes door changes."""
+        if not self.staged_startup:
+            self._connect_wifi_listeners()  # start_services() does once the scanner exists
         if self.tfminis is not None:
-            self.tfminis.start()
-        self.display.start()
-        #self.temperature_monitor.listeners.append(lambda status: self.publish('cpu_temp', f'{status}'))
-        self.temperature_monitor.start()
+            self.tfminis.listeners.append(self.track)
+            self.tfminis.listeners.append(self.notify)
+        self.temperature_monitor.listeners.append(lambda temperature: self.publish_telemetry('cpu_temp', temperature))
+        if self.history is not None:
+            self.temperature_monitor.listeners.append(lambda temperature: self.history.append('cpu_temp', temperature))
+            self.door_status.listeners.append(lambda status: self.history.append('door', status.value))
+
+        # garage-opened-left and so on when several stalls notify the same phone
+        suffix = f'-{self.stall_name}' if self.stall_name is not None else ''
 
         def door_status_publications(status: DoorStatus):
             self.publish_to_home_assistant()
-            if self.autoremote:
-                if status == DoorStatus.OPEN:
-                    self.autoremote.send_opened()
-                elif status == DoorStatus.CLOSED:
-                    self.autoremote.send_closed()
+            if status == DoorStatus.OPEN:
+                self.post_notification(f'garage-opened{suffix}')
+            elif status == DoorStatus.CLOSED:
+                self.post_notification(f'garage-closed{suffix}')
 
         self.door_status.listeners.append(door_status_publications)
-        self.door_status.start()
+        self.door_status.listeners.append(self.notify)
+        self.control.listeners.append(self._door_pressed)
+        if self.recorder is not None:
+            if self.tfminis is not None:
+                self.tfminis.data_listeners.append(self.recorder.tfmini)
+            self.door_status.edge_listeners.append(self.recorder.door)
+            self.control.listeners.append(self.recorder.relay)
+
+    def _connect_wifi_listeners(self):
+        if self.wifi_scanner is not None:
+            self.wifi_scanner.listeners.append(self.notify)
+            self.wifi_scanner.listeners.append(
+                lambda cells: self.publish_telemetry('wifi_found', len(self.wifi_scanner.found(self.ssids)) > 0))
+            if self.recorder is not None:
+                self.wifi_scanner.listeners.append(
+                    lambda cells: self.recorder.wifi(self.wifi_scanner.found(self.ssids)))
+
+    def run(self):
+        self.connect_listeners()
+        for thread in self.threads():
+            thread.start()
         super().run()
 
     def shutdown(self):
         super().shutdown()
-        self.db.close()
+        # releasing the relay reports the door moving, which posts a notification and writes to the db and history
+        self.control.shutdown()
         self.door_status.shutdown()
-        self.temperature_monitor.shutdown()
+        if self.notifications is not None:
+            self.notifications.shutdown()
+        self.db.close()
+        if self.history is not None:
+            self.history.close()
+        if self.temperature_monitor not in self.shared:
+            self.temperature_monitor.shutdown()
         self.display.shutdown()
         if self.home_assistant is not None:
             self.home_assistant.shutdown()
-        if self.tfminis is not None:
+        if self.tfminis is not None and self.tfmini_reader is None:
             self.tfminis.shutdown()
-        if self.wifi_scanner is not None:
+        if self.wifi_scanner is not None and self.wifi_scanner not in self.shared:
             self.wifi_scanner.shutdown()
-
-
-def truncate_time_series(arr: np.ndarray, seconds: float) -> np.ndarray:
-    # Start time for data slice
-    start_time = time.time() - seconds
-    # Select rows where timestamp is greater than or equal to start time
-    truncated = arr[arr[:, 0] >= start_time]
-    return truncated
-
-
-def speed(arr: np.ndarray, period: float = 2.0) -> float:
-    """Compute and return average speed in centimeters per second over the last period seconds.
-
-    Parameters
-    ----------
-    arr - np.ndarray (float) - array of times and positions from TFmini-S
-    period - float - how many seconds of data to use in computing average speed
-
-    Returns
-    -------
-    speed in cm/s or -999 if not enough data
-    """
-    truncated = truncate_time_series(arr, period)
-    if truncated.shape[0] < 2:
-        return -999.0
-    positions = truncated[:, 1]
-    times = truncated[:, 0]
-    v, _ = np.polyfit(times, positions, 1)
-    #logging.info(f'n={n} delta_p={positions[n-1]-positions[0]} delta_t={times[n-1]-times[0]}')
-    return v
-
-
-def acceleration(arr: np.ndarray) -> float:
-    if arr.shape[0] < 2:
-        return 0.0
-    positions = arr[:, 1]
-    times = arr[:, 0]
-    delta_positions = np.diff(positions)
-    delta_times = np.diff(times)
-    delta_times = np.where(delta_times == 0, np.inf, delta_times)
-    velocities = delta_positions / delta_times
-    times = times[1:]
-    a, _ = np.polyfit(times, velocities, 1)
-    return a
+        if self.recorder is not None:
+            self.recorder.close()
 
@@ -0,0 +1,78 @@
+import base64
+import hashlib
+import hmac
+import secrets
+
+from fastapi.security.utils import get_authorization_scheme_param
+
+
+class CredentialIndex:
+    """Checks web site credentials against passwords.json without keeping the passwords around.
+
+    The index is built once at startup: every "username:password" pair is base64 encoded the way HTTP Basic
+    authentication sends it and hashed with HMAC-SHA256 under a key made at startup.  Checking an Authorization header
+    or a login is one hash and one dict lookup whatever the number of users.  The lookup compares keyed hashes, not
+    passwords, so how long it takes tells an attacker nothing about how close a guess was, the same guarantee the
+    secrets.compare_digest() loop over every user gave.
+
+    Requests for static files, NiceGUI's own assets and its websocket never lead to a page, so is_static() lets the
+    middleware skip them.
+    """
+    # NiceGUI's libraries, components and socket.io, and the images Garage-Pi serves at /static
+    STATIC_PREFIXES = ('/_nicegui/', '/_nicegui_ws/', '/static/', '/favicon.ico')
+
+    def __init__(self, passwords: dict):
+        """
+        Parameters
+        ----------
+        passwords - dict - password of each username, as loaded from passwords.json
+        """
+        self.key = secrets.token_bytes(32)
+        self.index = {}  # hash of the Basic token -> username
+        for username, password in passwords.items():
+            self.index[self._hash(self._token(username, password))] = username
+        self.checks = 0
+        self.failures = 0
+
+    @staticmethod
+    def _token(username: str, password: str) -> bytes:
+        return base64.standard_b64encode(f'{username}:{password}'.encode())
+
+    def _hash(self, token: bytes) -> bytes:
+        return hmac.new(self.key, token, hashlib.sha256).digest()
+
+    def _lookup(self, token: bytes):
+        self.checks += 1
+        username = self.index.get(self._hash(token))
+        if username is None:
+            self.failures += 1
+        return username
+
+    def authorize(self, authorization: str):
+        """Returns the username of an Authorization header with valid Basic credentials, None otherwise."""
+        if not authorization:
+            return None
+        _, credentials = get_authorization_scheme_param(authorization)
+        return self._lookup(credentials.encode())
+
+    def verify(self, username: str, password: str) -> bool:
+        """Returns True if password is the password of username."""
+        if not username or password is None:
+            return False
+        return self._lookup(self._token(username, password)) == username
+
+    @classmethod
+    def is_static(cls, path: str) -> bool:
+        return path.startswith(cls.STATIC_PREFIXES)
+
+    @staticmethod
+    def remember(storage, username: str) -> bool:
+        """Marks the session in storage (app.storage.user) as logged in as username, returns True if it had to be
+        written.  NiceGUI saves the storage every time it is written, so it is only written when it changes."""
+        if storage.get('username') == username and storage.get('authenticated', False):
+            return False
+        storage.update({'username': username, 'authenticated': True})
+        return True
+
+    def stats(self) -> dict:
+        return {'users': len(self.index), 'checks': self.checks, 'failures': self.failures}
@@ -0,0 +1,236 @@
+import math
+from collections import namedtuple
+
+
+class RegressionSums:
+    """Running sums needed for a least-squares line fit of y against t."""
+    __slots__ = ('n', 'st', 'sy', 'stt', 'sty')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.n = 0
+        self.st = 0.0
+        self.sy = 0.0
+        self.stt = 0.0
+        self.sty = 0.0
+
+    def add(self, t: float, y: float):
+        self.n += 1
+        self.st += t
+        self.sy += y
+        self.stt += t * t
+        self.sty += t * y
+
+    def remove(self, t: float, y: float):
+        self.n -= 1
+        self.st -= t
+        self.sy -= y
+        self.stt -= t * t
+        self.sty -= t * y
+
+    def slope(self, default: float) -> float:
+        if self.n < 2:
+            return default
+        denominator = self.stt - self.st * self.st / self.n
+        if denominator <= 1e-12:
+            return default
+        return (self.sty - self.st * self.sy / self.n) / denominator
+
+
+# distance, speed and acceleration of the car in cm, cm/s and cm/s^2 with their standard deviations, at time
+Estimate = namedtuple('Estimate', ['time', 'distance', 'speed', 'acceleration',
+                                   'distance_std', 'speed_std', 'acceleration_std'])
+
+
+class DistanceTracker:
+    """Constant-acceleration Kalman filter for the distance readings of the TFmini-S.
+
+    Each reading costs one predict and one update of a 3 state filter written out in scalars, O(1) per frame.
+    Readings are dropped before they reach the filter when the signal strength is too low or saturated (the TFmini-S
+    datasheet calls those distances unreliable) and when the reading is more than gate standard deviations away from
+    where the filter expected the car to be.  A car driving into or out of the beam makes the distance jump, so after
+    max_rejections readings in a row were dropped the filter starts over at the new distance.  After max_dropped weak
+    or out of range readings in a row, the car left the beam or the signal is lost, the car is forgotten, and
+    current() ignores an estimate older than max_age seconds, so a lost car does not stay at its last distance.
+
+    A car braking to a stop would make a plain constant-acceleration filter overshoot into a few hundred milliseconds
+    of backing up, so two things are added:
+      * when the innovations keep the same sign the car is maneuvering and the process noise is raised until the
+        filter has caught up
+      * readings since the car last moved more than 3 measurement_std are fitted with a line, once that line is
+        STILL_SECONDS long and flatter than STILL_SPEED the speed and acceleration are set to zero (a zero velocity
+        update), so "stopped" is reported about half a second after the car stops instead of one to two seconds
+
+    update() is called from the TfminisThread for every frame.  estimate is replaced with a new tuple on every update so
+    other threads always see a consistent estimate without taking a lock.
+    """
+    STILL_SECONDS = 0.3
+    STILL_SPEED = 1.0  # cm/s
+    # innovations are averaged over about 10 readings, when the average is more than this many standard deviations
+    # away from zero the process noise is multiplied by MANEUVER_FACTOR
+    MANEUVER_BIAS = 1.0
+    MANEUVER_FACTOR = 100.0
+
+    def __init__(self, measurement_std: float = 1.0, jerk_std: float = 5.0, gate: float = 4.0,
+                 min_strength: int = 100, max_rejections: int = 5, frame_interval: float = 0.01,
+                 max_dropped: int = 10, max_age: float = 0.5):
+        """
+        Parameters
+        ----------
+        measurement_std - float - standard deviation of the TFmini-S distance noise in cm, defaults to 1 cm
+        jerk_std - float - how quickly the car's acceleration changes in cm/s^3 while it is not maneuvering, larger
+                           follows faster but is noisier, defaults to 5 cm/s^3
+        gate - float - readings further than this many standard deviations from the prediction are outliers,
+                       defaults to 4
+        min_strength - int - readings with a lower signal strength are dropped, defaults to 100
+        max_rejections - int - outliers in a row after which the filter starts over at the new distance, defaults to 5
+        frame_interval - float - seconds between TFmini-S frames, used for frames read together with the same
+                                 timestamp, defaults to 0.01
+        max_dropped - int - weak or out of range readings in a row after which the car is forgotten, defaults to 10
+        max_age - float - seconds after its last reading that current() no longer returns the estimate, defaults to
+                          0.5 seconds
+        """
+        self.measurement_variance = measurement_std * measurement_std
+        self.jerk_variance = jerk_std * jerk_std
+        self.gate_squared = gate * gate
+        self.min_strength = min_strength
+        self.max_rejections = max_rejections
+        self.frame_interval = frame_interval
+        self.max_dropped = max_dropped
+        self.max_age = max_age
+        self.still_band = 3 * measurement_std
+        self.estimate = None
+        self.updates = 0
+        self.rejected_strength = 0
+        self.rejected_outliers = 0
+        self.resets = 0
+        self.maneuvers = 0
+        self.cleared = 0
+        self._dropped = 0  # weak or out of range readings in a row
+        self._time = None
+        self._still = RegressionSums()
+
+    def _reset(self, distance: float, timestamp: float) -> None:
+        self._time = timestamp
+        self._p, self._v, self._a = float(distance), 0.0, 0.0
+        # a car can be anywhere from standing still to driving in at walking pace when it is first seen
+        self._p00, self._p01, self._p02 = self.measurement_variance, 0.0, 0.0
+        self._p11, self._p12 = 100.0 * 100.0, 0.0
+        self._p22 = 100.0 * 100.0
+        self._rejections = 0
+        self._bias = 0.0
+        self._still_since = timestamp
+        self._still.clear()
+        self._still.add(0.0, distance)
+        self.resets += 1
+        self._publish()
+
+    def update(self, distance: float, strength: int, timestamp: float) -> bool:
+        """Adds a reading taken at timestamp seconds (time.monotonic()), returns False if it was dropped."""
+        if distance >= 65535 or strength < self.min_strength or strength >= 65535:
+            self.rejected_strength += 1
+            self._dropped += 1
+            if self._dropped >= self.max_dropped and self._time is not None:
+                self.clear()
+                self.cleared += 1
+            return False
+        self._dropped = 0
+        if self._time is None:
+            self._reset(distance, timestamp)
+            return True
+        # frames that arrived in the same read share a timestamp but were sent frame_interval apart
+        timestamp = max(timestamp, self._time + self.frame_interval)
+        dt = timestamp - self._time
+        dt2 = dt * dt
+        dt3 = dt2 * dt
+        h = dt2 / 2
+        p00, p01, p02, p11, p12, p22 = self._p00, self._p01, self._p02, self._p11, self._p12, self._p22
+
+        # predict: x = F x, P = F P F' + Q for F = [[1, dt, dt^2/2], [0, 1, dt], [0, 0, 1]] and white noise jerk
+        p = self._p + dt * self._v + h * self._a
+        v = self._v + dt * self._a
+        a = self._a
+        r00 = p00 + dt * p01 + h * p02
+        r01 = p01 + dt * p11 + h * p12
+        r02 = p02 + dt * p12 + h * p22
+        r11 = p11 + dt * p12
+        r12 = p12 + dt * p22
+        q = self.jerk_variance
+        if abs(self._bias) > self.MANEUVER_BIAS:
+            q *= self.MANEUVER_FACTOR
+            self.maneuvers += 1
+        n00 = r00 + dt * r01 + h * r02 + q * dt3 * dt2 / 20
+        n01 = r01 + dt * r02 + q * dt2 * dt2 / 8
+        n02 = r02 + q * dt3 / 6
+        n11 = r11 + dt * r12 + q * dt3 / 3
+        n12 = r12 + q * dt2 / 2
+        n22 = p22 + q * dt
+
+        # update with the distance, H = [1, 0, 0]
+        innovation = distance - p
+        s = n00 + self.measurement_variance
+        if innovation * innovation > self.gate_squared * s:
+            self.rejected_outliers += 1
+            self._rejections += 1
+            if self._rejections >= self.max_rejections:
+                self._reset(distance, timestamp)
+            return False
+        self._bias += 0.1 * (innovation / math.sqrt(s) - self._bias)
+        k0, k1, k2 = n00 / s, n01 / s, n02 / s
+        self._p = p + k0 * innovation
+        self._v = v + k1 * innovation
+        self._a = a + k2 * innovation
+        self._p00 = n00 - k0 * n00
+        self._p01 = n01 - k0 * n01
+        self._p02 = n02 - k0 * n02
+        self._p11 = n11 - k1 * n01
+        self._p12 = n12 - k1 * n02
+        self._p22 = n22 - k2 * n02
+        self._time = timestamp
+        self._rejections = 0
+        self.updates += 1
+
+        still = self._still
+        if abs(distance - still.sy / still.n) > self.still_band:
+            # moved, look for the car standing still from here on
+            self._still_since = timestamp
+            still.clear()
+        still.add(timestamp - self._still_since, distance)
+        if timestamp - self._still_since >= self.STILL_SECONDS and abs(still.slope(0.0)) < self.STILL_SPEED:
+            self._v = self._a = 0.0
+            self._p01 = self._p02 = self._p12 = 0.0
+            self._p11 = min(self._p11, self.STILL_SPEED * self.STILL_SPEED)
+            self._p22 = min(self._p22, self.STILL_SPEED * self.STILL_SPEED)
+        self._publish()
+        return True
+
+    def _publish(self) -> None:
+        self.estimate = Estimate(self._time, self._p, self._v, self._a,
+                                 math.sqrt(self._p00), math.sqrt(self._p11), math.sqrt(self._p22))
+
+    def current(self, now: float):
+        """Returns the estimate, or None if there is none or its last reading is more than max_age seconds before now
+        (time.monotonic())."""
+        estimate = self.estimate
+        if estimate is None or now - estimate.time > self.max_age:
+            return None
+        return estimate
+
+    def speed(self, max_std: float = 5.0) -> float:
+        """Returns the speed in cm/s, positive when the car moves away from the sensor, or -999 while the speed is not
+        known to within max_std cm/s."""
+        estimate = self.estimate
+        if estimate is None or estimate.speed_std > max_std:
+            return -999.0
+        return estimate.speed
+
+    def clear(self) -> None:
+        """Forgets the car, the next reading starts the filter over."""
+        self._time = None
+        self.estimate = None
+
+    def stats(self) -> dict:
+        return {'updates': self.updates, 'rejected_strength': self.rejected_strength,
+                'rejected_outliers': self.rejected_outliers, 'resets': self.resets, 'maneuvers': self.maneuvers, 'cleared': self.cleared}
@@ -1,28 +1,153 @@
+from collections import deque
+from concurrent.futures import Future
+from enum import Enum
 from gpiozero import OutputDevice
+import threading
 import time
 import logging
 
-class DoorControl:
-    """Simple class that encapsulates the pressing of the garage door control button.  Uses
-    the gpiozero library to control a 5V rely on a GPIO pin of the raspberry pi (defaults to 17)."""
-    
-    def __init__(self, gpio_pin = 17):
+from base_thread import BaseThread
+from metrics import REGISTRY
+
+
+class DoorCommand(Enum):
+    OPEN = 1
+    CLOSE = 2
+    TOGGLE = 3
+
+
+class _Request:
+    __slots__ = ('command', 'reason', 'future', 'submitted')
+
+    def __init__(self, command: DoorCommand, reason: str):
+        self.command = command
+        self.reason = reason
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+class DoorControl(BaseThread):
+    """Presses the garage door control button with a 5V relay on a GPIO pin of the raspberry pi (defaults to 17)
+    using the gpiozero library.
+
+    Open, close and toggle commands from the web pages, Home Assistant and the control loop are queued with submit(),
+    which returns right away with a concurrent.futures.Future (use asyncio.wrap_future() to await it) that resolves
+    to True once the relay has been released or False if the command did not need a press.  The relay pulse is timed
+    by step() on this thread, or on the event loop with run_async(), so nobody waits for it.
+
+    The button is pressed at most once every lockout seconds.  A command that is already waiting, being pressed or
+    was pressed less than lockout seconds ago is merged into that one and shares its future.  A different command is
+    kept until the lockout ends, then resolve(command) decides with the door status at that time which press, if any,
+    it needs.  Listeners are called with the command that was pressed once the relay is released.
+    """
+    def __init__(self, gpio_pin = 17, pulse: float = 0.1, lockout: float = 1.0, resolve=None):
+        """
+        Parameters
+        ----------
+        gpio_pin - int - GPIOzero pin number of the relay, defaults to 17
+        pulse - float - seconds the relay is held, defaults to 0.1 seconds
+        lockout - float - minimum seconds between the starts of two presses, defaults to 1 second
+        resolve - function - called with a DoorCommand right before it is pressed, returns DoorCommand.OPEN or
+                             DoorCommand.CLOSE for the press it stands for or None to skip it, None presses every command
+        """
+        super(DoorControl, self).__init__()
         self.gpio_pin = gpio_pin
         self.output = OutputDevice(gpio_pin)
-        self.listeners = list()
-        self.last_pressed = 0
-        
-    def press(self):
-        if time.time() - self.last_pressed > 1.0:
-            logging.warning('triggering open/close button')
-            self.last_pressed = time.time()
+        self.pulse = pulse
+        self.lockout = lockout
+        self.resolve = resolve if resolve is not None else lambda command: command
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.pressing = None  # request whose pulse is running
+        self.release_time = None
+        self.pressed_command = None  # DoorCommand.OPEN or CLOSE the running pulse stands for
+        self.last_request = None  # request pressed last
+        self.last_pressed = -lockout
+        self.presses = 0
+        self.merged = 0
+        self.skipped = 0
+        self.command_latency = REGISTRY.histogram('garage_door_command_seconds',
+                                                  'Seconds from a door command to the release of the relay')
+        REGISTRY.gauge('garage_door_commands_waiting', 'Door commands waiting for the relay lockout',
+                       lambda: len(self.queue))
+        for name in ('presses', 'merged', 'skipped'):
+            REGISTRY.counter('garage_door_commands_total', 'Door commands by what happened to them',
+                             lambda name=name: getattr(self, name), outcome=name)
+
+    def submit(self, command: DoorCommand, reason: str = '') -> Future:
+        """Queues command, returns a future that resolves to True when the button was pressed for it."""
+        with self.lock:
+            merge_with = [request for request in self.queue if request.command == command]
+            if self.pressing is not None and self.pressing.command == command:
+                merge_with.append(self.pressing)
+            if (self.last_request is not None and self.last_request.command == command and
+                    time.monotonic() - self.last_pressed < self.lockout):
+                merge_with.append(self.last_request)
+            if merge_with:
+                self.merged += 1
+                logging.info(f'{command.name.lower()} {reason} merged with the {command.name.lower()} '
+                             f'{merge_with[0].reason}')
+                return merge_with[0].future
+            request = _Request(command, reason)
+            self.queue.append(request)
+        self.notify()
+        return request.future
+
+    def press(self, reason: str = '') -> Future:
+        """Presses the button whatever the door is doing."""
+        return self.submit(DoorCommand.TOGGLE, reason)
+
+    def step(self):
+        now = time.monotonic()
+        if self.pressing is not None:
+            if now < self.release_time:
+                return self.release_time - now
+            self._release(now)
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return None
+                wait = self.last_pressed + self.lockout - now
+                if wait > 0:
+                    return wait
+                request = self.queue.popleft()
+            pressed = self.resolve(request.command)
+            if pressed is None:
+                self.skipped += 1
+                logging.info(f'not pressing the button to {request.command.name.lower()} {request.reason}')
+                request.future.set_result(False)
+                continue
+            logging.warning(f'triggering open/close button to {pressed.name.lower()} {request.reason}')
             self.output.on()
-            time.sleep(0.1)
-            self.output.off()
-            for listener in self.listeners:
-                listener(self)
-        else:
-            logging.warning('attempt to press control button too often is ignored')
+            with self.lock:
+                self.pressing = request
+                self.last_request = request
+                self.last_pressed = now
+            self.release_time = now + self.pulse
+            self.pressed_command = pressed
+            return self.pulse
+
+    def _release(self, now: float):
+        self.output.off()
+        request = self.pressing
+        with self.lock:
+            self.pressing = None
+        self.presses += 1
+        self.command_latency.observe(now - request.submitted)
+        for listener in self.listeners:
+            listener(self.pressed_command)
+        request.future.set_result(True)
+
+    def shutdown(self):
+        super().shutdown()
+        if self.pressing is not None:
+            self._release(time.monotonic())
+        with self.lock:
+            waiting = list(self.queue)
+            self.queue.clear()
+        for request in waiting:
+            request.future.set_result(False)
+        self.output.close()
 
     def close(self):
-        self.output.close()
\ No newline at end of file
+        self.shutdown()
@@ -1,7 +1,9 @@
 from enum import Enum
 from gpiozero import Button
+import threading
 import time
 from base_thread import BaseThread
+from metrics import REGISTRY
 import logging
 
 
@@ -30,9 +32,16 @@ class DoorStatus(Enum):
 
 class DoorStatusThread(BaseThread):
     """Uses the gpiozero library to check the status of a pulled up GPIO pin (2 by default).  Reports
-    the status as the garage door open/close status to listeners.
+    the status as the garage door open/close status to listeners.  The thread sleeps until the pin changes
+    or the door has been moving for longer than it should.
+
+    Every edge of the pin is timestamped by the gpiozero callback and starts a debounce period, the pin is read once
+    the contact has not changed for debounce seconds and the door status changes as of the first edge.  Contact bounce
+    that ends where it started is counted in bounces and not reported.  edge_listeners are called with every edge,
+    True if the contact is pressed (door closed) after it, e.g. to record them with a SessionRecorder.
     """
-    def __init__(self, gpio_pin = 2, door_movement_delay : int = 10.0, opening_delay : int = 1.5):
+    def __init__(self, gpio_pin = 2, door_movement_delay : int = 10.0, opening_delay : int = 1.5,
+                 poll_interval: float = 10.0, debounce: float = 0.005):
         """Initialize DoorStatusThread object.
 
         Parameters
@@ -40,11 +49,30 @@ class DoorStatusThread(BaseThread):
         door_movement_delay (int) - delay in seconds from control press until door is fully opened or closed, defaults to
            10 seconds
         opening_delay (int) - delay in seconds from control press until door starts to open, defaults to 1.5 seconds
+        poll_interval (float) - seconds between checks of the pin when no change is reported, defaults to 10 seconds
+        debounce (float) - seconds the contact has to stay put after an edge before it is read, defaults to 5 ms
         """
         super(DoorStatusThread, self).__init__()
         self.gpio_pin = gpio_pin
+        self.debounce = debounce
         self.button = Button(gpio_pin)
+        self.button.when_pressed = lambda: self._edge(True)
+        self.button.when_released = lambda: self._edge(False)
+        self.edge_listeners = list()
+        self.edge_lock = threading.Lock()
+        self.first_edge = None  # (time.time(), time.monotonic()) of the first edge since the pin was last read
+        self.settle_time = None  # time.monotonic() when the pin can be read
+        self.edges = 0
+        self.bounces = 0
+        self.last_detection_latency = None
+        self.detection_latency = REGISTRY.histogram('garage_door_detection_seconds',
+                                                    'Seconds from an edge of the door contact to the new door status')
+        REGISTRY.counter('garage_door_edges_total', 'Edges seen on the door contact pin', lambda: self.edges)
+        REGISTRY.counter('garage_door_bounces_total', 'Door contact edges that bounced back before debounce ended',
+                         lambda: self.bounces)
+        self.was_pressed = self.button.is_pressed
         self.door_status = DoorStatus.UNKNOWN
+        self.changed_time = time.time()
         self.open_started_time = time.time()
         self.close_started_time = time.time()
         self.close_failed = False
@@ -53,72 +81,122 @@ class DoorStatusThread(BaseThread):
         self.opening_delay = opening_delay
         self.last_close_failed = 0
         self.last_open_failed = 0
-        
-    def loop(self):
+        self.poll_interval = poll_interval
+
+    def _edge(self, pressed: bool):
+        """Called by gpiozero on its own thread for every edge of the pin, pressed is the contact after it."""
+        with self.edge_lock:
+            if self.first_edge is None:
+                self.first_edge = (time.time(), time.monotonic())
+            self.settle_time = time.monotonic() + self.debounce
+            self.edges += 1
+        for listener in self.edge_listeners:
+            listener(pressed)
+        self.notify()
+
+    def step(self) -> float:
+        with self.edge_lock:
+            if self.settle_time is not None:
+                remaining = self.settle_time - time.monotonic()
+                if remaining > 0:
+                    # the contact is still bouncing
+                    return remaining
+            edge = self.first_edge
+            self.first_edge = None
+            self.settle_time = None
+        # transitions caused by the pin happened at the edge, timeouts happen now
+        now = edge[0] if edge is not None else time.time()
         open_status = self.is_open()
+        previous = self.door_status
         #logging.info(f'open_status is {open_status}, door_status is {self.door_status}')
         if open_status:
             # door is OPEN
             if self.door_status == DoorStatus.CLOSED:
-                self.door_status = DoorStatus.OPENING
-                self.open_started_time = time.time()
-                self.inform_listeners(self.door_status)
+                self.open_started_time = now
+                self._change(DoorStatus.OPENING, now)
             elif (self.door_status == DoorStatus.OPENING and
-                  time.time() - self.open_started_time > self.door_movement_delay):
-                self.door_status = DoorStatus.OPEN
+                  now - self.open_started_time > self.door_movement_delay):
                 self.open_failed = False
-                self.inform_listeners(self.door_status)
+                self._change(DoorStatus.OPEN, now)
             elif (self.door_status == DoorStatus.CLOSING and
-                  time.time() - self.close_started_time > self.door_movement_delay):
-                self.door_status = DoorStatus.OPEN
+                  now - self.close_started_time > self.door_movement_delay):
                 self.close_failed = True
-                self.last_close_failed = time.time()
-                self.inform_listeners(self.door_status)
+                self.last_close_failed = now
+                self._change(DoorStatus.OPEN, now)
             elif self.door_status == DoorStatus.UNKNOWN:
-                self.door_status = DoorStatus.OPEN
-                self.inform_listeners(self.door_status)
+                self._change(DoorStatus.OPEN, now)
         else:
             # door is CLOSED
             if (self.door_status == DoorStatus.OPENING and
-                  time.time() - self.open_started_time > self.door_movement_delay):
-                self.door_status = DoorStatus.CLOSED
+                  now - self.open_started_time > self.door_movement_delay):
                 self.open_failed = True
-                self.last_open_failed = time.time()
-                self.inform_listeners(self.door_status)
+                self.last_open_failed = now
+                self._change(DoorStatus.CLOSED, now)
             elif (self.door_status == DoorStatus.OPENING and
-                    time.time() - self.open_started_time < self.opening_delay):
+                    now - self.open_started_time < self.opening_delay):
                 # wait for at least opening_delay seconds before setting status to back to CLOSED
                 pass
             elif self.door_status != DoorStatus.CLOSED:
-                self.door_status = DoorStatus.CLOSED
                 self.close_failed = False
-                self.inform_listeners(self.door_status)
-        time.sleep(1.0)
+                self._change(DoorStatus.CLOSED, now)
+        if edge is not None:
+            if self.door_status != previous:
+                self.last_detection_latency = time.monotonic() - edge[1]
+                self.detection_latency.observe(self.last_detection_latency)
+            elif self.button.is_pressed == self.was_pressed:
+                self.bounces += 1
+        self.was_pressed = self.button.is_pressed
+        return self._next_timeout()
+
+    def _change(self, status: DoorStatus, when: float):
+        self.door_status = status
+        self.changed_time = when
+        self.inform_listeners(status)
+
+    def _next_timeout(self) -> float:
+        """Returns the number of seconds until the door movement state needs to be checked again."""
+        if self.door_status == DoorStatus.OPENING:
+            deadlines = [self.open_started_time + self.opening_delay,
+                         self.open_started_time + self.door_movement_delay]
+        elif self.door_status == DoorStatus.CLOSING:
+            deadlines = [self.close_started_time + self.door_movement_delay]
+        else:
+            return self.poll_interval
+        now = time.time()
+        # a little past the deadline because step() checks the delays with >
+        return min([deadline - now + 0.01 for deadline in deadlines if deadline >= now] + [self.poll_interval])
 
     def close_started(self):
-        self.door_status = DoorStatus.CLOSING
         self.close_started_time = time.time()
-        self.inform_listeners(self.door_status)
+        self._change(DoorStatus.CLOSING, self.close_started_time)
+        self.notify()
 
     def open_started(self):
-        self.door_status = DoorStatus.OPENING
         self.open_started_time = time.time()
-        self.inform_listeners(self.door_status)
+        self._change(DoorStatus.OPENING, self.open_started_time)
+        self.notify()
 
     def is_open(self):
         # contact is closed when door is closed, so we're open when button is not pressed
         return not self.button.is_pressed
 
-    def run(self):
+    def _initial_status(self):
         logging.info(f'monitoring door status using GPIO pin {self.gpio_pin}')
-        # send an initial message since loop() may not send one if nothing changes
-        if self.is_open():
-            self.door_status = DoorStatus.OPEN
-        else:
-            self.door_status = DoorStatus.CLOSED
-        self.inform_listeners(self.door_status)
+        # send an initial message since step() may not send one if nothing changes
+        with self.edge_lock:
+            self.first_edge = None
+            self.settle_time = None
+        self.was_pressed = self.button.is_pressed
+        self._change(DoorStatus.OPEN if self.is_open() else DoorStatus.CLOSED, time.time())
+
+    def run(self):
+        self._initial_status()
         super().run()
 
+    async def run_async(self, executor=None):
+        self._initial_status()
+        await super().run_async(executor)
+
     def shutdown(self):
         super().shutdown()
         self.button.close()
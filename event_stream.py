@@ -0,0 +1,208 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+
+class _Event:
+    __slots__ = ('sequence', 'type', 'data', 'time')
+
+    def __init__(self, sequence: int, type: str, data: bytes, time: float):
+        self.sequence = sequence
+        self.type = type
+        self.data = data  # the whole server-sent event, encoded once for every subscriber
+        self.time = time
+
+
+class EventStream:
+    """Server-sent event stream of a stall for the /api/events end point.
+
+    Event types:
+        state       - the JSON of /api/state, sent first so a client knows everything without waiting for changes
+        door        - {"door": DoorStatus name}
+        car         - {"car": CarStatus name}
+        distance    - {"distance": cm, "speed": cm/s or null}, sent at most rate times a second to each client
+        temperature - {"temperature": degrees C}
+
+    publish() encodes each event once and appends it to a ring of the last history events, whatever the number of
+    subscribers.  Each subscriber reads the ring from its own position on the event loop, so a slow client only
+    holds up itself, and it drops distance events it has no use for at its rate: a distance event is sent once
+    rate allows or together with the next other event, older ones are replaced by newer ones.
+
+    Event ids are "<start time>-<sequence>".  A client reconnecting with a Last-Event-ID still in the ring gets the
+    events it missed, otherwise it starts over with a state event.
+    """
+    KEEPALIVE = 15.0  # seconds between comments on an idle stream so proxies keep it open
+    MAX_RATE = 100.0  # TFmini-S frames per second
+
+    def __init__(self, history: int = 1000):
+        """
+        Parameters
+        ----------
+        history - int - events kept for clients that reconnect, defaults to 1000 (10 seconds of distances)
+        """
+        self.garage = None
+        self.epoch = int(time.time())
+        self.events = deque(maxlen=history)
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.event_loop = None
+        self.new_event = None  # asyncio.Future resolved on the event loop when there are new events
+        self.scheduled = False
+        self.subscribers = 0
+        self.published = 0
+        self.sent = 0
+        self.dropped = 0  # distance events not sent because of a client's rate
+        self.resyncs = 0  # clients that fell out of the ring and were sent a new state event
+        self.last_car = None
+        self.lag = REGISTRY.histogram('garage_stream_lag_seconds',
+                                      'Seconds from publish() until the event was handed to a /api/events client')
+        REGISTRY.gauge('garage_stream_subscribers', 'Clients of /api/events', lambda: self.subscribers)
+        for name in ('published', 'sent', 'dropped', 'resyncs'):
+            REGISTRY.counter('garage_stream_events_total', '/api/events events by what happened to them',
+                             lambda name=name: getattr(self, name), outcome=name)
+
+    def connect(self, garage) -> None:
+        """Publishes the door status, car status, distance and CPU temperature of garage."""
+        self.garage = garage
+        garage.door_status.listeners.append(lambda status: self.publish('door', {'door': status.name}))
+        garage.listeners.append(lambda distance: self.publish(
+            'distance', {'distance': distance, 'speed': garage.speed if garage.speed != -999.0 else None}))
+        garage.temperature_monitor.listeners.append(
+            lambda temperature: self.publish('temperature', {'temperature': temperature}))
+        garage.state.listeners.append(self._state_changed)
+
+    def start(self) -> None:
+        """Remembers the event loop the subscribers run on, use as a NiceGUI app.on_startup handler."""
+        self.event_loop = asyncio.get_running_loop()
+        self.new_event = self.event_loop.create_future()
+
+    def _state_changed(self, values: dict) -> None:
+        # the car status has no listeners of its own, GarageState notices when it changes
+        if values['car'] != self.last_car:
+            self.last_car = values['car']
+            self.publish('car', {'car': values['car']})
+
+    def event_id(self, sequence: int) -> str:
+        return f'{self.epoch}-{sequence}'
+
+    def publish(self, type: str, data: dict) -> None:
+        """Appends an event for every subscriber.  Safe to call from any thread, never blocks on a client."""
+        now = time.time()
+        with self.lock:
+            self.sequence += 1
+            self.published += 1
+            payload = json.dumps(dict(data, time=now), separators=(',', ':'))
+            encoded = f'id: {self.event_id(self.sequence)}\nevent: {type}\ndata: {payload}\n\n'.encode()
+            self.events.append(_Event(self.sequence, type, encoded, time.monotonic()))
+            event_loop = self.event_loop
+            if event_loop is None or self.scheduled:
+                return
+            self.scheduled = True
+        # one wake-up of the event loop for a burst of events, however many clients there are
+        event_loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        with self.lock:
+            self.scheduled = False
+        new_event = self.new_event
+        self.new_event = self.event_loop.create_future()
+        new_event.set_result(None)
+
+    def _since(self, sequence: int):
+        """Returns the events after sequence, None if some of them already left the ring."""
+        with self.lock:
+            if not self.events or self.events[-1].sequence <= sequence:
+                return []
+            if self.events[0].sequence > sequence + 1:
+                return None
+            # walks back from the newest event, a client is usually only a few events behind
+            events = []
+            for event in reversed(self.events):
+                if event.sequence <= sequence:
+                    break
+                events.append(event)
+        events.reverse()
+        return events
+
+    def _resume_sequence(self, last_event_id: str):
+        """Returns the sequence a Last-Event-ID of this run stands for, None if it is not from this run."""
+        try:
+            epoch, sequence = last_event_id.split('-')
+            if int(epoch) == self.epoch:
+                return int(sequence)
+        except (AttributeError, ValueError):
+            pass
+        return None
+
+    def _state_event(self) -> (int, bytes):
+        """Returns the current sequence and a state event with the JSON of /api/state."""
+        with self.lock:
+            sequence = self.sequence
+        _, body = self.garage.state.current
+        return sequence, f'id: {self.event_id(sequence)}\nevent: state\ndata: '.encode() + body + b'\n\n'
+
+    async def subscribe(self, last_event_id: str = None, rate: float = 10.0):
+        """Yields chunks of server-sent events for one client until it disconnects.
+
+        Parameters
+        ----------
+        last_event_id - str - Last-Event-ID of a client that reconnects, None for a new client
+        rate - float - distance events per second the client wants, at most MAX_RATE
+        """
+        interval = 1.0 / min(max(rate, 0.1), self.MAX_RATE)
+        sequence = self._resume_sequence(last_event_id)
+        self.subscribers += 1
+        try:
+            if sequence is None:
+                sequence, chunk = self._state_event()
+                yield chunk
+            held = None  # latest distance event not sent yet
+            next_distance = 0.0
+            while True:
+                new_event = self.new_event
+                events = self._since(sequence)
+                if events is None:
+                    # fell behind by more than the ring holds, start over
+                    self.resyncs += 1
+                    held = None
+                    sequence, chunk = self._state_event()
+                    yield chunk
+                    continue
+                chunks = []
+                now = time.monotonic()
+                for event in events:
+                    sequence = event.sequence
+                    if event.type == 'distance':
+                        if held is not None:
+                            self.dropped += 1
+                        held = event
+                        continue
+                    if held is not None:
+                        # keeps the ids in order so a reconnect resumes from the right place
+                        chunks.append(held)
+                        held = None
+                    chunks.append(event)
+                if held is not None and (chunks or now >= next_distance):
+                    chunks.append(held)
+                    held = None
+                if chunks:
+                    if any(event.type == 'distance' for event in chunks):
+                        next_distance = now + interval
+                    for event in chunks:
+                        self.lag.observe(now - event.time)
+                    self.sent += len(chunks)
+                    yield b''.join(event.data for event in chunks)
+                timeout = max(next_distance - time.monotonic(), 0.0) if held is not None else self.KEEPALIVE
+                done, _ = await asyncio.wait((new_event,), timeout=timeout)
+                if not done and held is None:
+                    yield b': keepalive\n\n'
+        finally:
+            self.subscribers -= 1
+
+    def stats(self) -> dict:
+        return {'subscribers': self.subscribers, 'published': self.published, 'sent': self.sent,
+                'dropped': self.dropped, 'resyncs': self.resyncs}
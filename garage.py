@@ -7,15 +7,15 @@
 #   from parking spot on a NeoPixel strip.  Also monitors
 #   Wifi to look for the Car's wifi signal.
 #
+import asyncio
 import json
 import sys
+import threading
 
 import configargparse as cap
-import gui
 import logging
+import logging.handlers
 import os
-from control_thread import ControlThread
-from nicegui import app, ui
 import io
 import board
 
@@ -36,6 +36,8 @@ p.add_argument('--neopixel_pin', type=str, action='store', default='D21',
 p.add_argument('--num_pixels', type=int, action='store', help='number of NeoPixels, defaults to 60',
                default=60)
 p.add_argument('--wlan', default='wlan0', help='wireless interface to use for ssid scanning, defaults to wlan0')
+p.add_argument('--wifi_slow_scan_period', type=float, action='store', default=30.0,
+               help='seconds between Wifi scans while the car is parked and the door is closed, defaults to 30 seconds')
 p.add_argument('--web_host', action='store', default='0.0.0.0',
                help='start web server and bind to given host')
 p.add_argument('--storage_secret', type=str, action='store',
@@ -48,6 +50,7 @@ p.add_argument('--door_control_pin', type=int, action='store', default=17,
                help='Door control pin, passed to gpiozero OutputDevice to trigger garage door open/close relay, '
                     'defaults to 17')
 p.add_argument('--mqtt_server', action='store', help='FQDN of MQTT server to send status updates to')
+p.add_argument('--mqtt_port', type=int, action='store', default=1883, help='port of MQTT server, defaults to 1883')
 p.add_argument('--mqtt_discovery_prefix', action='store', help='MQTT discovery_prefix portion of topic to publish '
                                                                'configuration and status to, defaults to homeassistant',
                default='homeassistant')
@@ -57,9 +60,26 @@ p.add_argument('--mqtt_device_name', action='store', help='MQTT device name to u
                                                           'defaults to "Garage Door"', default='Garage Door')
 p.add_argument('--mqtt_username', action='store', help='MQTT server username to login')
 p.add_argument('--mqtt_password', action='store', help='MQTT server password to login')
+p.add_argument('--mqtt_json_state', action='store_true', help='publish door, car and park distance state as one JSON '
+                                                               'message instead of one topic each')
+p.add_argument('--mqtt_coalesce_window', type=float, action='store', default=0.25,
+               help='minimum seconds between MQTT state publications, changes in between are merged, '
+                    'defaults to 0.25 seconds')
 p.add_argument('--passwords', action='store', default='passwords.json', help='passwords are loaded from this json file')
 p.add_argument('--db_file', action='store', help='store persistent variables in this file, defaults to garage_vars',
                default='garage_vars')
+p.add_argument('--db_flush_interval', type=float, action='store',
+               help='maximum number of seconds changes to persistent variables are kept in memory before being written '
+                    'to db_file, defaults to 60 seconds', default=60.0)
+p.add_argument('--history_dir', action='store', default='history',
+               help='keep a history of distance, speed, CPU temperature and door status in this directory for the '
+                    'graphs page, defaults to history')
+p.add_argument('--history_retention_days', type=float, action='store', default=7.0,
+               help='number of days of history to keep, defaults to 7 days')
+p.add_argument('--disable_history', action='store_true', help='disables keeping a history')
+p.add_argument('--record_dir', action='store',
+               help='record TFmini-S frames, door contact edges, car Wifi scans and door button presses in this '
+                    'directory for session_replay.py, kept for history_retention_days, defaults to not recording')
 p.add_argument('--auto_open_cool_down', type=int, action='store',
                help='amount of time in seconds to wait after car exits before considering opening the door, '
                     'defaults to 300 seconds',
@@ -67,13 +87,21 @@ p.add_argument('--auto_open_cool_down', type=int, action='store',
 p.add_argument('--door_movement_delay', type=int, action='store',
                help='how long to wait for door to open or close before considering it a failure when door_status_pin'
                     'does not change its reading, defaults to 10 seconds', default=10)
+p.add_argument('--door_debounce', type=float, action='store', default=0.005,
+               help='seconds the door contact has to stay put after it changes before it is read, defaults to 0.005')
 p.add_argument('--disable_tfmini', action='store_true', help='disables TFmini-S usage')
 p.add_argument('--disable_wifi', action='store_true', help='disables Wifi usage')
 p.add_argument('--disable_web', action='store_true', help='disables web interface')
 p.add_argument('--disable_auto_open_via_wifi', action='store_true', help='disable auto open via Wifi')
 p.add_argument('--disable_auto_close_via_wifi', action='store_true', help='disable auto close via Wifi')
 p.add_argument('--disable_mqtt', action='store_true', help='disables MQTT integration')
+p.add_argument('--disable_mqtt_telemetry', action='store_true', help='disables sending distance, speed, CPU temperature '
+                                                                     'and Wifi presence sensors to MQTT')
 p.add_argument('--autoremote_key', action='store', help='Tasker auto-remote key to send garage-opened and garage-closed messages to')
+p.add_argument('--asyncio', action='store_true', help='run sensors, NeoPixels and MQTT as tasks on the web server\'s '
+                                                      'asyncio event loop instead of separate threads')
+p.add_argument('--stalls', action='store', help='run the stalls in this json file in one process, each with its own '
+                                                'name, tfmini_port, door pins, ssids and NeoPixel segment, see README')
 
 
 options = p.parse_args()
@@ -114,31 +142,96 @@ if auto_open_via_wifi:
 if auto_close_via_wifi:
     logging.info(f'*** Door will be closed based on not seeing Wifi signal from {options.ssid}')
 
-garage = ControlThread(
-    park_distance = options.park_distance,
-    max_distance=options.max_distance,
-    wlan_interface=options.wlan,
-    ssids=options.ssid,
-    tfmini_port=options.tfmini_port,
-    neopixel_pin=getattr(board,options.neopixel_pin),
-    num_pixels=options.num_pixels,
-    door_status_pin=options.door_status_pin,
-    door_control_pin=options.door_control_pin,
-    auto_open_via_wifi=auto_open_via_wifi,
-    auto_open_cool_down=options.auto_open_cool_down,
-    auto_close_via_wifi=auto_close_via_wifi,
-    db_file=options.db_file,
-    door_movement_delay=options.door_movement_delay,
-    mqtt_server=options.mqtt_server,
-    mqtt_discovery_prefix=options.mqtt_discovery_prefix,
-    mqtt_device_id=options.mqtt_device_id,
-    mqtt_device_name=options.mqtt_device_name,
-    mqtt_username=options.mqtt_username,
-    mqtt_password=options.mqtt_password,
-    autoremote_key=options.autoremote_key
-)
-logging.info('starting garage control thread')
-garage.start()
+# Phase one starts the parking guide, the TFmini-S, LEDs and door contact, with as little imported as possible.  MQTT,
+# Wifi, notifications and the web site, with the imports they need, come up afterwards in parallel.
+staged = not options.asyncio and options.stalls is None
+if options.stalls is not None:
+    from stalls import Stalls
+    with io.open(options.stalls, 'r') as fp:
+        stalls = json.load(fp)
+    for stall in stalls:
+        if options.disable_tfmini:
+            stall['tfmini_port'] = None
+        logging.info(f"stall {stall.get('name')} looks for Wifi {stall.get('ssids')}")
+    garage = Stalls(
+        stalls,
+        neopixel_pin=getattr(board,options.neopixel_pin),
+        num_pixels=options.num_pixels,
+        wlan_interface=options.wlan,
+        wifi_slow_scan_period=options.wifi_slow_scan_period,
+        mqtt_server=options.mqtt_server,
+        mqtt_port=options.mqtt_port,
+        mqtt_username=options.mqtt_username,
+        mqtt_password=options.mqtt_password,
+        mqtt_device_id=options.mqtt_device_id,
+        mqtt_device_name=options.mqtt_device_name,
+        db_file=options.db_file,
+        history_dir=None if options.disable_history else options.history_dir,
+        record_dir=options.record_dir,
+        asyncio_mode=options.asyncio,
+        # every stall unless it says otherwise
+        park_distance=options.park_distance,
+        max_distance=options.max_distance,
+        history_retention_days=options.history_retention_days,
+        auto_open_via_wifi=not options.disable_wifi and not options.disable_auto_open_via_wifi,
+        auto_open_cool_down=options.auto_open_cool_down,
+        auto_close_via_wifi=not options.disable_wifi and not options.disable_auto_close_via_wifi,
+        db_flush_interval=options.db_flush_interval,
+        door_movement_delay=options.door_movement_delay,
+        door_debounce=options.door_debounce,
+        mqtt_discovery_prefix=options.mqtt_discovery_prefix,
+        mqtt_json_state=options.mqtt_json_state,
+        mqtt_coalesce_window=options.mqtt_coalesce_window,
+        mqtt_telemetry=not options.disable_mqtt_telemetry,
+        autoremote_key=options.autoremote_key
+    )
+else:
+    from control_thread import ControlThread
+    garage = ControlThread(
+        park_distance = options.park_distance,
+        max_distance=options.max_distance,
+        wlan_interface=options.wlan,
+        wifi_slow_scan_period=options.wifi_slow_scan_period,
+        history_dir=None if options.disable_history else options.history_dir,
+        history_retention_days=options.history_retention_days,
+        record_dir=options.record_dir,
+        ssids=options.ssid,
+        tfmini_port=options.tfmini_port,
+        neopixel_pin=getattr(board,options.neopixel_pin),
+        num_pixels=options.num_pixels,
+        door_status_pin=options.door_status_pin,
+        door_control_pin=options.door_control_pin,
+        auto_open_via_wifi=auto_open_via_wifi,
+        auto_open_cool_down=options.auto_open_cool_down,
+        auto_close_via_wifi=auto_close_via_wifi,
+        db_file=options.db_file,
+        db_flush_interval=options.db_flush_interval,
+        door_movement_delay=options.door_movement_delay,
+        door_debounce=options.door_debounce,
+        mqtt_server=options.mqtt_server,
+        mqtt_port=options.mqtt_port,
+        mqtt_discovery_prefix=options.mqtt_discovery_prefix,
+        mqtt_device_id=options.mqtt_device_id,
+        mqtt_device_name=options.mqtt_device_name,
+        mqtt_username=options.mqtt_username,
+        mqtt_password=options.mqtt_password,
+        mqtt_json_state=options.mqtt_json_state,
+        mqtt_coalesce_window=options.mqtt_coalesce_window,
+        mqtt_telemetry=not options.disable_mqtt_telemetry,
+        autoremote_key=options.autoremote_key,
+        asyncio_mode=options.asyncio,
+        staged_startup=staged
+    )
+if options.asyncio:
+    from async_runtime import AsyncRuntime
+    runtime = AsyncRuntime(garage)
+else:
+    runtime = None
+    logging.info('starting garage control thread')
+    garage.start()
+if staged:
+    # phase two, the Wifi scanner and notifications start and MQTT connects while the web site is imported
+    threading.Thread(target=garage.start_services, name='services', daemon=True).start()
 
 def _run_system_command(command):
     logging.info(command)
@@ -158,10 +251,20 @@ def restart():
     _run_system_command('reboot -f')
 
 if not options.disable_web:
+    import gui
+    from nicegui import app, ui
+    if staged:
+        garage.local_services_started.wait()  # the pages show the Wifi scanner and notifications
     gui.create_pages(garage, passwords, shutdown, restart)
     app.add_static_files('/static', 'static')
+    if runtime is not None:
+        app.on_startup(runtime.start)
+        app.on_shutdown(runtime.stop)
     ui.run(title='Garage-Pi', host=options.web_host, reload=False, show=False,
            storage_secret=options.storage_secret, favicon='🚗')
+elif runtime is not None:
+    logging.info('web interface disabled')
+    asyncio.run(runtime.run())
 else:
     try:
         logging.info('web interface disabled')
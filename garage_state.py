@@ -0,0 +1,139 @@
+import asyncio
+import json
+import threading
+import time
+
+from metrics import REGISTRY
+
+
+class GarageState:
+    """Versioned JSON snapshot of a stall for the /api/state end point.
+
+    refresh() is called at the end of every ControlThread step.  It collects door status, car status, tracked
+    distance, speed, park distance, CPU temperature and Wifi presence, and only when one of them changed by more
+    than its deadband does it bump the version, serialize the JSON once, wake up long-polling requests and call the
+    listeners.  Requests for an unchanged version are answered from the ETag alone.
+
+    The ETag combines the start time with the version so a client polling across a restart never sees a stale match.
+    """
+    # changes smaller than these are sensor noise and do not make a new version
+    DEADBANDS = {'distance': 2.0, 'speed': 2.0, 'temperature': 0.5}
+    MAX_WAIT = 60.0  # seconds a long-poll is held at most
+
+    def __init__(self, garage):
+        """
+        Parameters
+        ----------
+        garage - ControlThread - stall to take snapshots of
+        """
+        self.garage = garage
+        self.lock = threading.Lock()
+        self.epoch = int(time.time())
+        self.values = {}
+        self.version = 0
+        self.current = (None, b'')  # (etag, body), replaced as a whole so readers never see a mismatched pair
+        self.waiters = []  # (event loop, future) of requests waiting for the next version
+        self.refreshes = 0
+        self.listeners = []  # called with the values of every new version
+        self.sent = 0  # responses with a body
+        self.not_modified = 0  # 304 responses
+        REGISTRY.gauge('garage_state_version', 'Version of the /api/state snapshot', lambda: self.version)
+        REGISTRY.gauge('garage_state_waiting', 'Requests long-polling /api/state', lambda: len(self.waiters))
+        for name in ('sent', 'not_modified'):
+            REGISTRY.counter('garage_state_responses_total', '/api/state responses by kind',
+                             lambda name=name: getattr(self, name), response=name)
+
+    @property
+    def etag(self) -> str:
+        return self.current[0]
+
+    def snapshot(self) -> dict:
+        garage = self.garage
+        found = garage.wifi_scanner.found(garage.ssids) if garage.wifi_scanner is not None else None
+        # the filtered distance, the raw readings jump by a few cm from one frame to the next
+        estimate = garage.tracker.estimate
+        distance = round(estimate.distance, 1) if estimate is not None else garage.current_distance
+        return {
+            'door': garage.door_status.door_status.name,
+            'car': garage.db['car_status'].name,
+            'distance': distance if garage.tfminis is not None else None,
+            'speed': round(garage.speed, 1) if garage.tfminis is not None and garage.speed != -999.0 else None,
+            'park_distance': garage.display.park_distance,
+            'temperature': garage.temperature_monitor.temperature,
+            'wifi_found': len(found) > 0 if found is not None else None
+        }
+
+    def refresh(self) -> bool:
+        """Takes a new snapshot, returns True if it made a new version."""
+        values = self.snapshot()
+        with self.lock:
+            self.refreshes += 1
+            if self.current[0] is not None and not self._changed(values):
+                return False
+            self.values = values
+            self.version += 1
+            etag = f'"{self.epoch}-{self.version}"'
+            body = json.dumps(dict(values, version=self.version, time=time.time()), separators=(',', ':'))
+            self.current = (etag, body.encode())
+            waiters = self.waiters
+            self.waiters = []
+        for event_loop, future in waiters:
+            event_loop.call_soon_threadsafe(self._wake, future)
+        for listener in self.listeners:
+            listener(values)
+        return True
+
+    def _changed(self, values: dict) -> bool:
+        for key, value in values.items():
+            old = self.values.get(key)
+            deadband = self.DEADBANDS.get(key)
+            if deadband is None or value is None or old is None:
+                if value != old:
+                    return True
+            elif abs(value - old) >= deadband:
+                return True
+        return False
+
+    @staticmethod
+    def _wake(future: asyncio.Future) -> None:
+        if not future.done():
+            future.set_result(None)
+
+    async def wait_async(self, etag: str, timeout: float) -> None:
+        """Returns as soon as the ETag is no longer etag or after timeout seconds."""
+        event_loop = asyncio.get_running_loop()
+        future = event_loop.create_future()
+        with self.lock:
+            if self.current[0] != etag:
+                return
+            self.waiters.append((event_loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # timed out or the client went away
+            with self.lock:
+                if (event_loop, future) in self.waiters:
+                    self.waiters.remove((event_loop, future))
+
+    async def respond_async(self, etag: str = None, wait: float = 0.0) -> (int, str, bytes):
+        """Returns the status code, ETag and body to answer a request for the state with.
+
+        Parameters
+        ----------
+        etag - str - ETag from the If-None-Match header of the request, None if it has none
+        wait - float - seconds to wait for a new version when etag is the current one, 0 answers right away
+        """
+        if wait > 0 and etag == self.etag:
+            await self.wait_async(etag, min(wait, self.MAX_WAIT))
+        current, body = self.current
+        if etag == current:
+            self.not_modified += 1
+            return 304, current, b''
+        self.sent += 1
+        return 200, current, body
+
+    def stats(self) -> dict:
+        return {'version': self.version, 'refreshes': self.refreshes, 'waiting': len(self.waiters),
+                'sent': self.sent, 'not_modified': self.not_modified}
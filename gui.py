@@ -1,22 +1,23 @@
-import base64
-import secrets
+import asyncio
 import time
 from contextlib import contextmanager
 
 from fastapi.security import HTTPAuthorizationCredentials, HTTPDigest
-from fastapi.security.utils import get_authorization_scheme_param
-from nicegui import ui, app, nicegui, Client
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import RedirectResponse, PlainTextResponse
+from nicegui import ui, app, nicegui, Client, run
+from starlette.responses import RedirectResponse, PlainTextResponse, Response, StreamingResponse
+from credentials import CredentialIndex
 from door_status_thread import DoorStatus
-from utils import last_boot
-from fastapi import Request, Security
+from event_stream import EventStream
+from gui_hub import GuiHub
+from metrics import REGISTRY
+from stalls import Stalls
+from fastapi import HTTPException, Request, Security
 
 
 unrestricted_page_routes = {'/login'}
 
 
-def create_door_image(garage):
+def create_door_image(garage, hub: GuiHub):
     with ui.image(source='static/Open.jpg') as image:
         image_label = ui.label('OPEN').classes('absolute-bottom text-subtitle2 text-center')
 
@@ -34,11 +35,11 @@ def create_door_image(garage):
         image.update()
 
     update_image(garage.door_status.door_status)
-    garage.door_status.listeners.append(update_image)
+    hub.subscribe('door_status', update_image)
     return image
 
 
-def create_door_status_label(garage):
+def create_door_status_label(garage, hub: GuiHub):
     label = ui.label(f'Door is {garage.door_status.door_status.name}')
 
     def update_label(door_status):
@@ -46,11 +47,11 @@ def create_door_status_label(garage):
         label.update()
 
     update_label(garage.door_status.door_status)
-    garage.door_status.listeners.append(update_label)
+    hub.subscribe('door_status', update_label)
     return label
 
 
-def create_open_close_button(garage):
+def create_open_close_button(garage, hub: GuiHub):
     def open_or_close():
         garage.open_or_close(' because website user pressed button')
 
@@ -65,14 +66,14 @@ def create_open_close_button(garage):
             button.update()
 
     update_button_text(garage.door_status.door_status)
-    garage.door_status.listeners.append(update_button_text)
+    hub.subscribe('door_status', update_button_text)
     return button
 
 
-def create_distance_chart(garage):
-    """Creates a distance gauge and adds it as a listener to garage.listeners."""
+def create_distance_chart(garage, hub: GuiHub):
+    """Creates a distance gauge and subscribes it to the garage's distance readings."""
     chart = ui.chart({
-        'title': { 'text': 'Car Distance' },
+        'title': { 'text': 'Car Distance' if garage.stall_name is None else f'Car Distance {garage.stall_name}' },
         'chart': { 'type': 'gauge' },
         'xAxis': {
             'categories': [ 'Dist (cm)' ],
@@ -99,13 +100,12 @@ def create_distance_chart(garage):
             chart.update()
             chart.last_updated = time.time()
 
-    garage.listeners.append(update_chart)
+    hub.subscribe('distance', update_chart)
     return chart
 
 
-def create_temperature_chart(garage):
-    """Creates a CPU temperature gauge and uses garage.temperature_monitor.listeners to add the gauge as
-    a listener for temp changes. """
+def create_temperature_chart(garage, hub: GuiHub):
+    """Creates a CPU temperature gauge and subscribes it to temperature changes."""
     # https://www.highcharts.com/demo/highcharts/gauge-speedometer
     chart = ui.chart({
         'title': {
@@ -195,7 +195,40 @@ def create_temperature_chart(garage):
             chart.update()
             chart.last_updated = time.time()
 
-    garage.temperature_monitor.listeners.append(update_chart)
+    hub.subscribe('temperature', update_chart)
+    return chart
+
+
+def create_history_chart(garage):
+    """Creates a chart of the min, max and mean of a series in garage.history over the last hour, day or week."""
+    series_names = {'distance': 'Distance (cm)', 'speed': 'Speed (cm/s)', 'strength': 'Strength',
+                    'cpu_temp': 'CPU Temperature (°C)', 'door': 'Door Status'}
+    ranges = {3600: 'Hour', 86400: 'Day', 7 * 86400: 'Week'}
+    chart = ui.chart({
+        'title': { 'text': 'History' if garage.stall_name is None else f'History {garage.stall_name}' },
+        'chart': { 'zoomType': 'x' },
+        'xAxis': { 'type': 'datetime' },
+        'yAxis': { 'title': { 'text': None } },
+        'time': { 'useUTC': False },
+        'legend': { 'enabled': False },
+        'series': [
+            { 'name': 'Min/Max', 'type': 'arearange', 'data': [], 'lineWidth': 0, 'fillOpacity': 0.3 },
+            { 'name': 'Mean', 'type': 'line', 'data': [] }
+        ],
+    }).classes('w-96 h-64')
+
+    async def update_chart():
+        end = time.time()
+        buckets = await run.io_bound(garage.history.query, series.value, end - period.value, end, 300)
+        chart.options['yAxis']['title']['text'] = series_names[series.value]
+        chart.options['series'][0]['data'] = [[t * 1000, low, high] for t, low, high, _, _ in buckets]
+        chart.options['series'][1]['data'] = [[t * 1000, mean] for t, _, _, mean, _ in buckets]
+        chart.update()
+
+    with ui.row():
+        series = ui.select(series_names, value='distance', on_change=update_chart)
+        period = ui.toggle(ranges, value=86400, on_change=update_chart)
+    ui.timer(0.0, update_chart, once=True)
     return chart
 
 
@@ -209,7 +242,159 @@ def create_park_distance_slider(garage):
 
 
 
+def create_status_table(garage, hub: GuiHub, stream: EventStream):
+    """Creates the table of the status page for one stall with a button to refresh it."""
+    if garage.stall_name is not None:
+        ui.label(garage.stall_name).classes('text-lg')
+    table = ui.aggrid({
+        'columnDefs': [
+            {'headerName': 'Field', 'field': 'field'},
+            {'headerName': 'Status', 'field': 'status'},
+        ],
+        'rowData': []
+    })
+
+    def update_table():
+        # logging.info(f'updating table with {[cell.ssid for cell in garage.wifi_scanner.cells]}')
+        estimate = garage.tracker.estimate
+        table.options['rowData'] = [
+            {
+                'field': 'Car Status',
+                'status': garage.db['car_status'].name
+            },
+            {
+                'field': 'Door Status',
+                'status': garage.door_status.door_status.name
+            },
+            {
+                'field': 'Door contact',
+                'status': f'{garage.door_status.edges} edges, {garage.door_status.bounces} bounces'
+                          + ('' if garage.door_status.last_detection_latency is None else
+                             f', last change seen in '
+                             f'{garage.door_status.last_detection_latency * 1000:.1f} ms')
+            },
+            {
+                'field': 'Position',
+                'status': garage.current_distance
+            },
+            {
+                'field': 'Park Distance',
+                'status': garage.park_distance
+            },
+            {
+                'field': 'Max Distance',
+                'status': garage.max_distance
+            },
+            {
+                'field': 'Speed',
+                'status': f'{garage.speed:.2f}'
+            },
+            {
+                'field': 'Tracked distance',
+                'status': 'no reading yet' if estimate is None else
+                          f'{estimate.distance:.1f} ± {estimate.distance_std:.1f} cm, '
+                          f'{estimate.speed:.1f} ± {estimate.speed_std:.1f} cm/s, '
+                          f'{estimate.acceleration:.0f} cm/s², '
+                          f"{garage.tracker.stats()['rejected_outliers']} outliers dropped"
+            },
+            {
+                'field': 'Temperature',
+                'status': garage.temperature_monitor.temperature
+            },
+            {
+                'field': 'Wifi Seen?',
+                'status': str(len(garage.wifi_scanner.found(garage.ssids)) > 0) if garage.wifi_scanner else 'N/A'
+            },
+            {
+                'field': 'Parked?',
+                'status': str(garage.display.parked)
+            },
+            {
+                'field': 'Last boot',
+                'status': str(garage.temperature_monitor.metrics.boot_time())
+            },
+            {
+                'field': 'Load average',
+                'status': ' '.join(f'{load:.2f}' for load in garage.temperature_monitor.metrics.load_average())
+            },
+            {
+                'field': 'Memory available',
+                'status': f"{garage.temperature_monitor.metrics.memory()['MemAvailable'] // 1024} MB"
+            },
+            {
+                'field': 'LED frames',
+                'status': f'{garage.display.frames_rendered} sent, {garage.display.frames_skipped} unchanged'
+            },
+            {
+                'field': 'MQTT messages',
+                'status': f'{garage.home_assistant.messages_sent} sent, '
+                          f'{garage.home_assistant.messages_suppressed} unchanged'
+                          if garage.home_assistant else 'N/A'
+            },
+            {
+                'field': 'Wifi scans',
+                'status': f'{garage.wifi_scanner.scans_per_minute()} per minute, last took '
+                          f'{garage.wifi_scanner.last_scan_duration or 0:.1f} seconds, '
+                          f'{garage.wifi_scanner.passive_results} from other scans'
+                          if garage.wifi_scanner else 'N/A'
+            },
+            {
+                'field': 'Web page updates',
+                'status': f"{hub.stats()['subscribers']} pages open, {hub.delivered} delivered, "
+                          f"{hub.coalesced} merged, {hub.last_lag * 1000:.0f} ms lag "
+                          f"({hub.max_lag * 1000:.0f} ms max)"
+            },
+            {
+                'field': 'Notifications',
+                'status': f'{garage.notifications.sent} sent, {garage.notifications.waiting()} waiting, '
+                          f'{garage.notifications.failed} failed attempts'
+                          + (f', last error {garage.notifications.last_error}'
+                             if garage.notifications.last_error else '')
+            },
+            {
+                'field': 'Event stream',
+                'status': f'{stream.subscribers} clients, {stream.published} events, {stream.sent} sent, '
+                          f'{stream.dropped} distances dropped for client rates'
+            },
+            {
+                'field': 'SD card writes',
+                'status': f'{garage.db.bytes_written_last_hour()} bytes in the last hour'
+            }
+        ]
+        table.update()
+
+    update_table()
+    ui.button('Refresh', on_click=update_table)
+
+
 def create_pages(garage, passwords, shutdown, restart) -> None:
+    """Creates the web site of garage, a ControlThread or the Stalls of a garage with several stalls.  Every page
+    shows all stalls, the routes for one stall take ?stall=<name> and use the first stall without it."""
+    # passwords are only kept hashed from here on
+    credentials = CredentialIndex(passwords)
+    stalls = list(garage) if isinstance(garage, Stalls) else [garage]
+    hubs = {}
+    streams = {}
+    for stall in stalls:
+        with REGISTRY.labelled(**({'stall': stall.stall_name} if stall.stall_name is not None else {})):
+            hubs[stall] = GuiHub()
+            streams[stall] = EventStream()
+        hubs[stall].connect(stall)
+        app.on_startup(hubs[stall].start)
+        streams[stall].connect(stall)
+        app.on_startup(streams[stall].start)
+    # the stalls share the scanner
+    wifi_scanner = next((stall.wifi_scanner for stall in stalls if stall.wifi_scanner is not None), None)
+
+    def find(name: str = None):
+        """Returns the stall called name, the first stall if name is None."""
+        if name is None:
+            return stalls[0]
+        for stall in stalls:
+            if stall.stall_name == name:
+                return stall
+        raise HTTPException(status_code=404, detail=f'no stall {name}')
+
     def menu():
         with ui.button(icon='menu'):
             with ui.menu() as menu:
@@ -236,54 +421,60 @@ def create_pages(garage, passwords, shutdown, restart) -> None:
     @ui.page('/')
     def main_page():
         with layout('Garage-Pi'):
-            create_door_image(garage)
-            create_open_close_button(garage)
+            for stall in stalls:
+                if stall.stall_name is not None:
+                    ui.label(stall.stall_name).classes('text-lg')
+                create_door_image(stall, hubs[stall])
+                create_open_close_button(stall, hubs[stall])
 
     @ui.page('/graphs')
     def graphs_page():
         with layout('Graphs'):
-            create_distance_chart(garage)
-            create_temperature_chart(garage)
+            for stall in stalls:
+                create_distance_chart(stall, hubs[stall])
+            create_temperature_chart(stalls[0], hubs[stalls[0]])
+            for stall in stalls:
+                if stall.history is not None:
+                    create_history_chart(stall)
             ui.link('Back', main_page)
 
 
 
-    class AuthMiddleware(BaseHTTPMiddleware):
+    class AuthMiddleware:
         """This middleware restricts access to all NiceGUI pages.
 
-        It redirects the user to the login page if they are not authenticated.
+        It redirects the user to the login page if they are not authenticated.  It is a plain ASGI middleware rather
+        than a BaseHTTPMiddleware, so the static files and NiceGUI assets it lets through untouched do not pay for a
+        Request, a task and a streamed copy of the response.
         """
-        def authorize_digest(self, request: Request):
-            authorization = request.headers.get("Authorization")
-            if authorization:
-                scheme, credentials = get_authorization_scheme_param(authorization)
-                for expected_username, expected_password in passwords.items():
-                    expected_token = base64.standard_b64encode(
-                        bytes(f"{expected_username}:{expected_password}", encoding="UTF-8")
-                    )
-                    correct_token = secrets.compare_digest(
-                        bytes(credentials, encoding="UTF-8"),
-                        expected_token
-                    )
-                    if correct_token:
-                        app.storage.user.update({'username': expected_username, 'authenticated': True})
-                        break
-
-        async def dispatch(self, request: Request, call_next):
-            self.authorize_digest(request)
+        def __init__(self, app):
+            self.app = app
+
+        def authorize_basic(self, request: Request):
+            username = credentials.authorize(request.headers.get("Authorization"))
+            if username is not None:
+                credentials.remember(app.storage.user, username)
+
+        async def __call__(self, scope, receive, send):
+            if scope['type'] != 'http' or credentials.is_static(scope['path']):
+                await self.app(scope, receive, send)
+                return
+            request = Request(scope)
+            self.authorize_basic(request)
             if not app.storage.user.get('authenticated', False):
                 if request.url.path in Client.page_routes.values() and request.url.path not in unrestricted_page_routes:
                     app.storage.user['referrer_path'] = request.url.path  # remember where the user wanted to go
-                    return RedirectResponse('/login')
-            return await call_next(request)
+                    await RedirectResponse('/login')(scope, receive, send)
+                    return
+            await self.app(scope, receive, send)
 
     app.add_middleware(AuthMiddleware)
 
     @ui.page('/login')
     def login_page():
         def try_login() -> None:  # local function to avoid passing username and password as arguments
-            if passwords.get(username.value) == password.value:
-                app.storage.user.update({'username': username.value, 'authenticated': True})
+            if credentials.verify(username.value, password.value):
+                credentials.remember(app.storage.user, username.value)
                 ui.open('/')
             else:
                 ui.notify('Wrong username or password', color='negative')
@@ -297,7 +488,7 @@ def create_pages(garage, passwords, shutdown, restart) -> None:
 
     @ui.page('/wifi')
     def wifi_page():
-        if garage.wifi_scanner is not None:
+        if wifi_scanner is not None:
             with layout('Wifi Networks'):
                 table = ui.aggrid({
                   'columnDefs': [
@@ -309,11 +500,12 @@ def create_pages(garage, passwords, shutdown, restart) -> None:
                 })
 
                 def update_table(message):
-                    #logging.info(f'updating table with {[cell.ssid for cell in garage.wifi_scanner.cells]}')
+                    #logging.info(f'updating table with {[cell.ssid for cell in wifi_scanner.cells]}')
                     table.options['rowData'] = [{ 'id': cell.ssid, 'address': cell.address, 'signal': cell.signal }
-                                  for cell in garage.wifi_scanner.cells if len(cell.ssid) > 0]
+                                  for cell in wifi_scanner.cells if len(cell.ssid) > 0]
                     table.update()
 
+                wifi_scanner.scan_now()
                 ui.button('Scan', on_click=update_table)
         else:
             ui.label('Wifi scanner disabled')
@@ -321,84 +513,60 @@ def create_pages(garage, passwords, shutdown, restart) -> None:
     @ui.page('/status')
     def status_page():
         with layout('Status'):
-            table = ui.aggrid({
-                'columnDefs': [
-                    {'headerName': 'Field', 'field': 'field'},
-                    {'headerName': 'Status', 'field': 'status'},
-                ],
-                'rowData': []
-            })
-
-            def update_table():
-                # logging.info(f'updating table with {[cell.ssid for cell in garage.wifi_scanner.cells]}')
-                table.options['rowData'] = [
-                    {
-                        'field': 'Car Status',
-                        'status': garage.db['car_status'].name
-                    },
-                    {
-                        'field': 'Door Status',
-                        'status': garage.door_status.door_status.name
-                    },
-                    {
-                        'field': 'Position',
-                        'status': garage.current_distance
-                    },
-                    {
-                        'field': 'Park Distance',
-                        'status': garage.park_distance
-                    },
-                    {
-                        'field': 'Max Distance',
-                        'status': garage.max_distance
-                    },
-                    {
-                        'field': 'Speed',
-                        'status': f'{garage.speed:.2f}'
-                    },
-                    {
-                        'field': 'Temperature',
-                        'status': garage.temperature_monitor.temperature
-                    },
-                    {
-                        'field': 'Wifi Seen?',
-                        'status': str(len(garage.wifi_scanner.found()) > 0) if garage.wifi_scanner else 'N/A'
-                    },
-                    {
-                        'field': 'Parked?',
-                        'status': str(garage.display.parked)
-                    },
-                    {
-                        'field': 'Last boot',
-                        'status': str(last_boot())
-                    }
-                ]
-                table.update()
-
-            update_table()
-            ui.button('Refresh', on_click=update_table)
+            for stall in stalls:
+                create_status_table(stall, hubs[stall], streams[stall])
 
     @app.get('/door-status', response_class=PlainTextResponse)
-    async def door_status():
+    async def door_status(stall: str = None):
+        garage = find(stall)
         return garage.door_status.door_status.name
 
+    # the door commands are queued on the DoorControl thread, awaiting them does not hold up the event loop
     @app.get('/press-button', response_class=PlainTextResponse)
-    async def press_button():
-        garage.open(' because I received a /press-button web command')
-        return "Pressed"
+    async def press_button(stall: str = None):
+        garage = find(stall)
+        if await asyncio.wrap_future(garage.open_or_close(' because I received a /press-button web command')):
+            return "Pressed"
+        return f"Not pressed, door is {garage.door_status.door_status.name}"
 
     @app.get('/open', response_class=PlainTextResponse)
-    async def open_garage():
-        garage.open_garage(' because I received a /open web command')
-        return "Opened"
+    async def open_garage(stall: str = None):
+        garage = find(stall)
+        if await asyncio.wrap_future(garage.open_garage(' because I received a /open web command')):
+            return "Opened"
+        return f"Not opened, door is {garage.door_status.door_status.name}"
 
     @app.get('/close', response_class=PlainTextResponse)
-    async def close_garage():
-        garage.close_garage(' because I received a /close web command')
-        return "Closed"
+    async def close_garage(stall: str = None):
+        garage = find(stall)
+        if await asyncio.wrap_future(garage.close_garage(' because I received a /close web command')):
+            return "Closed"
+        return f"Not closed, door is {garage.door_status.door_status.name}"
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    async def metrics():
+        return REGISTRY.render()
+
+    @app.get('/api/state')
+    async def api_state(request: Request, wait: float = 0.0, stall: str = None):
+        """JSON snapshot of the stall.  Send the last ETag in If-None-Match to get a 304 while nothing changed, add
+        ?wait=seconds to hold the request open until something does (at most 60 seconds)."""
+        status, etag, body = await find(stall).state.respond_async(request.headers.get('if-none-match'), wait)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if status == 304:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    @app.get('/api/events')
+    async def api_events(request: Request, rate: float = 10.0, stall: str = None):
+        """Server-sent events of door, car, distance and temperature changes, see EventStream.  ?rate= sets the
+        distance events per second, a reconnecting EventSource sends Last-Event-ID and gets what it missed."""
+        last_event_id = request.headers.get('last-event-id', request.query_params.get('last_event_id'))
+        return StreamingResponse(streams[find(stall)].subscribe(last_event_id, rate), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
     @app.get('/wifi.json')
     async def wifi_json():
-        if garage.wifi_scanner is not None and garage.wifi_scanner.cells is not None:
-            return garage.wifi_scanner.cells
+        if wifi_scanner is not None and wifi_scanner.cells is not None:
+            return wifi_scanner.cells
         return None
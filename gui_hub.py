@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import threading
+import time
+
+from nicegui import context, Client
+
+from metrics import REGISTRY
+
+
+class _Subscriber:
+    """The handlers and undelivered values of one browser client."""
+    def __init__(self, client: Client):
+        self.client = client
+        self.handlers = {}  # topic -> list of handler(value)
+        self.pending = {}  # topic -> (value, time published), only the latest value of each topic is kept
+        self.scheduled = False
+
+
+class GuiHub:
+    """Delivers sensor changes to the elements of the web pages that are currently open.
+
+    Sensor threads publish to the hub instead of calling NiceGUI elements themselves.  Every browser client has
+    its own queue that keeps only the latest value of each topic, and it is drained on the event loop, so a
+    publish never blocks on a slow phone and a burst of readings reaches a client as one update.  A client's
+    subscriptions are removed when it disconnects, or on the next publish once NiceGUI has deleted the client without
+    a disconnect, as it does for pages whose websocket never connected.
+
+    Topics published for a garage by connect(): 'door_status', 'distance' and 'temperature'."""
+    def __init__(self):
+        self.subscribers = {}  # client id -> _Subscriber
+        self.lock = threading.Lock()
+        self.event_loop = None
+        self.published = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.lag = REGISTRY.histogram('garage_web_update_lag_seconds',
+                                      'Seconds from publish() until the update was sent to a web page')
+        REGISTRY.gauge('garage_web_subscribers', 'Web pages receiving live updates', lambda: len(self.subscribers))
+        REGISTRY.gauge('garage_web_pending_updates', 'Updates waiting to be sent to web pages',
+                       lambda: sum(len(subscriber.pending) for subscriber in list(self.subscribers.values())))
+
+    def connect(self, garage) -> None:
+        """Publishes the door status, distance and CPU temperature of garage."""
+        garage.door_status.listeners.append(lambda status: self.publish('door_status', status))
+        garage.listeners.append(lambda distance: self.publish('distance', distance))
+        garage.temperature_monitor.listeners.append(lambda temperature: self.publish('temperature', temperature))
+
+    def start(self) -> None:
+        """Remembers the event loop that drains the queues, use as a NiceGUI app.on_startup handler."""
+        self.event_loop = asyncio.get_running_loop()
+
+    def subscribe(self, topic: str, handler) -> None:
+        """Calls handler(value) on the event loop with the latest value of topic while the current page's client
+        is connected.  Must be called while building a page."""
+        client = context.get_client()
+        with self.lock:
+            subscriber = self.subscribers.get(client.id)
+            if subscriber is None:
+                subscriber = _Subscriber(client)
+                self.subscribers[client.id] = subscriber
+                client.on_disconnect(lambda: self.unsubscribe(client))
+            subscriber.handlers.setdefault(topic, []).append(handler)
+
+    def unsubscribe(self, client: Client) -> None:
+        """Removes every subscription of client."""
+        with self.lock:
+            self.subscribers.pop(client.id, None)
+
+    def publish(self, topic: str, value) -> None:
+        """Queues value for every client subscribed to topic, replacing a value that was not delivered yet.  Safe
+        to call from any thread, never blocks on a client."""
+        event_loop = self.event_loop
+        if event_loop is None or event_loop.is_closed():
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.published += 1
+            gone = [client_id for client_id, subscriber in self.subscribers.items()
+                    if Client.instances.get(client_id) is not subscriber.client]
+            for client_id in gone:
+                del self.subscribers[client_id]
+            for subscriber in self.subscribers.values():
+                if topic not in subscriber.handlers:
+                    continue
+                if topic in subscriber.pending:
+                    self.coalesced += 1
+                subscriber.pending[topic] = (value, now)
+                if not subscriber.scheduled:
+                    subscriber.scheduled = True
+                    event_loop.call_soon_threadsafe(self._drain, subscriber)
+
+    def _drain(self, subscriber: _Subscriber) -> None:
+        with self.lock:
+            pending = subscriber.pending
+            subscriber.pending = {}
+            subscriber.scheduled = False
+            if self.subscribers.get(subscriber.client.id) is not subscriber:
+                return
+        now = time.monotonic()
+        with subscriber.client:
+            for topic, (value, published) in pending.items():
+                self.last_lag = now - published
+                self.lag.observe(self.last_lag)
+                self.max_lag = max(self.max_lag, self.last_lag)
+                for handler in subscriber.handlers[topic]:
+                    try:
+                        handler(value)
+                    except Exception:
+                        logging.exception(f'updating web page with {topic}={value} failed')
+                    self.delivered += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            subscribers = len(self.subscribers)
+            subscriptions = sum(len(handlers) for subscriber in self.subscribers.values()
+                                for handlers in subscriber.handlers.values())
+        return {
+            'subscribers': subscribers,
+            'subscriptions': subscriptions,
+            'published': self.published,
+            'delivered': self.delivered,
+            'coalesced': self.coalesced,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag
+        }
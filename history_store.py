@@ -0,0 +1,369 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+_SEGMENT_HEADER = struct.Struct('<4sHHd16x')  # magic, version, points per block, scale
+_BLOCK_HEADER = struct.Struct('<qqiiiqH2x')  # start ms, end ms, first value, min, max, sum, count
+_MAGIC = b'GPHS'
+_VERSION = 1
+_MAX_TIME_DELTA = 0xFFFF  # ms, time deltas are stored as uint16
+_MIN_VALUE_DELTA = -0x8000  # value deltas are stored as int16
+_MAX_VALUE_DELTA = 0x7FFF
+
+
+class Series:
+    """How one measurement is stored in a HistoryStore."""
+    def __init__(self, name: str, scale: float = 1.0, block_points: int = 512, blocks_per_segment: int = 64):
+        """
+        Parameters
+        ----------
+        name - str - name of the series, also the name of its directory
+        scale - float - values are stored as round(value * scale), e.g. 10 keeps one decimal, defaults to 1
+        block_points - int - number of points per block, use few for series that rarely change, defaults to 512
+        blocks_per_segment - int - number of blocks per segment file, defaults to 64
+        """
+        self.name = name
+        self.scale = scale
+        self.block_points = block_points
+        self.blocks_per_segment = blocks_per_segment
+        self.block_size = _BLOCK_HEADER.size + 4 * block_points
+        self.segment_size = _SEGMENT_HEADER.size + self.block_size * blocks_per_segment
+
+
+def default_series() -> list:
+    """Returns the series ControlThread records: distance and strength of the TFmini-S readings, speed, CPU
+    temperature and door status."""
+    return [
+        Series('distance'),
+        Series('strength'),
+        Series('speed', scale=10),
+        Series('cpu_temp', scale=10, block_points=256),
+        Series('door', block_points=16, blocks_per_segment=256)
+    ]
+
+
+class _Block:
+    """A block of up to block_points points: a header with the first value and min, max, sum and count, followed
+    by a column of uint16 millisecond time deltas and a column of int16 value deltas."""
+    def __init__(self, block_points: int):
+        self.time_deltas = array('H', bytes(2 * block_points))
+        self.value_deltas = array('h', bytes(2 * block_points))
+        self.count = 0
+        self.start = 0
+        self.end = 0
+        self.first = 0
+        self.last = 0
+        self.min = 0
+        self.max = 0
+        self.sum = 0
+
+    def add(self, t: int, value: int) -> bool:
+        """Adds a point, returns False if the block is full or the point's deltas do not fit."""
+        if self.count == 0:
+            self.start = self.end = t
+            self.first = self.last = self.min = self.max = self.sum = value
+            self.count = 1
+            return True
+        time_delta = t - self.end
+        value_delta = value - self.last
+        if self.count == len(self.time_deltas) or not 0 <= time_delta <= _MAX_TIME_DELTA or \
+                not _MIN_VALUE_DELTA <= value_delta <= _MAX_VALUE_DELTA:
+            return False
+        self.time_deltas[self.count] = time_delta
+        self.value_deltas[self.count] = value_delta
+        self.count += 1
+        self.end = t
+        self.last = value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.sum += value
+        return True
+
+    def to_bytes(self) -> bytes:
+        return _BLOCK_HEADER.pack(self.start, self.end, self.first, self.min, self.max, self.sum, self.count) + \
+            self.time_deltas.tobytes() + self.value_deltas.tobytes()
+
+
+class _Buckets:
+    """min, max, sum and count of the values in equally sized time buckets."""
+    def __init__(self, start: int, end: int, count: int):
+        self.start = start
+        self.end = end
+        self.width = max((end - start) / count, 1)
+        self.mins = [None] * count
+        self.maxs = [None] * count
+        self.sums = [0] * count
+        self.counts = [0] * count
+
+    def index(self, t: int) -> int:
+        return min(int((t - self.start) / self.width), len(self.counts) - 1)
+
+    def add_summary(self, i: int, minimum: int, maximum: int, total: int, count: int) -> None:
+        if self.counts[i] == 0:
+            self.mins[i] = minimum
+            self.maxs[i] = maximum
+        else:
+            self.mins[i] = min(self.mins[i], minimum)
+            self.maxs[i] = max(self.maxs[i], maximum)
+        self.sums[i] += total
+        self.counts[i] += count
+
+    def add_block(self, start: int, end: int, first: int, minimum: int, maximum: int, total: int, count: int,
+                  time_deltas, value_deltas) -> None:
+        if end < self.start or start >= self.end:
+            return
+        if start >= self.start and end < self.end and self.index(start) == self.index(end):
+            # the whole block falls in one bucket, its header is all that is needed
+            self.add_summary(self.index(start), minimum, maximum, total, count)
+            return
+        times = list(accumulate(time_deltas[1:count], initial=start))
+        values = list(accumulate(value_deltas[1:count], initial=first))
+        i = bisect_left(times, self.start)
+        last = bisect_left(times, self.end)
+        while i < last:
+            # summarize the run of points that fall in the same bucket
+            bucket = self.index(times[i])
+            j = max(bisect_left(times, self.start + (bucket + 1) * self.width, i, last), i + 1)
+            run = values[i:j]
+            self.add_summary(bucket, min(run), max(run), sum(run), j - i)
+            i = j
+
+    def results(self, scale: float) -> list:
+        return [(int(self.start + i * self.width) / 1000, self.mins[i] / scale, self.maxs[i] / scale,
+                 self.sums[i] / self.counts[i] / scale, self.counts[i])
+                for i in range(len(self.counts)) if self.counts[i] > 0]
+
+
+class _SeriesStore:
+    """Segment files of one series.  Full blocks are copied into the memory mapped segment once, the block being
+    filled stays in memory until it is full or flush() is called, so the SD card sees each block written about
+    once, plus once every HistoryStore.flush_interval while it fills, instead of every page being rewritten on each
+    point."""
+    def __init__(self, directory: str, series: Series):
+        self.directory = directory
+        self.series = series
+        self.block = _Block(series.block_points)
+        self.segment = None
+        self.segment_fd = None
+        self.segment_start = None
+        self.segment_blocks = 0
+        self.points = 0
+        self.blocks_written = 0
+        self.unwritten = False  # the block being filled has points that are only in memory
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, t: int, value: int) -> bool:
+        """Adds a point, returns True if a new segment file was started."""
+        self.points += 1
+        self.unwritten = True
+        if self.block.add(t, value):
+            return False
+        new_segment = self._write_block(complete=True)
+        self.block = _Block(self.series.block_points)
+        self.block.add(t, value)
+        return new_segment
+
+    def flush(self) -> None:
+        """Writes the block being filled into its slot without completing it, then flushes the segment to disk."""
+        if not self.unwritten:
+            return
+        self.unwritten = False
+        self._write_block(complete=False)
+        if self.segment is not None:
+            self.segment.flush()
+
+    def _write_block(self, complete: bool) -> bool:
+        if self.block.count == 0:
+            return False
+        new_segment = self.segment is None
+        if new_segment:
+            self._new_segment(self.block.start)
+        offset = _SEGMENT_HEADER.size + self.segment_blocks * self.series.block_size
+        self.segment[offset:offset + self.series.block_size] = self.block.to_bytes()
+        self.blocks_written += 1
+        if complete:
+            self.segment_blocks += 1
+            if self.segment_blocks == self.series.blocks_per_segment:
+                self.close()
+        return new_segment
+
+    def _new_segment(self, start: int) -> None:
+        while os.path.exists(os.path.join(self.directory, f'{start}.seg')):
+            start += 1  # the clock went back, e.g. a Pi without network time after a reboot
+        path = os.path.join(self.directory, f'{start}.seg')
+        # the file is sparse, blocks only take space on the SD card once they are written
+        self.segment_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.segment_fd, self.series.segment_size)
+        self.segment = mmap.mmap(self.segment_fd, self.series.segment_size)
+        self.segment[:_SEGMENT_HEADER.size] = _SEGMENT_HEADER.pack(_MAGIC, _VERSION, self.series.block_points,
+                                                                   self.series.scale)
+        self.segment_start = start
+        self.segment_blocks = 0
+
+    def segments(self) -> list:
+        """Returns the start times in ms of the segment files, oldest first."""
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def query(self, buckets: _Buckets) -> None:
+        starts = self.segments()
+        for i, start in enumerate(starts):
+            if start >= buckets.end or i + 1 < len(starts) and starts[i + 1] <= buckets.start:
+                continue
+            if start == self.segment_start and self.segment is not None:
+                self._query_segment(self.segment, self.segment_blocks, buckets)
+            else:
+                try:
+                    with open(os.path.join(self.directory, f'{start}.seg'), 'rb') as fp:
+                        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+                            self._query_segment(segment, self.series.blocks_per_segment, buckets)
+                except (OSError, ValueError) as e:
+                    # removed by retention or empty, skip it
+                    logging.debug(f'skipping segment {start} of {self.series.name}: {e}')
+        block = self.block
+        if block.count > 0:
+            buckets.add_block(block.start, block.end, block.first, block.min, block.max, block.sum, block.count,
+                              block.time_deltas, block.value_deltas)
+
+    def _query_segment(self, segment, blocks: int, buckets: _Buckets) -> None:
+        magic, version, block_points, scale = _SEGMENT_HEADER.unpack_from(segment, 0)
+        if magic != _MAGIC or version != _VERSION:
+            return
+        block_size = _BLOCK_HEADER.size + 4 * block_points
+        for i in range(blocks):
+            offset = _SEGMENT_HEADER.size + i * block_size
+            if offset + block_size > len(segment):
+                break
+            start, end, first, minimum, maximum, total, count = _BLOCK_HEADER.unpack_from(segment, offset)
+            if count == 0:
+                break
+            if end < buckets.start or start >= buckets.end:
+                continue
+            columns = offset + _BLOCK_HEADER.size
+            time_deltas = memoryview(segment)[columns:columns + 2 * block_points].cast('H')
+            value_deltas = memoryview(segment)[columns + 2 * block_points:columns + 4 * block_points].cast('h')
+            try:
+                buckets.add_block(start, end, first, minimum, maximum, total, count, time_deltas, value_deltas)
+            finally:
+                time_deltas.release()
+                value_deltas.release()
+
+    def expire(self, before: int) -> int:
+        """Removes segment files that only hold points older than before (ms), returns the number removed."""
+        starts = self.segments()
+        removed = 0
+        for start, next_start in zip(starts, starts[1:]):
+            if next_start <= before and start != self.segment_start:
+                os.remove(os.path.join(self.directory, f'{start}.seg'))
+                removed += 1
+        return removed
+
+    def disk_usage(self) -> int:
+        """Returns the number of bytes the segment files take on disk."""
+        return sum(os.stat(os.path.join(self.directory, f'{start}.seg')).st_blocks * 512
+                   for start in self.segments())
+
+    def close(self) -> None:
+        if self.segment is not None:
+            self.segment.flush()
+            self.segment.close()
+            os.close(self.segment_fd)
+            self.segment = None
+            self.segment_start = None
+
+
+class HistoryStore:
+    """Keeps a history of what the garage measures on disk, e.g. a week of distance readings, for graphs.
+
+    Each series is stored in its own directory as memory mapped segment files made of fixed size blocks.  A block
+    holds the time and value deltas of up to block_points points in two columns (a few bytes per point) plus a
+    header with the min, max, sum and count of its values.  query() returns min/max/mean buckets over a time
+    range, using only the block headers for blocks that fall within one bucket, so a week of 10 Hz readings can be
+    charted without loading it all into memory.  Segments older than retention_days are removed as new ones are
+    started.  The block being filled is only in memory until it is full or flush_if_due() finds it has been
+    flush_interval seconds, so a power cut loses at most that much history of each series.
+
+    Values are stored as integers, see Series.scale.  Safe to use from any thread."""
+    def __init__(self, directory: str, series: list = None, retention_days: float = 7.0,
+                 flush_interval: float = 60.0):
+        """
+        Parameters
+        ----------
+        directory - str - directory to store the series in, created if needed
+        series - list(Series) - series to store, defaults to default_series()
+        retention_days - float - number of days of history to keep, defaults to 7
+        flush_interval - float - most seconds points are kept only in memory, see flush_if_due(), defaults to 60
+            seconds
+        """
+        self.directory = directory
+        self.retention_days = retention_days
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.series = {s.name: _SeriesStore(os.path.join(directory, s.name), s)
+                       for s in (series if series is not None else default_series())}
+        self.expire()
+
+    def append(self, name: str, value: float, timestamp: float = None) -> None:
+        """Adds value to series name at timestamp (time.time() seconds, defaults to now)."""
+        store = self.series[name]
+        t = int((timestamp if timestamp is not None else time.time()) * 1000)
+        with self.lock:
+            new_segment = store.append(t, round(value * store.series.scale))
+        if new_segment:
+            self.expire()
+
+    def query(self, name: str, start: float, end: float, buckets: int = 500) -> list:
+        """Returns the values of series name from start to end (time.time() seconds) in buckets equally sized
+        time buckets.
+
+        Returns
+        -------
+        list of (bucket start time, min, max, mean, count) tuples, buckets without values are left out
+        """
+        store = self.series[name]
+        result = _Buckets(int(start * 1000), int(end * 1000), buckets)
+        with self.lock:
+            store.query(result)
+        return result.results(store.series.scale)
+
+    def expire(self) -> None:
+        """Removes history older than retention_days."""
+        before = int((time.time() - self.retention_days * 86400) * 1000)
+        with self.lock:
+            removed = sum(store.expire(before) for store in self.series.values())
+        if removed > 0:
+            logging.info(f'removed {removed} history segments older than {self.retention_days} days')
+
+    def flush_if_due(self) -> None:
+        """Writes the blocks being filled to disk if flush_interval seconds have passed since the last flush."""
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the points that are only in memory to disk."""
+        with self.lock:
+            self.last_flush = time.monotonic()
+            for store in self.series.values():
+                store.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            for store in self.series.values():
+                store.flush()
+                store.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'points': sum(store.points for store in self.series.values()),
+                'blocks_written': sum(store.blocks_written for store in self.series.values()),
+                'disk_usage': sum(store.disk_usage() for store in self.series.values())
+            }
@@ -1,4 +1,8 @@
+import asyncio
+import json
 import logging
+import threading
+import time
 from typing import Callable
 
 from paho import mqtt
@@ -7,10 +11,195 @@ from paho.mqtt.client import MQTTMessage, MQTT_ERR_SUCCESS, Client
 from car_status import CarStatus
 from door_status_thread import DoorStatus
 from home_assistant_controllable import HomeAssistantControllable
+from metrics import REGISTRY, stage_latency
+
+
+class TelemetryEntity:
+    """A Home Assistant sensor fed with readings that change much more often than is worth sending.
+
+    A new value is sent when it differs from the last value sent by more than deadband, but never more often than
+    every min_interval seconds.  The last value is sent again every heartbeat seconds so Home Assistant graphs
+    keep going while nothing changes."""
+    def __init__(self, key: str, component: str, config: dict, prefix: str, deadband: float = 0.0,
+                 min_interval: float = 0.0, heartbeat: float = 300.0, precision: int = 1, suffix: str = ''):
+        """
+        Parameters
+        ----------
+        key - str - name used with HomeAssistant.publish_telemetry(), also part of the topics
+        component - str - home assistant component, 'sensor' or 'binary_sensor'
+        config - dict - discovery config fields such as name, device_class and unit_of_measurement
+        prefix - str - MQTT discovery prefix
+        deadband - float - smallest change worth sending, defaults to 0 meaning any change
+        min_interval - float - minimum seconds between messages, defaults to 0
+        heartbeat - float - seconds after which an unchanged value is sent again, defaults to 300
+        precision - int - number of decimals sent for numbers, defaults to 1
+        suffix - str - appended to the object id in the topics, such as '_left' for the left stall, defaults to ''
+        """
+        self.key = key
+        self.config = config
+        self.config_topic = f'{prefix}/{component}/garage_{key}{suffix}/config'
+        self.state_topic = f'{prefix}/{component}/garage_{key}{suffix}/state'
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+        self.precision = precision
+        self.last_value = None
+        self.last_sent = 0.0
+
+    def payload(self, value, now: float):
+        """Returns the payload to send for value now, or None if it should not be sent."""
+        elapsed = now - self.last_sent
+        if self.last_value is not None and elapsed < self.heartbeat:
+            if elapsed < self.min_interval:
+                return None
+            if isinstance(value, bool) or self.deadband <= 0:
+                if value == self.last_value:
+                    return None
+            elif abs(value - self.last_value) <= self.deadband:
+                return None
+        self.last_value = value
+        self.last_sent = now
+        if isinstance(value, bool):
+            return 'ON' if value else 'OFF'
+        return f'{value:.{self.precision}f}'
+
+
+def default_telemetry(prefix: str, suffix: str = '') -> list:
+    """Returns the telemetry entities ControlThread publishes to, suffix tells the entities of stalls apart."""
+    return [
+        TelemetryEntity('current_distance', 'sensor', {
+            'name': 'Car Distance', 'device_class': 'distance', 'unit_of_measurement': 'cm',
+            'state_class': 'measurement'
+        }, prefix, deadband=2.0, min_interval=1.0, precision=0, suffix=suffix),
+        TelemetryEntity('car_speed', 'sensor', {
+            'name': 'Car Speed', 'unit_of_measurement': 'cm/s', 'state_class': 'measurement', 'icon': 'mdi:speedometer'
+        }, prefix, deadband=5.0, min_interval=1.0, suffix=suffix),
+        TelemetryEntity('cpu_temp', 'sensor', {
+            'name': 'CPU Temperature', 'device_class': 'temperature', 'unit_of_measurement': '°C',
+            'state_class': 'measurement', 'entity_category': 'diagnostic'
+        }, prefix, deadband=0.5, min_interval=10.0, suffix=suffix),
+        TelemetryEntity('wifi_found', 'binary_sensor', {
+            'name': 'Car Wifi', 'device_class': 'presence'
+        }, prefix, suffix=suffix),
+    ]
+
+
+class MqttConnection:
+    """The one connection to the MQTT server that the HomeAssistant of every stall publishes on.
+
+    Each HomeAssistant adds its on_connect handler with add_connect_handler(), they are all called after every
+    (re)connect, and routes the commands of its own topics to itself with message_callback_add().  start() connects
+    and services the connection from paho's network thread, run_async() from the running asyncio event loop."""
+    def __init__(self, mqtt_server: str = 'homeassistant.local', mqtt_port: int = 1883, mqtt_username: str = None,
+                 mqtt_password: str = None, client_id: str = 'garage-pi'):
+        """
+        Parameters
+        ----------
+        mqtt_server - str - MQTT server to connect to, defaults to 'homeassistant.local'
+        mqtt_port - int - port of the MQTT server, defaults to 1883
+        mqtt_username - str - username to login to MQTT server with, defaults to None meaning no user/password required
+        mqtt_password - str - password needed to login to MQTT server, defaults to None meaning no password needed
+        client_id - str - MQTT client identifier, defaults to 'garage-pi'
+        """
+        self.mqtt_server = mqtt_server
+        self.mqtt_port = mqtt_port
+        self.running = False
+        self.event_loop = None
+        self.connect_handlers = []
+        self.client = Client(client_id=client_id, userdata=self)
+        if mqtt_username is not None and mqtt_password is not None:
+            self.client.username_pw_set(mqtt_username, password=mqtt_password)
+        self.client.on_connect = self._on_connect
+
+    def add_connect_handler(self, handler: Callable) -> None:
+        """Calls handler(client, userdata, flags, rc) after every (re)connect."""
+        self.connect_handlers.append(handler)
+
+    def _on_connect(self, client: Client, userdata, flags, rc):
+        for handler in self.connect_handlers:
+            handler(client, userdata, flags, rc)
+
+    def start(self) -> None:
+        """Connects and services the connection from paho's network thread, disables MQTT if connecting fails."""
+        try:
+            self.client.connect(self.mqtt_server, self.mqtt_port)
+            self.client.loop_start()
+        except IOError as error:
+            logging.warning(f'unable to connect to MQTT at {self.mqtt_server}, MQTT disabled', error)
+            self.client = None
+
+    async def run_async(self, executor=None, reconnect_delay: float = 5.0):
+        """Connects to MQTT and services the connection from the running asyncio event loop instead of paho's
+        network thread, reconnecting after reconnect_delay seconds whenever the connection is lost.
+
+        Parameters
+        ----------
+        executor - concurrent.futures.Executor - executor for the blocking connect, None uses the loop's default
+        reconnect_delay - float - seconds to wait before connecting again, defaults to 5 seconds
+        """
+        if self.client is None:
+            return
+        event_loop = asyncio.get_running_loop()
+        self.event_loop = event_loop
+        client = self.client
+        # paho calls these from whichever thread is using the client, the event loop must only be changed from its
+        # own thread
+        client.on_socket_open = lambda c, userdata, sock: \
+            event_loop.call_soon_threadsafe(event_loop.add_reader, sock, client.loop_read)
+        client.on_socket_close = lambda c, userdata, sock: \
+            event_loop.call_soon_threadsafe(event_loop.remove_reader, sock)
+        client.on_socket_register_write = lambda c, userdata, sock: \
+            event_loop.call_soon_threadsafe(event_loop.add_writer, sock, client.loop_write)
+        client.on_socket_unregister_write = lambda c, userdata, sock: \
+            event_loop.call_soon_threadsafe(event_loop.remove_writer, sock)
+        self.running = True
+        connected_once = False
+        while self.running:
+            try:
+                if connected_once:
+                    await event_loop.run_in_executor(executor, client.reconnect)
+                else:
+                    await event_loop.run_in_executor(executor, client.connect, self.mqtt_server, self.mqtt_port)
+                    connected_once = True
+                while self.running and client.loop_misc() == MQTT_ERR_SUCCESS:
+                    await asyncio.sleep(1.0)
+            except IOError as error:
+                logging.warning(f'unable to connect to MQTT at {self.mqtt_server}, retrying: {error}')
+            if self.running:
+                await asyncio.sleep(reconnect_delay)
+
+    def shutdown(self):
+        self.running = False
+        client = self.client
+        if client is None:
+            return
+        event_loop = self.event_loop
+        if event_loop is not None and event_loop.is_closed():
+            self._forget_event_loop()  # too late to remove the socket from it, it is gone
+        # while the event loop still runs, so it stops watching the socket
+        client.disconnect()
+        client.loop_stop()
+        # paho closes the socket again when the client is garbage collected, long after the loop was closed
+        self._forget_event_loop()
+
+    def _forget_event_loop(self) -> None:
+        client = self.client
+        client.on_socket_open = None
+        client.on_socket_close = None
+        client.on_socket_register_write = None
+        client.on_socket_unregister_write = None
 
 
 class HomeAssistant:
-    """Encapsulates the garage door's interactions with Home Assistant in one location."""
+    """Encapsulates the garage door's interactions with Home Assistant in one location.
+
+    State is only published when it changes.  The last payload sent on each topic is remembered and identical
+    payloads are suppressed.  Changes that arrive within coalesce_window seconds of the last publication are
+    held back and only the latest value of each topic is sent when the window ends.  All state is sent again
+    after (re)connecting.
+
+    Every stall of a garage run by one process has its own HomeAssistant with its own device and entities, the
+    topics and unique ids of a stall end in _<stall>, and they all share one MqttConnection."""
     def __init__(self,
                  garage: HomeAssistantControllable,
                  mqtt_server: str = 'homeassistant.local',
@@ -20,7 +209,14 @@ class HomeAssistant:
                  mqtt_username: str = None,
                  mqtt_password: str = None,
                  max_distance: float = 390,
-                 on_connect : Callable = None):
+                 on_connect : Callable = None,
+                 connect: bool = True,
+                 coalesce_window: float = 0.25,
+                 json_state: bool = False,
+                 telemetry: bool = True,
+                 mqtt_port: int = 1883,
+                 connection: MqttConnection = None,
+                 stall: str = None):
         """
         Parameters
         ----------
@@ -33,103 +229,240 @@ class HomeAssistant:
         mqtt_password - str - password needed to login to MQTT server, defaults to None meaning no password needed
         max_distance - int - maximum distance in centimeters for TFMiniS, defaults to 390 cm
         on_connect - Callable - this function is called after successfully connecting to Home Assistant server
+        connect - bool - True to connect now and use paho's network thread, False leaves connecting to run_async(),
+            defaults to True
+        coalesce_window - float - minimum seconds between publications, changes in between are merged, defaults
+            to 0.25 seconds
+        json_state - bool - True to publish door, car and park distance state as one JSON message that the
+            entities read with value templates and the cover also uses for its attributes, defaults to False
+        telemetry - bool - True to add distance, speed, CPU temperature and Wifi presence sensors, see
+            publish_telemetry(), defaults to True
+        mqtt_port - int - port of the MQTT server, defaults to 1883
+        connection - MqttConnection - connection shared with other stalls, whoever created it starts and shuts it
+            down, defaults to None meaning this HomeAssistant connects to mqtt_server on its own
+        stall - str - name of the stall added to the topics and unique ids, defaults to None for a single stall
         """
         self.garage = garage
         self.on_connect = on_connect
-        if mqtt_server is not None:
-            self.mqtt_server = mqtt_server
+        self.coalesce_window = coalesce_window
+        self.json_state = json_state
+        self.event_loop = None
+        self.lock = threading.Lock()
+        self.state = {}  # topic -> latest payload
+        self.last_published = {}  # topic -> payload last sent to the broker
+        self.pending = {}  # topic -> payload waiting for the end of the coalesce window
+        self.last_flush = 0.0
+        self.flush_scheduled = False
+        self.messages_sent = 0
+        self.messages_suppressed = 0
+        self.messages_coalesced = 0
+        self.mqtt_latency = stage_latency('mqtt')
+        REGISTRY.gauge('garage_mqtt_pending_messages', 'State changes waiting for the end of the coalesce window',
+                       lambda: len(self.pending))
+        for name in ('sent', 'suppressed', 'coalesced'):
+            REGISTRY.counter('garage_mqtt_messages_total', 'MQTT messages by what happened to them',
+                             lambda name=name: getattr(self, f'messages_{name}'), outcome=name)
+        self.owns_connection = connection is None and mqtt_server is not None
+        if self.owns_connection:
+            connection = MqttConnection(mqtt_server, mqtt_port, mqtt_username, mqtt_password)
+        self.connection = connection
+        if connection is not None:
+            self.mqtt_server = connection.mqtt_server
+            self.suffix = f'_{stall}' if stall is not None else ''
             self.mqtt_discovery_prefix = mqtt_discovery_prefix
+            self.json_state_topic = f'{mqtt_discovery_prefix}/garage_door/{mqtt_device_id}/state'
             self.mqtt_device_id = mqtt_device_id
             self.mqtt_device_name = mqtt_device_name
             self.max_distance = max_distance
-            self.mqtt_client = Client(client_id="garage-pi", userdata=self)
-            if mqtt_username is not None and mqtt_password is not None:
-                self.mqtt_client.username_pw_set(mqtt_username, password=mqtt_password)
-            self.mqtt_client.on_message = self._on_mqtt_message
-            self.mqtt_client.on_connect = self._on_mqtt_connect
-            try:
-                self.mqtt_client.connect(mqtt_server)
-                self.mqtt_client.loop_start()
-            except IOError as error:
-                logging.warning(f'unable to connect to MQTT at {mqtt_server}, MQTT disabled', error)
-                self.mqtt_client = None
+            # Store command topics for later use in _on_mqtt_connect and _on_mqtt_message
+            self.garage_button_command_topic = \
+                f'{self.mqtt_discovery_prefix}/button/garage_door{self.suffix}/commands'
+            self.park_distance_command_topic = \
+                f'{self.mqtt_discovery_prefix}/number/garage_park_distance{self.suffix}/set'
+            self.telemetry = {entity.key: entity for entity in
+                              (default_telemetry(mqtt_discovery_prefix, self.suffix) if telemetry else [])}
+            self.discovery = self._discovery_messages()
+            connection.add_connect_handler(self._on_mqtt_connect)
+            for topic in (self.garage_button_command_topic, self.park_distance_command_topic):
+                connection.client.message_callback_add(topic, self._on_mqtt_message)
+            if self.owns_connection and connect:
+                connection.start()
         else:
-            self.mqtt_client = None
-        # Store command topics for later use in _on_mqtt_connect and _on_mqtt_message
-        self.garage_button_command_topic = f'{self.mqtt_discovery_prefix}/button/garage_door/commands'
-        self.park_distance_command_topic = f'{self.mqtt_discovery_prefix}/number/garage_park_distance/set'
+            self.telemetry = {}
+
+    @property
+    def mqtt_client(self):
+        """The paho client to publish on, None if MQTT is disabled or connecting failed."""
+        return self.connection.client if self.connection is not None else None
 
 
     def publish(self, door_status: DoorStatus, car_status: CarStatus, park_distance: float):
-        """Sends the current status of this garage device to home assistant."""
-        if self.mqtt_client is not None:
-            self.mqtt_client.publish(f'{self.mqtt_discovery_prefix}/cover/garage_door/state',
-                                     door_status.ha_status(), retain=True)
-            self.mqtt_client.publish(f'{self.mqtt_discovery_prefix}/binary_sensor/car_presence/state',
-                                     'ON' if car_status == CarStatus.PARKED else 'OFF', retain=True)
+        """Sends the current status of this garage device to home assistant if it changed."""
+        if self.mqtt_client is None:
+            return
+        if self.json_state:
+            state = {
+                'door': door_status.ha_status(),
+                'car_presence': 'ON' if car_status == CarStatus.PARKED else 'OFF',
+                'car_status': car_status.name
+            }
+            if park_distance is not None:
+                state['park_distance'] = park_distance
+            self._queue(self.json_state_topic, json.dumps(state, sort_keys=True))
+        else:
+            self._queue(f'{self.mqtt_discovery_prefix}/cover/garage_door{self.suffix}/state',
+                        door_status.ha_status())
+            self._queue(f'{self.mqtt_discovery_prefix}/binary_sensor/car_presence{self.suffix}/state',
+                        'ON' if car_status == CarStatus.PARKED else 'OFF')
             if park_distance is not None:
-                self.mqtt_client.publish(f'{self.mqtt_discovery_prefix}/number/garage_park_distance/state',
-                                         str(park_distance), retain=True)
+                self._queue(f'{self.mqtt_discovery_prefix}/number/garage_park_distance{self.suffix}/state',
+                            str(park_distance))
+        self._flush_or_schedule()
+
+    def _queue(self, topic: str, payload: str):
+        with self.lock:
+            self.state[topic] = payload
+            if topic in self.pending:
+                if self.last_published.get(topic) == payload:
+                    # changed and changed back before it was sent, nothing needs to be sent
+                    del self.pending[topic]
+                    self.messages_suppressed += 1
+                elif self.pending[topic] != payload:
+                    self.pending[topic] = payload
+                    self.messages_coalesced += 1
+                else:
+                    self.messages_suppressed += 1
+            elif self.last_published.get(topic) == payload:
+                self.messages_suppressed += 1
+            else:
+                self.pending[topic] = payload
+
+    def _flush_or_schedule(self):
+        with self.lock:
+            if not self.pending or self.flush_scheduled:
+                return
+            delay = self.last_flush + self.coalesce_window - time.monotonic()
+            if delay > 0:
+                self.flush_scheduled = True
+        if delay <= 0:
+            self.flush()
+        elif self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self.event_loop.call_later, delay, self.flush)
+        else:
+            timer = threading.Timer(delay, self.flush)
+            timer.daemon = True
+            timer.start()
+
+    def flush(self):
+        """Sends every pending change now."""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.flush_scheduled = False
+            self.last_flush = time.monotonic()
+            self.last_published.update(pending)
+        if self.mqtt_client is not None:
+            for topic, payload in pending.items():
+                self.mqtt_client.publish(topic, payload, retain=True)
+                self.messages_sent += 1
+
+    def publish_telemetry(self, key: str, value, received: float = None) -> None:
+        """Sends a sensor reading to home assistant if the telemetry entity for key lets it through.  Call this
+        as often as new values are available, the entity's deadband, rate limit and heartbeat decide what is sent.
+        received is the time.monotonic() the reading arrived from the sensor, if given the time until it was handed
+        to the MQTT client is recorded as the 'mqtt' stage latency."""
+        entity = self.telemetry.get(key)
+        if entity is None or self.mqtt_client is None:
+            return
+        payload = entity.payload(value, time.monotonic())
+        if payload is None:
+            self.messages_suppressed += 1
+            return
+        self.mqtt_client.publish(entity.state_topic, payload)
+        self.messages_sent += 1
+        if received is not None:
+            self.mqtt_latency.observe(time.monotonic() - received)
+
+    def stats(self) -> dict:
+        return {
+            'messages_sent': self.messages_sent,
+            'messages_suppressed': self.messages_suppressed,
+            'messages_coalesced': self.messages_coalesced
+        }
+
+    def _discovery_messages(self) -> list:
+        """Returns (topic, payload) of every entity's discovery config, built once because they never change."""
+        prefix = self.mqtt_discovery_prefix
+        suffix = self.suffix
+        device = {
+            'identifiers': [self.mqtt_device_id],
+            'name': self.mqtt_device_name
+        }
+
+        def state(field: str, topic: str) -> dict:
+            if self.json_state:
+                return {'state_topic': self.json_state_topic, 'value_template': f'{{{{ value_json.{field} }}}}'}
+            return {'state_topic': topic}
+
+        configs = [
+            (f'{prefix}/cover/garage_door{suffix}/config', {
+                'uniq_id': f'mqtt_cover.garage_door{suffix}',
+                'name': 'Garage Door',
+                'device_class': 'garage',
+                **state('door', f'{prefix}/cover/garage_door{suffix}/state'),
+                **({'json_attributes_topic': self.json_state_topic} if self.json_state else {}),
+                'unique_id': f'garagedoor{self.mqtt_device_id}',
+                'device': device
+            }),
+            (f'{prefix}/binary_sensor/car_presence{suffix}/config', {
+                'uniq_id': f'mqtt_binary_sensor.garage_car_presence{suffix}',
+                'name': 'Car Presence',
+                'device_class': 'presence',
+                **state('car_presence', f'{prefix}/binary_sensor/car_presence{suffix}/state'),
+                'unique_id': f'carpresence{self.mqtt_device_id}',
+                'device': device
+            }),
+            (f'{prefix}/button/garage_door{suffix}/config', {
+                'uniq_id': f'mqtt_button.garage_button{suffix}',
+                'name': 'Garage Button',
+                'command_topic': self.garage_button_command_topic,
+                'unique_id': f'garagebutton{self.mqtt_device_id}',
+                'device': device
+            }),
+            (f'{prefix}/number/garage_park_distance{suffix}/config', {
+                'uniq_id': f'mqtt_binary_sensor.garage_park_distance{suffix}',
+                'name': 'Car Park Distance',
+                'command_topic': self.park_distance_command_topic,
+                'device_class': 'distance',
+                **state('park_distance', f'{prefix}/number/garage_park_distance{suffix}/state'),
+                'unique_id': f'parkdistance{self.mqtt_device_id}',
+                'min': 0.0,
+                'max': self.max_distance,
+                'step': 1.0,
+                'retain': 'true',
+                'unit_of_measurement': 'cm',
+                'device': device
+            })
+        ]
+        for entity in self.telemetry.values():
+            configs.append((entity.config_topic, {
+                **entity.config,
+                'unique_id': f'{entity.key.replace("_", "")}{self.mqtt_device_id}',
+                'state_topic': entity.state_topic,
+                'device': device
+            }))
+        return [(topic, json.dumps(config)) for topic, config in configs]
 
     def _on_mqtt_connect(self, client: Client, userdata, flags, rc):
         """This is called after connecting with homeassistant MQTT.  It configures the entities that are used
         for communicating with home assistant."""
-        #         mqtt_discovery_prefix - str - prefix for mqtt topic so that homeassistant can see it, defaults to 'homeassistant'
-        #         mqtt_device_id - str - device identifier to use in publications to MQTT, defaults to '01ad'
-        #         mqtt_device_name - str - device name to use in publications to MQTT, defaults to 'Garage Door'
-        client.publish(f'{self.mqtt_discovery_prefix}/cover/garage_door/config',
-                       f'{{ '
-                       f'  "uniq_id": "mqtt_cover.garage_door",'
-                       f'  "name": "Garage Door", '
-                       f'  "device_class": "garage", '
-                       f'  "state_topic": "{self.mqtt_discovery_prefix}/cover/garage_door/state",'
-                       f'  "unique_id": "garagedoor{self.mqtt_device_id}",'
-                       f'  "device": {{ '
-                       f'    "identifiers" : ["{self.mqtt_device_id}"], '
-                       f'    "name": "{self.mqtt_device_name}" '
-                       f'  }}'
-                       f'}}')
-        client.publish(f'{self.mqtt_discovery_prefix}/binary_sensor/car_presence/config',
-                       f'{{ '
-                       f'  "uniq_id": "mqtt_binary_sensor.garage_car_presence",'
-                       f'  "name": "Car Presence", '
-                       f'  "device_class": "presence", '
-                       f'  "state_topic": "{self.mqtt_discovery_prefix}/binary_sensor/car_presence/state",'
-                       f'  "unique_id": "carpresence{self.mqtt_device_id}",'
-                       f'  "device": {{ '
-                       f'    "identifiers" : ["{self.mqtt_device_id}"], '
-                       f'    "name": "{self.mqtt_device_name}" '
-                       f'  }}'
-                       f'}}')
-        client.publish(f'{self.mqtt_discovery_prefix}/button/garage_door/config',
-                       f'{{ '
-                       f'  "uniq_id": "mqtt_button.garage_button",'
-                       f'  "name": "Garage Button", '
-                       f'  "command_topic": "{self.garage_button_command_topic}",'
-                       f'  "unique_id": "garagebutton{self.mqtt_device_id}",'
-                       f'  "device": {{ '
-                       f'    "identifiers" : ["{self.mqtt_device_id}"], '
-                       f'    "name": "{self.mqtt_device_name}" '
-                       f'  }}'
-                       f'}}')
-        client.publish(f'{self.mqtt_discovery_prefix}/number/garage_park_distance/config',
-                       f'{{ '
-                       f'  "uniq_id": "mqtt_binary_sensor.garage_park_distance",'
-                       f'  "name": "Car Park Distance", '
-                       f'  "command_topic": "{self.park_distance_command_topic}",'
-                       f'  "device_class": "distance", '
-                       f'  "state_topic": "{self.mqtt_discovery_prefix}/number/garage_park_distance/state",'
-                       f'  "unique_id": "parkdistance{self.mqtt_device_id}",'
-                       f'  "min": 0.0,'
-                       f'  "max": {self.max_distance},'
-                       f'  "step": 1.0,'
-                       f'  "retain": "true",'
-                       f'  "unit_of_measurement": "cm",'
-                       f'  "device": {{ '
-                       f'    "identifiers" : ["{self.mqtt_device_id}"], '
-                       f'    "name": "{self.mqtt_device_name}" '
-                       f'  }}'
-                       f'}}')
+        for topic, payload in self.discovery:
+            client.publish(topic, payload)
+        # the broker may have lost the retained state, send all of it again
+        with self.lock:
+            self.last_published.clear()
+            self.pending.update(self.state)
+        self.flush()
         if self.on_connect is not None:
             self.on_connect()
         result, _ = client.subscribe(f'{self.garage_button_command_topic}', qos=0)
@@ -152,6 +485,13 @@ class HomeAssistant:
         elif message.topic == f'{self.park_distance_command_topic}':
             self.garage.set_park_distance(float(command))
 
+    async def run_async(self, executor=None) -> None:
+        """Makes the coalesce window use the running asyncio event loop and services the MQTT connection from it
+        if this stall owns the connection, see MqttConnection.run_async()."""
+        self.event_loop = asyncio.get_running_loop()
+        if self.owns_connection:
+            await self.connection.run_async(executor)
+
     def shutdown(self):
-        if self.mqtt_client is not None:
-            self.mqtt_client.loop_stop()
+        if self.owns_connection:
+            self.connection.shutdown()
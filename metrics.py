@@ -0,0 +1,134 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# seconds, from a fast step() to a missed MQTT connection
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labels(labels: dict, extra: str = None) -> str:
+    pairs = [f'{name}="{value}"' for name, value in sorted(labels.items())]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """Counts observations in fixed buckets.  observe() is a bisect and two additions, cheap enough to call for
+    every reading.  Each histogram is meant to be observed from one thread, so it takes no lock."""
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket holding the q quantile, e.g. 0.95, or None if nothing was observed."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """Metrics exported in the Prometheus text format by render(), see the /metrics route in gui.create_pages.
+
+    Histograms are created once by the code that observes them.  Gauges and counters are functions that are called
+    when the metrics are rendered, so values that are already kept somewhere, such as queue lengths and message
+    counters, cost nothing until they are scraped.
+
+    Metrics registered inside a labelled() block get its labels as well, so the same metrics of different stalls
+    do not replace each other."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}  # name -> (type, help, {labels tuple -> histogram or function})
+        self.default_labels = {}
+
+    @contextmanager
+    def labelled(self, **labels):
+        """Adds labels, such as stall='left', to every metric registered in the with block."""
+        previous = self.default_labels
+        self.default_labels = {**previous, **labels}
+        try:
+            yield self
+        finally:
+            self.default_labels = previous
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(sorted({**self.default_labels, **labels}.items()))
+
+    def _family(self, name: str, kind: str, help_text: str) -> dict:
+        family = self.families.get(name)
+        if family is None:
+            family = (kind, help_text, {})
+            self.families[name] = family
+        return family[2]
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        """Returns the histogram with the given name and labels, creating it the first time."""
+        key = self._key(labels)
+        with self.lock:
+            members = self._family(name, 'histogram', help_text)
+            if key not in members:
+                members[key] = Histogram(buckets)
+            return members[key]
+
+    def gauge(self, name: str, help_text: str, function, **labels) -> None:
+        """Exports the value function() returns when rendered, replacing a function registered with the same
+        labels."""
+        with self.lock:
+            self._family(name, 'gauge', help_text)[self._key(labels)] = function
+
+    def counter(self, name: str, help_text: str, function, **labels) -> None:
+        """Same as gauge() for values that only go up."""
+        with self.lock:
+            self._family(name, 'counter', help_text)[self._key(labels)] = function
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            families = [(name, kind, help_text, list(members.items()))
+                        for name, (kind, help_text, members) in sorted(self.families.items())]
+        for name, kind, help_text, members in families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, member in members:
+                labels = dict(key)
+                if kind == 'histogram':
+                    total = 0
+                    for bound, count in zip(member.buckets, member.counts):
+                        total += count
+                        le = _labels(labels, f'le="{bound}"')
+                        lines.append(f'{name}_bucket{le} {total}')
+                    le = _labels(labels, 'le="+Inf"')
+                    lines.append(f'{name}_bucket{le} {member.count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {member.sum}')
+                    lines.append(f'{name}_count{_labels(labels)} {member.count}')
+                else:
+                    try:
+                        value = member()
+                    except Exception:
+                        continue
+                    if value is not None:
+                        lines.append(f'{name}{_labels(labels)} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def stage_latency(stage: str) -> Histogram:
+    """Returns the histogram of the seconds a reading takes from arriving on the serial port to the end of stage."""
+    return REGISTRY.histogram('garage_stage_latency_seconds',
+                              'Seconds from a TFmini-S reading arriving on the serial port to the end of a stage',
+                              stage=stage)
@@ -1,9 +1,10 @@
-import logging
-
-import board
-import neopixel
+import threading
 import time
 from base_thread import BaseThread
+from metrics import stage_latency
+
+OFF = (0, 0, 0)
+RED = (255, 0, 0)
 
 
 def mapval(x, in_min, in_max, out_min, out_max):
@@ -17,14 +18,52 @@ def mapval(x, in_min, in_max, out_min, out_max):
 
 
 class NeoPixelDisplayThread(BaseThread):
-    def __init__(self, color = (255, 255, 0), pin = board.D21, num_pixels = 60,
-                 park_distance = 100, max_distance = 390):
+    """Shows the distance to the park spot on the NeoPixel strip.
+
+    Every frame the strip can show (each bullseye size, standby, solid red and off) is built once as the bytes
+    that are sent to the strip.  A frame is only sent when it differs from the last one sent, because bit-banging
+    the strip takes interrupt sensitive time on the Pi that the TFmini-S serial port also needs."""
+    def __init__(self, color = (255, 255, 0), pin = None, num_pixels = 60,
+                 park_distance = 100, max_distance = 390, brightness = 0.6, pixels = None, write = None):
+        """
+        Parameters
+        ----------
+        color - tuple(int) - (r, g, b) color of the bullseye, defaults to yellow
+        pin - board.Pin - pin the strip is connected to, defaults to board.D21
+        num_pixels - int - number of pixels on the strip, defaults to 60
+        park_distance - int - distance in centimeters the car should park at, defaults to 100
+        max_distance - int - distance in centimeters at which the bullseye starts, defaults to 390
+        brightness - float - 0.0 to 1.0, defaults to 0.6
+        pixels - neopixel.NeoPixel - strip to draw on instead of creating one on pin, it only needs pin and byteorder
+        write - function(pin, bytes) - sends a frame to the strip, defaults to neopixel_write
+        """
         super(NeoPixelDisplayThread, self).__init__()
-        self.pixels = neopixel.NeoPixel(pin, num_pixels, auto_write=False, brightness=0.6)
-        self.pixels.fill((0,0,0))
-        self.pixels.show()
+        # the Adafruit libraries refuse to import anywhere but on a Pi, so they are only imported when needed
+        if pixels is None:
+            import board
+            import neopixel
+            pixels = neopixel.NeoPixel(pin if pin is not None else board.D21, num_pixels, auto_write=False,
+                                       brightness=brightness)
+        if write is None:
+            from neopixel_write import neopixel_write as write
+        self.pixels = pixels
+        self.write = write
         self.num_pixels = num_pixels
         self.color = color
+        self.brightness = brightness
+        self.frames_rendered = 0
+        self.frames_skipped = 0
+        self.last_frame = None
+        self.received = None
+        self.led_latency = stage_latency('led')
+        # bullseye_frames[n] lights n pixels from each end of the strip
+        self.bullseye_frames = [self._frame([color if i < n or i >= num_pixels - n else OFF
+                                             for i in range(num_pixels)])
+                                for n in range(num_pixels // 2 + 1)]
+        self.off_frame = self.bullseye_frames[0]
+        self.standby_frame = self.bullseye_frames[1]
+        self.red_frame = self._frame([RED] * num_pixels)
+        self.show(self.off_frame)
         self.park_distance = park_distance
         self.backup_factor = 0.5
         self.max_distance = max_distance
@@ -35,26 +74,47 @@ class NeoPixelDisplayThread(BaseThread):
         self.rate = 0
         self.parked = False
 
-    def set_reading(self, distance, speed):
+    def _frame(self, colors: list) -> bytes:
+        """Returns the bytes to send to the strip for the given list of (r, g, b) colors, same as NeoPixel.show()."""
+        frame = bytearray()
+        for r, g, b in colors:
+            values = {'R': int(r * self.brightness), 'G': int(g * self.brightness), 'B': int(b * self.brightness),
+                      'W': 0}
+            frame.extend(values[c] for c in self.pixels.byteorder)
+        return bytes(frame)
+
+    def show(self, frame: bytes, force: bool = False) -> None:
+        """Sends frame to the strip unless it is already showing it."""
+        if frame is self.last_frame and not force:
+            self.frames_skipped += 1
+            self.received = None  # the strip already shows this reading
+            return
+        self.write(self.pixels.pin, frame)
+        self.last_frame = frame
+        self.frames_rendered += 1
+        if self.received is not None:
+            self.led_latency.observe(time.monotonic() - self.received)
+            self.received = None
+
+    def stats(self) -> dict:
+        return {'frames_rendered': self.frames_rendered, 'frames_skipped': self.frames_skipped}
+
+    def set_reading(self, distance, speed, received: float = None):
+        """Shows distance and speed, received is the time.monotonic() the reading arrived from the TFmini-S."""
         self.distance = distance
         self.speed = speed
+        self.received = received
+        self.notify()
     
     def bullseye(self):
         pixel_count = int(mapval(self.distance, self.max_distance, self.park_distance, 0, self.num_pixels/2))
-        logging.debug(f'distance={self.distance} max={self.max_distance} min={self.park_distance} pixel_count={pixel_count}')
-        self.pixels.fill((0,0,0))
-        for i in range(0, pixel_count):
-            self.pixels[i] = self.color
-            self.pixels[self.num_pixels - i - 1] = self.color
-        self.pixels.show()
+        self.show(self.bullseye_frames[pixel_count])
         
     def standby(self):
-        self.pixels.fill((0,0,0))
-        self.pixels[0] = self.color
-        self.pixels[self.num_pixels-1] = self.color
-        self.pixels.show()
+        self.show(self.standby_frame)
         
-    def loop(self):
+    def step(self):
+        blinking = False
         if abs(self.speed) < 2.0:
             self.standby()
             if self.park_distance >= self.distance >= self.park_distance * self.backup_factor:
@@ -63,6 +123,7 @@ class NeoPixelDisplayThread(BaseThread):
                 self.parked = True
         elif self.distance < self.park_distance * self.backup_factor:
             self.blink()
+            blinking = True
             self.parked = False
         elif self.distance > self.park_distance:
             self.bullseye()
@@ -70,23 +131,70 @@ class NeoPixelDisplayThread(BaseThread):
         else:
             self.park_here()
             self.parked = True
-        time.sleep(0.1)
+        # nothing changes on the strip until the next reading unless it is blinking
+        return (self.last_blink + 500 - int(time.time() * 1000) + 1) / 1000 if blinking else None
             
     def blink(self):
         now = int(time.time() * 1000)
         if now > self.last_blink + 500:
             self.blink_is_on = not self.blink_is_on
             self.last_blink = now
-        if self.blink_is_on:
-            self.pixels.fill((255,0,0))
-        else:
-            self.pixels.fill((0,0,0))
-        self.pixels.show()
+        self.show(self.red_frame if self.blink_is_on else self.off_frame)
         
     def park_here(self):
-        self.pixels.fill((255,0,0))
-        self.pixels.show()
+        self.show(self.red_frame)
         
     def shutdown(self):
         super().shutdown()
-        self.pixels.fill((0,0,0))        
+        self.show(self.off_frame, force=True)
+
+
+class NeoPixelStrip:
+    """One NeoPixel strip split into segments, one per stall of a garage run by one process.
+
+    Each stall's NeoPixelDisplayThread draws on its own segment as if it were a strip of its own: pass pixels as its
+    pixels and segment() as its write.  A segment's frame is copied into the frame of the whole strip, which is
+    then sent, so a segment that does not change keeps showing what it showed."""
+    def __init__(self, pin = None, num_pixels = 60, brightness = 0.6, pixels = None, write = None):
+        """
+        Parameters
+        ----------
+        pin - board.Pin - pin the strip is connected to, defaults to board.D21
+        num_pixels - int - number of pixels on the whole strip, defaults to 60
+        brightness - float - 0.0 to 1.0, defaults to 0.6
+        pixels - neopixel.NeoPixel - strip to draw on instead of creating one on pin, it only needs pin and byteorder
+        write - function(pin, bytes) - sends a frame to the strip, defaults to neopixel_write
+        """
+        if pixels is None:
+            import board
+            import neopixel
+            pixels = neopixel.NeoPixel(pin if pin is not None else board.D21, num_pixels, auto_write=False,
+                                       brightness=brightness)
+        if write is None:
+            from neopixel_write import neopixel_write as write
+        self.pixels = pixels
+        self.write = write
+        self.num_pixels = num_pixels
+        self.bytes_per_pixel = len(pixels.byteorder)
+        self.frame = bytearray(num_pixels * self.bytes_per_pixel)
+        self.lock = threading.Lock()
+        self.segments = []  # (first pixel, number of pixels)
+
+    def segment(self, first_pixel: int, num_pixels: int):
+        """Returns the write function of the num_pixels pixels starting at first_pixel."""
+        if first_pixel < 0 or first_pixel + num_pixels > self.num_pixels:
+            raise ValueError(f'pixels {first_pixel} to {first_pixel + num_pixels - 1} are not on the strip of '
+                             f'{self.num_pixels} pixels')
+        for first, count in self.segments:
+            if first_pixel < first + count and first < first_pixel + num_pixels:
+                raise ValueError(f'pixels {first_pixel} to {first_pixel + num_pixels - 1} overlap pixels {first} '
+                                 f'to {first + count - 1}')
+        self.segments.append((first_pixel, num_pixels))
+        start = first_pixel * self.bytes_per_pixel
+        end = start + num_pixels * self.bytes_per_pixel
+
+        def write(pin, frame: bytes) -> None:
+            with self.lock:
+                self.frame[start:end] = frame
+                self.write(pin, bytes(self.frame))
+        return write
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from base_thread import BaseThread
+from metrics import REGISTRY
+
+
+class NotificationError(Exception):
+    """Raised by Notifier.send() when the service did not take the message."""
+
+
+class Notifier(ABC):
+    """A service NotificationDispatcher delivers messages to, such as Autoremote.  Subclasses set name, which keys
+    the outbox, and implement send()."""
+    name = None
+
+    @abstractmethod
+    def send(self, session: requests.Session, message: str, timeout: float) -> None:
+        """Delivers message using session, raises NotificationError or a requests.RequestException on failure.
+
+        Parameters
+        ----------
+        session - requests.Session - pooled keep-alive session shared by all notifiers
+        message - str - what happened, such as 'garage-opened'
+        timeout - float - seconds to wait for the service at most
+        """
+
+
+class _Notification:
+    __slots__ = ('message', 'created', 'posted', 'attempts', 'due', 'saved')
+
+    def __init__(self, message: str, created: float, attempts: int = 0):
+        self.message = message
+        self.created = created  # time.time(), survives restarts
+        self.posted = time.monotonic()
+        self.attempts = attempts
+        self.due = 0.0
+        self.saved = False  # True once it is in the outbox
+
+
+class NotificationDispatcher(BaseThread):
+    """Delivers notifications such as garage-opened and garage-closed to the notifiers added with add().
+
+    post() only queues the message for every notifier and wakes up this thread, so the door contact thread that
+    reports a door change never waits for the network.  Each notifier has its own queue of at most max_queue
+    messages, the oldest is dropped when it is full.  Messages to a notifier are sent in order over one pooled
+    keep-alive requests.Session with a timeout.  A failed message is retried after backoff seconds, doubling every
+    time up to max_backoff, and the messages after it wait so a phone never sees closed before opened.
+
+    Messages that failed once are written to an outbox in store, a StateStore, so they are still delivered after a
+    restart.  Messages older than max_age seconds are not worth delivering any more and are dropped.
+
+    The sends are blocking, so with run_async() they are made on the executor.
+    """
+    def __init__(self, store=None, max_queue: int = 20, timeout: float = 5.0, backoff: float = 1.0,
+                 max_backoff: float = 300.0, max_age: float = 3600.0):
+        """
+        Parameters
+        ----------
+        store - StateStore - keeps the outbox under 'outbox', None keeps undelivered messages in memory only
+        max_queue - int - most messages waiting per notifier, defaults to 20
+        timeout - float - seconds to wait for a notifier's service, defaults to 5
+        backoff - float - seconds before the first retry, defaults to 1
+        max_backoff - float - most seconds between retries, defaults to 300
+        max_age - float - seconds after which an undelivered message is dropped, defaults to an hour
+        """
+        super(NotificationDispatcher, self).__init__(join_timeout=timeout + 1.0)
+        self.store = store
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_age = max_age
+        self.notifiers = {}  # name -> Notifier
+        self.queues = {}  # name -> deque of _Notification
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.expired = 0
+        self.last_error = None
+        self.delivery_latency = REGISTRY.histogram('garage_notification_seconds',
+                                                   'Seconds from posting a notification until it was delivered')
+        REGISTRY.gauge('garage_notifications_waiting', 'Notifications waiting to be delivered',
+                       lambda: sum(len(queue) for queue in list(self.queues.values())))
+        for name in ('sent', 'failed', 'dropped', 'expired'):
+            REGISTRY.counter('garage_notifications_total', 'Notification attempts by what happened to them',
+                             lambda name=name: getattr(self, name), outcome=name)
+
+    def add(self, notifier: Notifier) -> None:
+        """Adds notifier and queues what the outbox still holds for it."""
+        queue = deque()
+        outbox = self.store.get('outbox', []) if self.store is not None else []
+        for name, message, created, attempts in outbox:
+            if name == notifier.name:
+                notification = _Notification(message, created, attempts)
+                notification.saved = True
+                queue.append(notification)
+        if queue:
+            logging.info(f'{len(queue)} undelivered {notifier.name} notifications in the outbox')
+        with self.lock:
+            self.notifiers[notifier.name] = notifier
+            self.queues[notifier.name] = queue
+        self.notify()
+
+    def post(self, message: str) -> None:
+        """Queues message for every notifier and returns right away.  Safe to call from any thread."""
+        now = time.time()
+        with self.lock:
+            for name, queue in self.queues.items():
+                if len(queue) >= self.max_queue:
+                    dropped = queue.popleft()
+                    self.dropped += 1
+                    logging.warning(f'dropping {name} notification {dropped.message}, {len(queue)} are waiting')
+                queue.append(_Notification(message, now))
+        self.notify()
+
+    def _next(self):
+        """Returns (name, notification) of the first message that is due, or (None, seconds until one is)."""
+        now = time.monotonic()
+        due = None, None
+        expired = False
+        with self.lock:
+            for name, queue in self.queues.items():
+                while queue and time.time() - queue[0].created > self.max_age:
+                    notification = queue.popleft()
+                    self.expired += 1
+                    expired = expired or notification.saved
+                    logging.warning(f'giving up on {name} notification {notification.message}')
+                if not queue:
+                    continue
+                if queue[0].due <= now:
+                    due = name, queue[0]
+                    break
+                if due[1] is None or queue[0].due - now < due[1]:
+                    due = None, queue[0].due - now
+        if expired:
+            self._save()
+        return due
+
+    def _attempt(self, name: str, notification: _Notification):
+        """Sends notification, blocking for at most timeout seconds.  Returns None or the error."""
+        try:
+            self.notifiers[name].send(self.session, notification.message, self.timeout)
+            return None
+        except (NotificationError, requests.RequestException) as e:
+            return e
+
+    def _finish(self, name: str, notification: _Notification, error) -> None:
+        notification.attempts += 1
+        if error is None:
+            with self.lock:
+                queue = self.queues[name]
+                # post() may have dropped it while it was being sent
+                if queue and queue[0] is notification:
+                    queue.popleft()
+            if notification.saved:
+                self._save()
+            self.sent += 1
+            self.delivery_latency.observe(time.monotonic() - notification.posted)
+            return
+        self.failed += 1
+        self.last_error = f'{name}: {error}'
+        delay = min(self.backoff * 2 ** (notification.attempts - 1), self.max_backoff)
+        notification.due = time.monotonic() + delay
+        logging.warning(f'sending {notification.message} to {name} failed ({error}), retrying in {delay:.0f} seconds')
+        if not notification.saved:
+            self._save()
+
+    def _save(self, everything: bool = False) -> None:
+        """Writes the queues of the notifiers that have a message that failed or was in the outbox to the outbox,
+        or every queue if everything is True."""
+        if self.store is None:
+            return
+        outbox = []
+        with self.lock:
+            for name, queue in self.queues.items():
+                if everything or any(notification.attempts > 0 or notification.saved for notification in queue):
+                    for notification in queue:
+                        notification.saved = True
+                        outbox.append((name, notification.message, notification.created, notification.attempts))
+        self.store['outbox'] = outbox
+        self.store.flush()
+
+    def step(self):
+        while True:
+            name, notification = self._next()
+            if name is None:
+                return notification
+            self._finish(name, notification, self._attempt(name, notification))
+            if not self.running:
+                return None
+
+    async def run_async(self, executor=None) -> None:
+        event_loop = asyncio.get_running_loop()
+        self._attach(event_loop)
+        while self.running:
+            name, notification = self._next()
+            if name is not None:
+                error = await event_loop.run_in_executor(executor, self._attempt, name, notification)
+                self._finish(name, notification, error)
+            else:
+                await self.wait_async(notification)
+            self.wakeups += 1
+
+    def waiting(self) -> int:
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def shutdown(self):
+        super().shutdown()
+        # whatever is still queued is delivered after the restart
+        if self.waiting() > 0 or self.store is not None and self.store.get('outbox'):
+            self._save(everything=True)
+        self.session.close()
+
+    def stats(self) -> dict:
+        return {'waiting': self.waiting(), 'sent': self.sent, 'failed': self.failed, 'dropped': self.dropped,
+                'expired': self.expired, 'last_error': self.last_error}
@@ -0,0 +1,276 @@
+import bz2
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from enum import IntEnum
+
+from door_control import DoorCommand
+
+_SEGMENT_HEADER = struct.Struct('<4sH2xq')  # magic, version, start ms
+_BLOCK_HEADER = struct.Struct('<qII')  # start ms, records, compressed bytes
+_RECORD_HEADER = struct.Struct('<BHH')  # kind, ms since the previous record, payload bytes
+_MAGIC = b'GPSR'
+_VERSION = 1
+_MAX_TIME_DELTA = 0xFFFF  # ms, time deltas are stored as uint16
+_MAX_PAYLOAD = 0xFFFF
+
+
+class RecordKind(IntEnum):
+    TFMINI = 1  # bytes read from the TFmini-S as they arrived, frames and garbage alike
+    DOOR = 2  # edge of the door contact, 1 if it is pressed (door closed) after it, 0 if released
+    WIFI = 3  # car Wifi networks a scan found, one 'ssid<tab>signal' line each
+    RELAY = 4  # the door button was pressed, DoorCommand value of the press
+    SETTINGS = 5  # JSON of the stall's settings and persistent variables, see ControlThread.session_settings()
+
+
+class _Block:
+    __slots__ = ('start', 'records', 'data')
+
+    def __init__(self, start: int, records: int, data: bytes):
+        self.start = start  # ms of the first record
+        self.records = records
+        self.data = data  # record headers followed by the payloads, uncompressed
+
+
+class SessionRecorder:
+    """Records what the sensors of a stall report, so a session can be replayed with SessionReplayer: every byte
+    read from the TFmini-S, the edges of the door contact, the car Wifi networks each scan found and the presses of
+    the door button.
+
+    Records are a 5 byte header (kind, millisecond time delta, payload length) and their payload.  They are collected
+    in a block in memory, the headers of all records ahead of their payloads so the TFmini-S frames are back to
+    back, that is compressed with bz2 and appended to the current segment file with one write once it holds
+    block_bytes or flush_interval seconds have passed.  A day of 100 Hz TFmini-S frames takes about 12 MB and the
+    SD card sees a write about once a minute.  Every block starts with a SETTINGS record, so a replay can start at
+    any block.  A new segment file is started every segment_bytes and segments older than retention_days are removed
+    as new ones are started.
+
+    Safe to use from any thread.  A block is compressed and written by the thread that fills it or calls flush(),
+    without holding up the threads that record meanwhile."""
+    def __init__(self, directory: str, settings=None, flush_interval: float = 60.0, block_bytes: int = 256 * 1024,
+                 segment_bytes: int = 4 * 1024 * 1024, retention_days: float = 7.0):
+        """
+        Parameters
+        ----------
+        directory - str - directory to write the segment files to, created if needed
+        settings - function() - returns the dict recorded as the SETTINGS record of each segment, defaults to None
+        flush_interval - float - most seconds records are kept only in memory, defaults to 60 seconds
+        block_bytes - int - uncompressed bytes of records after which a block is written, defaults to 256 KiB
+        segment_bytes - int - bytes after which a new segment file is started, defaults to 4 MiB
+        retention_days - float - number of days of recordings to keep, defaults to 7
+        """
+        self.directory = directory
+        self.settings = settings
+        self.flush_interval = flush_interval
+        self.block_bytes = block_bytes
+        self.segment_bytes = segment_bytes
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # taken while the lock is held, so blocks are written in order
+        self.headers = bytearray()
+        self.payloads = bytearray()
+        self.block_start = 0
+        self.block_end = 0
+        self.block_records = 0
+        self.segment = None
+        self.segment_start = None
+        self.segment_size = 0
+        self.last_flush = time.monotonic()
+        self.records = 0
+        self.bytes_recorded = 0
+        self.blocks_written = 0
+        self.bytes_written = 0
+        os.makedirs(directory, exist_ok=True)
+        self.expire()
+
+    def tfmini(self, data: bytes) -> None:
+        """Records bytes read from the TFmini-S, use as a data listener of a TfminisThread or TfminiSensor."""
+        for i in range(0, len(data), _MAX_PAYLOAD):
+            self.append(RecordKind.TFMINI, data[i:i + _MAX_PAYLOAD])
+
+    def door(self, pressed: bool) -> None:
+        """Records an edge of the door contact, use as an edge listener of a DoorStatusThread."""
+        self.append(RecordKind.DOOR, b'\1' if pressed else b'\0')
+
+    def wifi(self, found: list) -> None:
+        """Records the result of a Wifi scan, found is the wifi.Cell of each car network that was seen."""
+        self.append(RecordKind.WIFI, '\n'.join(f'{cell.ssid}\t{getattr(cell, "signal", "")}'
+                                               for cell in found).encode('utf-8')[:_MAX_PAYLOAD])
+
+    def relay(self, command: DoorCommand) -> None:
+        """Records a press of the door button, use as a listener of DoorControl."""
+        self.append(RecordKind.RELAY, bytes([command.value]))
+
+    def append(self, kind: RecordKind, payload: bytes, timestamp: float = None) -> None:
+        """Adds a record at timestamp (time.time() seconds, defaults to now), writes the block once it is full."""
+        t = int((timestamp if timestamp is not None else time.time()) * 1000)
+        blocks = []
+        with self.lock:
+            if self.block_records > 0 and not 0 <= t - self.block_end <= _MAX_TIME_DELTA:
+                # a long gap or the clock went back, start a block with a new start time
+                blocks.append(self._take_block())
+            if self.block_records == 0:
+                self.block_start = self.block_end = t
+                if self.settings is not None:
+                    self._add(RecordKind.SETTINGS, json.dumps(self.settings(), sort_keys=True).encode('utf-8'), t)
+            self._add(kind, payload, t)
+            if len(self.headers) + len(self.payloads) >= self.block_bytes:
+                blocks.append(self._take_block())
+            if blocks:
+                self.write_lock.acquire()
+        if blocks:
+            self._write_blocks(blocks)
+
+    def _add(self, kind: RecordKind, payload: bytes, t: int) -> None:
+        self.headers += _RECORD_HEADER.pack(kind, t - self.block_end, len(payload))
+        self.payloads += payload
+        self.block_end = t
+        self.block_records += 1
+        self.records += 1
+        self.bytes_recorded += _RECORD_HEADER.size + len(payload)
+
+    def _take_block(self) -> _Block:
+        """Returns the records collected so far as a block and starts a new one, call with the lock held."""
+        block = _Block(self.block_start, self.block_records, bytes(self.headers + self.payloads))
+        self.headers = bytearray()
+        self.payloads = bytearray()
+        self.block_records = 0
+        return block
+
+    def _write_blocks(self, blocks: list) -> None:
+        """Compresses the blocks and appends them to the segment, call with the write_lock taken, it is released."""
+        new_segment = False
+        try:
+            for block in blocks:
+                if self.segment is None or self.segment_size >= self.segment_bytes:
+                    self._new_segment(block.start)
+                    new_segment = True
+                data = bz2.compress(block.data)
+                # one write per block, a power cut leaves at most the last block cut short, read_session() stops there
+                self.segment.write(_BLOCK_HEADER.pack(block.start, block.records, len(data)) + data)
+                self.segment_size += _BLOCK_HEADER.size + len(data)
+                self.blocks_written += 1
+                self.bytes_written += _BLOCK_HEADER.size + len(data)
+        finally:
+            self.write_lock.release()
+        if new_segment:
+            self.expire()
+
+    def _new_segment(self, start: int) -> None:
+        self._close_segment()
+        while os.path.exists(os.path.join(self.directory, f'{start}.rec')):
+            start += 1  # the clock went back, e.g. a Pi without network time after a reboot
+        self.segment = open(os.path.join(self.directory, f'{start}.rec'), 'ab', buffering=0)
+        self.segment.write(_SEGMENT_HEADER.pack(_MAGIC, _VERSION, start))
+        self.segment_start = start
+        self.segment_size = _SEGMENT_HEADER.size
+
+    def _close_segment(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+            self.segment_start = None
+
+    def segments(self) -> list:
+        """Returns the start times in ms of the segment files, oldest first."""
+        return segments(self.directory)
+
+    def expire(self) -> None:
+        """Removes segment files that only hold records older than retention_days."""
+        before = int((time.time() - self.retention_days * 86400) * 1000)
+        starts = self.segments()
+        removed = 0
+        for start, next_start in zip(starts, starts[1:]):
+            if next_start <= before and start != self.segment_start:
+                os.remove(os.path.join(self.directory, f'{start}.rec'))
+                removed += 1
+        if removed > 0:
+            logging.info(f'removed {removed} recorded session segments older than {self.retention_days} days')
+
+    def flush_if_due(self) -> None:
+        """Writes the block if records have been kept in memory for flush_interval seconds."""
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the records that are only in memory to disk."""
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if self.block_records == 0:
+                return
+            block = self._take_block()
+            self.write_lock.acquire()
+        self._write_blocks([block])
+
+    def close(self) -> None:
+        self.flush()
+        with self.write_lock:
+            self._close_segment()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'records': self.records,
+                'bytes_recorded': self.bytes_recorded,
+                'blocks_written': self.blocks_written,
+                'bytes_written': self.bytes_written,
+                'compression': self.bytes_recorded / self.bytes_written if self.bytes_written > 0 else None
+            }
+
+
+def segments(directory: str) -> list:
+    """Returns the start times in ms of the segment files in directory, oldest first."""
+    return sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.rec'))
+
+
+def read_session(directory: str, start: float = None, end: float = None):
+    """Yields the records a SessionRecorder wrote to directory, oldest first.  A block that was cut short, because
+    the Pi lost power while writing it, ends its segment.
+
+    Parameters
+    ----------
+    directory - str - directory of the segment files
+    start - float - time.time() seconds of the first record to yield, defaults to None for the oldest
+    end - float - time.time() seconds to stop at, defaults to None for the newest
+
+    Returns
+    -------
+    generator of (time.time() seconds, RecordKind, payload bytes) tuples
+    """
+    start_ms = int(start * 1000) if start is not None else None
+    end_ms = int(end * 1000) if end is not None else None
+    starts = segments(directory)
+    for i, segment_start in enumerate(starts):
+        if end_ms is not None and segment_start >= end_ms:
+            return
+        if start_ms is not None and i + 1 < len(starts) and starts[i + 1] <= start_ms:
+            continue
+        with open(os.path.join(directory, f'{segment_start}.rec'), 'rb') as fp:
+            data = fp.read()
+        if len(data) < _SEGMENT_HEADER.size:
+            continue
+        magic, version, _ = _SEGMENT_HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            logging.warning(f'skipping {segment_start}.rec, it is not a version {_VERSION} recorded session')
+            continue
+        offset = _SEGMENT_HEADER.size
+        while offset + _BLOCK_HEADER.size <= len(data):
+            t, records, size = _BLOCK_HEADER.unpack_from(data, offset)
+            offset += _BLOCK_HEADER.size
+            try:
+                block = bz2.decompress(data[offset:offset + size])
+            except (OSError, ValueError) as e:
+                logging.warning(f'{segment_start}.rec ends with a damaged block: {e}')
+                break
+            offset += size
+            position = records * _RECORD_HEADER.size
+            for kind, delta, length in _RECORD_HEADER.iter_unpack(block[:position]):
+                t += delta
+                if end_ms is not None and t >= end_ms:
+                    return
+                if start_ms is None or t >= start_ms:
+                    yield t / 1000, RecordKind(kind), block[position:position + length]
+                position += length
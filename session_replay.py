@@ -0,0 +1,383 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+from wifi import Cell
+
+import control_thread
+import door_control
+import door_status_thread
+import garage_state
+import home_assistant
+import neopixel_display_thread
+import notification_dispatcher
+import state_store
+import tfmini_reader_thread
+import wifi_scan_thread
+from car_status import CarStatus
+from control_thread import ControlThread
+from door_control import DoorCommand
+from session_recorder import RecordKind, read_session, segments
+from tfmini_reader_thread import TfminiReaderThread
+from wifi_scan_thread import WifiScanThread
+
+# modules whose time.time() and time.monotonic() are the recorded time during a replay
+CLOCKED_MODULES = [control_thread, door_control, door_status_thread, garage_state, home_assistant,
+                   neopixel_display_thread, notification_dispatcher, state_store, tfmini_reader_thread, wifi_scan_thread]
+
+
+class ReplayClock:
+    """Stands in for the time module of CLOCKED_MODULES, time() and monotonic() are the recorded time the replay has
+    reached and sleep() moves it on."""
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+    def __getattr__(self, name: str):
+        return getattr(time, name)
+
+
+class ReplayPixels:
+    """Stands in for the NeoPixel strip, pass it as pixels and its write as pixel_write."""
+    def __init__(self):
+        self.pin = 'replay'
+        self.byteorder = 'GRB'
+        self.frames = 0
+
+    def write(self, pin, frame: bytes) -> None:
+        self.frames += 1
+
+
+class ReplayClient:
+    """Stands in for the paho client of an MqttConnection, hands every publication to on_publish."""
+    def __init__(self, on_publish):
+        self.on_publish = on_publish
+        self.messages = 0
+
+    def publish(self, topic: str, payload: str, retain: bool = False) -> None:
+        self.messages += 1
+        self.on_publish(topic, payload, retain)
+
+    def message_callback_add(self, topic: str, callback) -> None:
+        pass
+
+
+class ReplayConnection:
+    """Stands in for the MqttConnection a HomeAssistant publishes on, it never connects."""
+    def __init__(self, on_publish):
+        self.mqtt_server = 'replay'
+        self.client = ReplayClient(on_publish)
+
+    def add_connect_handler(self, handler) -> None:
+        pass
+
+
+class SessionReplayer:
+    """Feeds a session recorded by a SessionRecorder back through a ControlThread with its NeoPixelDisplayThread,
+    DoorStatusThread, DoorControl and HomeAssistant, on stand-in devices: the TFmini-S bytes are parsed by a
+    TfminiSensor, the door contact edges drive a gpiozero mock pin, the Wifi scans are handed to a WifiScanThread
+    that never scans, and the NeoPixel strip and MQTT client only count what they are sent.
+
+    None of the threads is started.  The replayer steps them itself, the way BaseThread.loop() would: when they were
+    notified, no sooner than min_period after their last step, and when the timeout their step() returned is up.
+    Their modules tell the time from a ReplayClock set to the recorded time, so speeds, debouncing, door movement
+    delays and the auto-open cool down come out as they did and a replay as fast as possible gives the same
+    transitions as one at real time.  MQTT state is not coalesced, every change is published.
+
+    The stall is set up from the SETTINGS record at the start of the session, options replace any of them, e.g.
+    auto_open_cool_down=60 to see what a shorter cool down would have done.  Only one replayer can run at a time
+    per process, it takes over the time of CLOCKED_MODULES and the gpiozero pin factory until close()."""
+    def __init__(self, directory: str, realtime: bool = False, start: float = None, end: float = None,
+                 listener=None, **options):
+        """
+        Parameters
+        ----------
+        directory - str - record_dir of the stall
+        realtime - bool - True to replay at the pace it was recorded, False as fast as possible, defaults to False
+        start - float - time.time() seconds to start at, defaults to None for the start of the session
+        end - float - time.time() seconds to stop at, defaults to None for the end of the session
+        listener - function(time, what, value) - called with every transition as it happens, defaults to None
+        options - ControlThread arguments that replace the recorded settings
+        """
+        self.directory = directory
+        self.realtime = realtime
+        self.start = start
+        self.end = end
+        self.listener = listener
+        self.options = options
+        self.transitions = []  # (time.time() seconds, what, value)
+        self.clock = None
+        self.garage = None
+        self.reader = None
+        self.scanner = None
+        self.due = {}  # thread -> clock time its next step() is due, None to wait for notify()
+        self.last_step = {}
+        self.records = 0
+        self.recorded_presses = 0
+        self.first_time = None
+        self.last_time = None
+        self.started = None
+        self.car_status = None
+        self.display_mode = None
+        self.wifi = None
+        self.temporary = None
+        self.pin_factory = None
+        self.saved_time = None
+        self.saved_pin_factory = None
+
+    def run(self) -> dict:
+        """Replays the session and returns a summary, see stats()."""
+        self.started = time.monotonic()
+        first_segment = None
+        settings = None
+        if self.start is not None:
+            # the SETTINGS record at the start of the segment that holds start sets up the stall
+            start_ms = int(self.start * 1000)
+            first_segment = max([s for s in segments(self.directory) if s <= start_ms], default=start_ms) / 1000
+        try:
+            for t, kind, payload in read_session(self.directory, first_segment, self.end):
+                if self.garage is None:
+                    if kind == RecordKind.SETTINGS:
+                        settings = payload
+                    if self.start is not None and t < self.start:
+                        continue
+                    if kind != RecordKind.SETTINGS and settings is None:
+                        continue
+                    self._setup(json.loads(settings), t)
+                    if kind == RecordKind.SETTINGS:
+                        continue
+                self._run_until(t)
+                self._apply(kind, payload)
+                self.records += 1
+                self.last_time = t
+            if self.last_time is not None:
+                self._run_until(self.last_time)
+        finally:
+            self.close()
+        return self.stats()
+
+    def _setup(self, settings: dict, t: float) -> None:
+        self.first_time = self.last_time = t
+        self.clock = ReplayClock(t)
+        self.saved_time = [module.time for module in CLOCKED_MODULES]
+        for module in CLOCKED_MODULES:
+            module.time = self.clock
+        self.saved_pin_factory = Device.pin_factory
+        self.pin_factory = Device.pin_factory = MockFactory()
+        self.temporary = tempfile.mkdtemp(prefix='replay')
+        self.reader = TfminiReaderThread()
+        ssids = self.options.get('ssids', settings['ssids'])
+        self.scanner = WifiScanThread(ssids, 'replay', events=False, scan=lambda interface: []) if ssids else None
+        options = {key: settings[key] for key in ('max_distance', 'ssids', 'num_pixels', 'auto_open_via_wifi',
+                                                  'auto_close_via_wifi', 'auto_open_cool_down', 'door_movement_delay',
+                                                  'door_debounce', 'period', 'idle_timeout')}
+        options.update(self.options)
+        options.update(wlan_interface=None, tfmini_port='replay', mqtt_server=None, mqtt_coalesce_window=0.0,
+                       db_file=os.path.join(self.temporary, 'garage_vars'), history_dir=None,
+                       pixels=ReplayPixels(), mqtt_connection=ReplayConnection(self._published),
+                       wifi_scanner=self.scanner, tfmini_reader=self.reader)
+        options['pixel_write'] = options['pixels'].write
+        garage = self.garage = ControlThread(**options)
+        for key, value in settings['db'].items():
+            garage.db[key] = CarStatus[value] if key == 'car_status' else value
+        self.car_status = garage.db['car_status']
+        self._transition('car', self.car_status.name)
+        garage.connect_listeners()
+        garage.door_status.listeners.append(lambda status: self._transition('door', status.name))
+        garage.control.listeners.append(lambda command: self._transition('relay', command.name))
+        if settings['door_contact']:
+            self.door_pin().drive_low()
+        # what the threads do when they are started: the door contact is read, then they all step once
+        garage.door_status._initial_status()
+        for thread in (garage.display, garage.door_status, garage.control, garage):
+            self.due[thread] = t
+            self.last_step[thread] = t - thread.min_period
+        garage.display.park_distance = self.options.get('park_distance', settings['park_distance'])
+        self._wifi([(ssid, None) for ssid in settings['wifi']])
+
+    def door_pin(self):
+        return self.pin_factory.pin(self.garage.door_status.gpio_pin)
+
+    def _apply(self, kind: RecordKind, payload: bytes) -> None:
+        if kind == RecordKind.TFMINI:
+            self.garage.tfminis.handle_data(payload)
+        elif kind == RecordKind.DOOR:
+            # the contact is pulled up, pressed (door closed) is low
+            if payload[0]:
+                self.door_pin().drive_low()
+            else:
+                self.door_pin().drive_high()
+        elif kind == RecordKind.WIFI:
+            lines = payload.decode('utf-8').split('\n') if payload else []
+            self._wifi([line.split('\t') for line in lines])
+        elif kind == RecordKind.RELAY:
+            self.recorded_presses += 1
+            self._transition('recorded relay', DoorCommand(payload[0]).name)
+        elif kind == RecordKind.SETTINGS:
+            settings = json.loads(payload)
+            if 'park_distance' not in self.options and settings['park_distance'] != self.garage.display.park_distance:
+                self.garage.set_park_distance(settings['park_distance'])
+
+    def _wifi(self, found: list) -> None:
+        """Hands a scan that found the (ssid, signal) of found to the scanner."""
+        cells = []
+        for ssid, signal in found:
+            cell = Cell()
+            cell.ssid = ssid
+            cell.signal = int(signal) if signal else None
+            cells.append(cell)
+        if self.scanner is not None:
+            self.scanner.update(cells)
+        seen = sorted(cell.ssid for cell in cells)
+        if seen != self.wifi:
+            self._transition('wifi', ', '.join(seen) if seen else 'none')
+            self.wifi = seen
+
+    def _run_until(self, t: float) -> None:
+        """Runs every step() that is due before t, then moves the clock to t."""
+        while True:
+            thread = None
+            for candidate, due in self.due.items():
+                # peeking first saves taking the lock of every thread for each of the ~100 records a second
+                if candidate._wakeup_pending and candidate.wait(0):
+                    # notified, BaseThread.loop() would run it now but not before min_period
+                    run_at = max(self.clock.now, self.last_step[candidate] + candidate.min_period)
+                    due = self.due[candidate] = run_at if due is None else min(due, run_at)
+                if due is not None and due <= t and (thread is None or due < next_due):
+                    thread, next_due = candidate, due
+            if thread is None:
+                break
+            due = next_due
+            self._advance(due)
+            timeout = thread.step()
+            thread.wakeups += 1
+            self.last_step[thread] = due
+            self.due[thread] = due + timeout if timeout is not None else None
+            if thread is self.garage:
+                self._garage_stepped()
+            elif thread is self.garage.display:
+                self._display_stepped(timeout is not None)
+        self._advance(t)
+
+    def _advance(self, t: float) -> None:
+        if t <= self.clock.now:
+            return
+        if self.realtime:
+            wait = self.started + (t - self.first_time) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.clock.now = t
+
+    def _garage_stepped(self) -> None:
+        status = self.garage.db['car_status']
+        if status != self.car_status:
+            self.car_status = status
+            self._transition('car', status.name)
+
+    def _display_stepped(self, blinking: bool) -> None:
+        display = self.garage.display
+        if blinking:
+            mode = 'blinking red'
+        elif display.last_frame is display.red_frame:
+            mode = 'red'
+        elif display.last_frame is display.standby_frame:
+            mode = 'standby'
+        elif display.last_frame is display.off_frame:
+            mode = 'off'
+        else:
+            mode = 'bullseye'
+        if mode != self.display_mode:
+            self.display_mode = mode
+            self._transition('leds', mode)
+
+    def _published(self, topic: str, payload: str, retain: bool) -> None:
+        # state is published retained, telemetry is not
+        if retain:
+            self._transition('mqtt', f'{topic} {payload}')
+
+    def _transition(self, what: str, value: str) -> None:
+        now = self.clock.now
+        self.transitions.append((now, what, value))
+        if self.listener is not None:
+            self.listener(now, what, value)
+
+    def stats(self) -> dict:
+        """Returns what was replayed: the records and hours of the session, the seconds it took, hours replayed per
+        second and the door button presses the replay made vs the ones that were recorded."""
+        seconds = time.monotonic() - self.started
+        hours = (self.last_time - self.first_time) / 3600 if self.first_time is not None else 0.0
+        return {
+            'records': self.records,
+            'hours': hours,
+            'seconds': seconds,
+            'hours_per_second': hours / seconds if seconds > 0 else None,
+            'transitions': len(self.transitions),
+            'readings': self.garage.tfminis.parser.frames if self.garage is not None else 0,
+            'presses': self.garage.control.presses if self.garage is not None else 0,
+            'recorded_presses': self.recorded_presses
+        }
+
+    def close(self) -> None:
+        """Shuts the stall down and gives back the time of CLOCKED_MODULES and the gpiozero pin factory."""
+        if self.garage is None or self.saved_time is None:
+            return
+        self.garage.shutdown()
+        self.reader.shutdown()
+        if self.scanner is not None:
+            self.scanner.shutdown()
+        for module, saved in zip(CLOCKED_MODULES, self.saved_time):
+            module.time = saved
+        self.saved_time = None
+        Device.pin_factory = self.saved_pin_factory
+        shutil.rmtree(self.temporary, ignore_errors=True)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Replays a session recorded with garage.py --record_dir and prints the '
+                                            'door, car, LED, door button, MQTT and Wifi transitions it results in.')
+    p.add_argument('directory', help='record_dir of the stall, <record_dir>/<name> with --stalls')
+    p.add_argument('--realtime', action='store_true', help='replay at the pace it was recorded instead of as fast as '
+                                                           'possible')
+    p.add_argument('--start', type=datetime.fromisoformat, help='local date and time to start at, e.g. '
+                                                               '2024-01-31T07:00, defaults to the start of the session')
+    p.add_argument('--end', type=datetime.fromisoformat, help='local date and time to stop at, defaults to the end of '
+                                                             'the session')
+    p.add_argument('--quiet', action='store_true', help='print only the summary')
+    options = p.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    def print_transition(t: float, what: str, value: str) -> None:
+        print(f'{datetime.fromtimestamp(t).isoformat(" ", "milliseconds")} {what:<14} {value}', flush=True)
+
+    replayer = SessionReplayer(options.directory, realtime=options.realtime,
+                               start=options.start.timestamp() if options.start is not None else None,
+                               end=options.end.timestamp() if options.end is not None else None,
+                               listener=None if options.quiet else print_transition)
+    stats = replayer.run()
+    if stats['records'] == 0:
+        print(f'nothing recorded in {options.directory}')
+        sys.exit(1)
+    print(f'replayed {stats["records"]} records, {stats["hours"]:.2f} hours, in {stats["seconds"]:.1f} seconds '
+          f'({stats["hours_per_second"]:.3g} hours per second): {stats["readings"]} TFmini-S readings, '
+          f'{stats["transitions"]} transitions, {stats["presses"]} door button presses '
+          f'({stats["recorded_presses"]} recorded)')
+
+
+if __name__ == '__main__':
+    main()
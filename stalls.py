@@ -0,0 +1,185 @@
+import logging
+import os
+import re
+
+from control_thread import ControlThread
+from home_assistant import MqttConnection
+from metrics import REGISTRY
+from neopixel_display_thread import NeoPixelStrip
+from temperature_monitor_thread import TemperatureMonitorThread
+from tfmini_reader_thread import TfminiReaderThread
+from wifi_scan_thread import WifiScanThread
+
+
+class Stalls:
+    """Every stall of a garage run by one process.
+
+    Each stall is a ControlThread with its own TFmini-S, NeoPixel segment, door pins, car Wifi, state file, history
+    and Home Assistant device.  They share one Wifi scanner, because a scan keeps the one radio busy whoever asks for
+    it, one thread reading every TFmini-S, one CPU temperature monitor, one MQTT connection, the NeoPixel strip and
+    the web site.  The metrics of a stall are labelled stall=<name>.
+
+    Start the stalls with start() or run them with AsyncRuntime, the same as a single ControlThread."""
+    NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+    def __init__(self, stalls: list,
+                 neopixel_pin = None,
+                 num_pixels: int = 60,
+                 wlan_interface: str = 'wlan0',
+                 wifi_slow_scan_period: float = 30.0,
+                 mqtt_server: str = None,
+                 mqtt_port: int = 1883,
+                 mqtt_username: str = None,
+                 mqtt_password: str = None,
+                 mqtt_device_id: str = '01ad',
+                 mqtt_device_name: str = 'Garage Door',
+                 db_file: str = 'garage_vars',
+                 history_dir: str = 'history',
+                 record_dir: str = None,
+                 asyncio_mode: bool = False,
+                 pixels = None,
+                 pixel_write = None,
+                 **defaults):
+        """
+        Parameters
+        ----------
+        stalls - list(dict) - ControlThread arguments of each stall such as tfmini_port, door_status_pin,
+            door_control_pin, ssids and park_distance, plus its name (letters, digits, - and _) and optionally
+            first_pixel and num_pixels of its NeoPixel segment, by default the strip is split evenly
+        neopixel_pin - board.Pin - pin of the NeoPixel strip the stalls share, defaults to board.D21
+        num_pixels - int - number of pixels on the whole strip, defaults to 60
+        wlan_interface - str - wifi interface the shared scanner uses, None disables, defaults to 'wlan0'
+        wifi_slow_scan_period - float - seconds between Wifi scans while every car is parked behind a closed door,
+            defaults to 30 seconds
+        mqtt_server - str - MQTT server all stalls publish to over one connection, defaults to None meaning no MQTT
+        mqtt_port - int - port of the MQTT server, defaults to 1883
+        mqtt_username - str - username to login to MQTT server with, defaults to None
+        mqtt_password - str - password needed to login to MQTT server, defaults to None
+        mqtt_device_id - str - a stall's device identifier defaults to this followed by _<name>, defaults to '01ad'
+        mqtt_device_name - str - a stall's device name defaults to this followed by its name, defaults to
+            'Garage Door'
+        db_file - str - a stall's db_file defaults to this followed by _<name>, defaults to 'garage_vars'
+        history_dir - str - a stall's history is kept in the <name> directory in here, None disables, defaults to
+            'history'
+        record_dir - str - a stall's session is recorded in the <name> directory in here, None disables, defaults
+            to None
+        asyncio_mode - bool - True if AsyncRuntime will run the stalls, defaults to False
+        pixels - neopixel.NeoPixel - strip to draw on instead of creating one on neopixel_pin, for simulation
+        pixel_write - function(pin, bytes) - sends frames to pixels instead of neopixel_write, for simulation
+        defaults - ControlThread arguments for every stall that does not set them itself
+        """
+        if not stalls:
+            raise ValueError('at least one stall is needed')
+        names = [stall.get('name') for stall in stalls]
+        for name in names:
+            if name is None or not self.NAME.match(name):
+                raise ValueError(f'stall name {name!r} has to be letters, digits, - and _')
+        if len(set(names)) != len(names):
+            raise ValueError(f'stall names {names} are not unique')
+        ssids = sorted({ssid for stall in stalls for ssid in stall.get('ssids') or []})
+        if ssids and wlan_interface is not None:
+            self.wifi_scanner = WifiScanThread(ssids, wlan_interface, slow_period=wifi_slow_scan_period)
+        else:
+            self.wifi_scanner = None
+            logging.info('Wifi scanner disabled')
+        self.tfmini_reader = TfminiReaderThread()
+        self.temperature_monitor = TemperatureMonitorThread()
+        if mqtt_server is not None:
+            self.mqtt_connection = MqttConnection(mqtt_server, mqtt_port, mqtt_username, mqtt_password)
+        else:
+            self.mqtt_connection = None
+        self.asyncio_mode = asyncio_mode
+        self.strip = NeoPixelStrip(pin=neopixel_pin, num_pixels=num_pixels, pixels=pixels, write=pixel_write)
+        self.stalls = []
+        first_pixel = 0
+        for stall in stalls:
+            options = {**defaults, **stall}
+            name = options.pop('name')
+            count = options.pop('num_pixels', num_pixels // len(stalls))
+            first_pixel = options.pop('first_pixel', first_pixel)
+            options.setdefault('db_file', f'{db_file}_{name}')
+            options.setdefault('history_dir', os.path.join(history_dir, name) if history_dir is not None else None)
+            options.setdefault('record_dir', os.path.join(record_dir, name) if record_dir is not None else None)
+            options.setdefault('mqtt_device_id', f'{mqtt_device_id}_{name}')
+            options.setdefault('mqtt_device_name', f'{mqtt_device_name} {name}')
+            # the stalls publish over mqtt_connection, without one there is no MQTT
+            options['mqtt_server'] = None
+            # only a stall with a car Wifi of its own uses the scanner, found() would report the other cars
+            wifi_scanner = self.wifi_scanner if options.get('ssids') else None
+            with REGISTRY.labelled(stall=name):
+                self.stalls.append(ControlThread(name=name,
+                                                 num_pixels=count,
+                                                 pixels=self.strip.pixels,
+                                                 pixel_write=self.strip.segment(first_pixel, count),
+                                                 wlan_interface=wlan_interface if wifi_scanner is not None else None,
+                                                 wifi_scanner=wifi_scanner,
+                                                 temperature_monitor=self.temperature_monitor,
+                                                 tfmini_reader=self.tfmini_reader,
+                                                 mqtt_connection=self.mqtt_connection,
+                                                 asyncio_mode=asyncio_mode,
+                                                 **options))
+            logging.info(f'stall {name} uses pixels {first_pixel} to {first_pixel + count - 1}')
+            first_pixel += count
+
+    def __iter__(self):
+        return iter(self.stalls)
+
+    def __len__(self) -> int:
+        return len(self.stalls)
+
+    def get(self, name: str = None) -> ControlThread:
+        """Returns the stall called name, the first stall if name is None, or None if there is no such stall."""
+        if name is None:
+            return self.stalls[0]
+        for stall in self.stalls:
+            if stall.stall_name == name:
+                return stall
+        return None
+
+    def shared_threads(self) -> list:
+        """Returns the threads the stalls share in the order they are started."""
+        threads = []
+        if self.wifi_scanner is not None:
+            threads.append(self.wifi_scanner)
+        if self.tfmini_reader.sensors:
+            threads.append(self.tfmini_reader)
+        threads.append(self.temperature_monitor)
+        return threads
+
+    def threads(self) -> list:
+        """Returns the shared threads and the threads of every stall in the order they are started."""
+        return self.shared_threads() + [thread for stall in self.stalls for thread in stall.threads()]
+
+    def runnables(self) -> list:
+        """Returns everything AsyncRuntime runs as a task."""
+        runnables = self.shared_threads()
+        if self.mqtt_connection is not None:
+            runnables.append(self.mqtt_connection)
+        return runnables + [runnable for stall in self.stalls for runnable in stall.runnables()]
+
+    def connect_listeners(self):
+        for stall in self.stalls:
+            stall.connect_listeners()
+
+    def start(self):
+        """Starts the shared threads and the stalls, then connects to MQTT once every stall is listening."""
+        for thread in self.shared_threads():
+            thread.start()
+        for stall in self.stalls:
+            stall.start()
+        if self.mqtt_connection is not None and not self.asyncio_mode:
+            self.mqtt_connection.start()
+
+    def join(self):
+        for stall in self.stalls:
+            stall.join()
+
+    def shutdown(self):
+        for stall in self.stalls:
+            stall.shutdown()
+        if self.mqtt_connection is not None:
+            self.mqtt_connection.shutdown()
+        self.temperature_monitor.shutdown()
+        self.tfmini_reader.shutdown()
+        if self.wifi_scanner is not None:
+            self.wifi_scanner.shutdown()
@@ -0,0 +1,192 @@
+import dbm
+import logging
+import os
+import pickle
+import shelve
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+_HEADER = struct.Struct('<II')  # payload length, crc32 of payload
+
+
+class StateStore:
+    """Write-behind store for the persistent variables (last_found, car_status, etc.) of a garage stall.
+
+    Values are kept in memory so reading and setting them is cheap and safe from any thread.  Changes are
+    coalesced and appended to a journal file as one checksummed record per flush, either every flush_interval
+    seconds or right away when one of the flush_keys changes value.  A record that was only partially written
+    when power was lost fails its checksum and is ignored on the next start, so the store always comes back
+    with the values of the last complete flush.  Once the journal grows past compact_size it is replaced by a
+    single snapshot record.
+
+    Bytes written are counted so SD card wear can be tracked with bytes_written_last_hour().
+    """
+    def __init__(self, path: str, flush_interval: float = 60.0, flush_keys=('car_status',),
+                 compact_size: int = 64 * 1024, fsync: bool = True):
+        """
+        Parameters
+        ----------
+        path - str - name of the store, '.journal' is appended for the journal file
+        flush_interval - float - maximum number of seconds a change is kept only in memory, defaults to 60
+        flush_keys - tuple(str) - keys whose changes are important enough to be written immediately, defaults to
+            ('car_status',)
+        compact_size - int - journal size in bytes that triggers a rewrite as a single snapshot, defaults to 64 KB
+        fsync - bool - True to fsync after every flush, defaults to True
+        """
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.flush_interval = flush_interval
+        self.flush_keys = set(flush_keys)
+        self.compact_size = compact_size
+        self.fsync = fsync
+        self.values = {}
+        self.dirty = {}
+        self.lock = threading.RLock()
+        self.last_flush = time.monotonic()
+        self.opened = time.monotonic()
+        self.bytes_written = 0
+        self.flushes = 0
+        self.sets = 0
+        self.recent_writes = deque()  # (time, bytes) of writes in the last hour
+        if os.path.exists(self.journal_path):
+            self._load()
+        else:
+            self._import_shelve()
+        self.journal = open(self.journal_path, 'ab')
+        self.journal_size = self.journal.tell()
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            changed = self.values.get(key, _MISSING) != value
+            self.values[key] = value
+            self.dirty[key] = value
+            self.sets += 1
+        if changed and key in self.flush_keys:
+            self.flush()
+
+    def __contains__(self, key) -> bool:
+        return key in self.values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def flush_if_due(self) -> None:
+        """Flushes the pending changes if the oldest of them has waited flush_interval seconds."""
+        if self.dirty and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Appends all pending changes to the journal as one record."""
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if not self.dirty:
+                return
+            changes = self.dirty
+            self.dirty = {}
+            if self.journal_size >= self.compact_size:
+                self._compact()
+            else:
+                self._append(self.journal, changes)
+            self.flushes += 1
+
+    def sync(self) -> None:
+        """Same as flush(), for code written against shelve."""
+        self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.journal.close()
+
+    def bytes_written_last_hour(self) -> int:
+        """Returns the number of bytes written to the journal in the last hour."""
+        with self.lock:
+            self._expire_recent_writes()
+            return sum(size for _, size in self.recent_writes)
+
+    def bytes_written_per_hour(self) -> float:
+        """Returns the average number of bytes written per hour since the store was opened."""
+        hours = max(time.monotonic() - self.opened, 1.0) / 3600
+        return self.bytes_written / hours
+
+    def stats(self) -> dict:
+        return {
+            'sets': self.sets,
+            'flushes': self.flushes,
+            'bytes_written': self.bytes_written,
+            'bytes_written_last_hour': self.bytes_written_last_hour(),
+            'journal_size': self.journal_size
+        }
+
+    def _append(self, fp, changes: dict) -> None:
+        payload = pickle.dumps(changes, protocol=pickle.HIGHEST_PROTOCOL)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        fp.write(record)
+        fp.flush()
+        if self.fsync:
+            os.fsync(fp.fileno())
+        self.journal_size += len(record)
+        self._count_write(len(record))
+
+    def _compact(self) -> None:
+        """Replaces the journal with one record holding every value, atomically."""
+        temp_path = f'{self.journal_path}.tmp'
+        self.journal.close()
+        self.journal_size = 0
+        with open(temp_path, 'wb') as fp:
+            self._append(fp, self.values)
+        os.replace(temp_path, self.journal_path)
+        if self.fsync:
+            directory = os.open(os.path.dirname(os.path.abspath(self.journal_path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        self.journal = open(self.journal_path, 'ab')
+
+    def _load(self) -> None:
+        with open(self.journal_path, 'rb') as fp:
+            data = fp.read()
+        pos = 0
+        while pos + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, pos)
+            payload = data[pos + _HEADER.size:pos + _HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self.values.update(pickle.loads(payload))
+            pos += _HEADER.size + length
+        if pos < len(data):
+            logging.warning(f'ignoring {len(data) - pos} bytes of incomplete writes at the end of {self.journal_path}')
+            with open(self.journal_path, 'r+b') as fp:
+                fp.truncate(pos)
+
+    def _import_shelve(self) -> None:
+        """Starts from the values of the shelve file earlier versions used, if there is one."""
+        # the dbm backend shelve used decides the file names
+        if not any(os.path.exists(self.path + suffix) for suffix in ('', '.db', '.dat', '.dir', '.pag')):
+            return
+        try:
+            with shelve.open(self.path, flag='r') as db:
+                self.values.update(db)
+                self.dirty.update(db)
+            logging.info(f'imported {len(self.values)} values from shelve {self.path}')
+        except (*dbm.error, OSError, pickle.UnpicklingError) as error:
+            logging.warning(f'unable to import the values of shelve {self.path}, starting without them: {error}')
+
+    def _count_write(self, size: int) -> None:
+        self.bytes_written += size
+        self.recent_writes.append((time.monotonic(), size))
+        self._expire_recent_writes()
+
+    def _expire_recent_writes(self) -> None:
+        start = time.monotonic() - 3600
+        while self.recent_writes and self.recent_writes[0][0] < start:
+            self.recent_writes.popleft()
+
+
+_MISSING = object()
@@ -0,0 +1,84 @@
+import glob
+import logging
+import os
+import threading
+from datetime import datetime
+
+
+class SystemMetrics:
+    """Reads the CPU temperature, load average, memory and boot time of the Pi without starting a process.
+
+    The sysfs and /proc files are opened once and re-read from the start with os.pread(), which makes the kernel
+    generate fresh contents, so a sample costs a system call instead of a fork and exec of vcgencmd or uptime.
+    Values that never change, such as the boot time, are read once and cached.  Safe to use from any thread, e.g.
+    the temperature thread and the web site's status page."""
+    def __init__(self, thermal_zone: str = None):
+        """
+        Parameters
+        ----------
+        thermal_zone - str - temp file of the thermal zone to read, defaults to the zone whose type is cpu-thermal,
+            or the first zone if none is
+        """
+        self.files = {}
+        self.lock = threading.Lock()  # held while a file is opened, read or closed
+        self._boot_time = None
+        self.thermal_zone = thermal_zone if thermal_zone is not None else self._find_cpu_thermal_zone()
+        if self.thermal_zone is None:
+            logging.info('no thermal zone found, CPU temperature not available')
+
+    @staticmethod
+    def _find_cpu_thermal_zone():
+        zones = sorted(glob.glob('/sys/class/thermal/thermal_zone*'))
+        for zone in zones:
+            try:
+                with open(os.path.join(zone, 'type')) as fp:
+                    if fp.read().strip() == 'cpu-thermal':
+                        return os.path.join(zone, 'temp')
+            except OSError:
+                continue
+        return os.path.join(zones[0], 'temp') if zones else None
+
+    def _read(self, path: str) -> str:
+        """Returns the current contents of path, opening it on first use."""
+        with self.lock:
+            fd = self.files.get(path)
+            if fd is None:
+                fd = os.open(path, os.O_RDONLY)
+                self.files[path] = fd
+            data = os.pread(fd, 4096, 0)
+        return data.decode()
+
+    def cpu_temperature(self):
+        """Returns the CPU temperature in degrees Celsius rounded to 0.1, or None if there is no thermal zone."""
+        if self.thermal_zone is None:
+            return None
+        return round(int(self._read(self.thermal_zone)) / 1000, 1)
+
+    def load_average(self) -> tuple:
+        """Returns the 1, 5 and 15 minute load averages."""
+        fields = self._read('/proc/loadavg').split()
+        return float(fields[0]), float(fields[1]), float(fields[2])
+
+    def memory(self) -> dict:
+        """Returns /proc/meminfo as a dict of field name to kB, e.g. memory()['MemAvailable']."""
+        values = {}
+        for line in self._read('/proc/meminfo').splitlines():
+            name, _, value = line.partition(':')
+            values[name] = int(value.split()[0])
+        return values
+
+    def boot_time(self) -> datetime:
+        """Returns the last time the system was booted."""
+        if self._boot_time is None:
+            with open('/proc/stat') as fp:
+                for line in fp:
+                    if line.startswith('btime '):
+                        self._boot_time = datetime.fromtimestamp(int(line.split()[1]))
+                        break
+        return self._boot_time
+
+    def close(self) -> None:
+        with self.lock:
+            for fd in self.files.values():
+                os.close(fd)
+            self.files = {}
@@ -1,18 +1,29 @@
-import os
 import logging
-import time
-from base_thread import BaseThread
+from base_thread import SamplingThread
+from system_metrics import SystemMetrics
 
 
-class TemperatureMonitorThread(BaseThread):
-    """Uses the vcgencmd measure_temp to monitor the CPU temperature."""
-    def __init__(self):
-        super(TemperatureMonitorThread, self).__init__()
+class TemperatureMonitorThread(SamplingThread):
+    """Monitors the CPU temperature through the kernel's thermal zone, see SystemMetrics."""
+    def __init__(self, period: float = 1.0, metrics: SystemMetrics = None):
+        """
+        Parameters
+        ----------
+        period - float - seconds between temperature samples, defaults to 1 second
+        metrics - SystemMetrics - where to read the temperature, defaults to a new SystemMetrics
+        """
+        super(TemperatureMonitorThread, self).__init__(period, blocking=False)
+        self.metrics = metrics if metrics is not None else SystemMetrics()
         self.temperature = 0.0
 
-    def loop(self):
-        t = os.popen("vcgencmd measure_temp").readline()
-        self.temperature = float(t.replace("temp=","").replace("'C\n",""))
+    def sample(self) -> float:
+        return self.metrics.cpu_temperature()
+
+    def update(self, temperature: float) -> None:
+        self.temperature = temperature
         logging.debug(f'temperature={self.temperature}')
         self.inform_listeners(self.temperature)
-        time.sleep(5)
+
+    def shutdown(self) -> None:
+        super().shutdown()
+        self.metrics.close()
@@ -0,0 +1,111 @@
+import time
+
+FRAME_HEADER = b'\x59\x59'  # 0x59 is 'Y'
+FRAME_SIZE = 9
+INVALID_DISTANCE = 65535
+
+
+class TfminiParser:
+    """Streaming parser for the 9 byte TFmini-S serial frames.
+
+    Bytes are copied into a reusable bytearray and scanned for the 0x59 0x59 header.  Every frame with a good
+    checksum is returned, so no frames are thrown away when the sensor outputs faster than it is read and the
+    parser re-synchronizes on its own when a read starts in the middle of a frame.
+
+    Frame layout (see TFmini-S datasheet):
+        0: 0x59, 1: 0x59, 2: Dist_L, 3: Dist_H, 4: Strength_L, 5: Strength_H, 6: Temp_L, 7: Temp_H, 8: Checksum
+    """
+    def __init__(self, capacity: int = 4096):
+        """
+        Parameters
+        ----------
+        capacity - int - size of the receive buffer in bytes, defaults to 4096
+        """
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.frames = 0
+        self.resyncs = 0
+        self.checksum_failures = 0
+        self.bytes_discarded = 0
+
+    def feed(self, data, timestamp: float = None) -> list:
+        """Adds data received from the TFmini-S and returns every complete, valid frame found so far.
+
+        Parameters
+        ----------
+        data - bytes - bytes read from the serial port
+        timestamp - float - arrival time of data, defaults to time.time()
+
+        Returns
+        -------
+        list of readings, each a dict with time, distance, strength and temperature keys
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        size = len(data)
+        if self.length + size > len(self.buffer):
+            if size >= len(self.buffer):
+                # keep only the tail, the rest could never be parsed anyway
+                self.bytes_discarded += self.length + size - len(self.buffer)
+                data = data[size - len(self.buffer):]
+                size = len(data)
+                self.length = 0
+            else:
+                overflow = self.length + size - len(self.buffer)
+                self._consume(overflow)
+                self.bytes_discarded += overflow
+        self.buffer[self.length:self.length + size] = data
+        self.length += size
+        return self._parse(timestamp)
+
+    def _parse(self, timestamp: float) -> list:
+        readings = []
+        buffer = self.buffer
+        view = self.view
+        pos = 0
+        end = self.length
+        while end - pos >= FRAME_SIZE:
+            if buffer[pos] != 0x59 or buffer[pos + 1] != 0x59:
+                header = buffer.find(FRAME_HEADER, pos + 1, end)
+                self.resyncs += 1
+                if header < 0:
+                    # keep a trailing 0x59, it may be the first half of the next header
+                    pos = end - 1 if buffer[end - 1] == 0x59 else end
+                    break
+                pos = header
+                continue
+            if sum(view[pos:pos + 8]) & 0xff != buffer[pos + 8]:
+                # bad frame, the real header may be somewhere inside of it
+                self.checksum_failures += 1
+                pos += 1
+                continue
+            readings.append({
+                'time': timestamp,
+                'distance': buffer[pos + 2] | buffer[pos + 3] << 8,
+                'strength': buffer[pos + 4] | buffer[pos + 5] << 8,
+                'temperature': (buffer[pos + 6] | buffer[pos + 7] << 8) / 8 - 256
+            })
+            pos += FRAME_SIZE
+        self.frames += len(readings)
+        self._consume(pos)
+        return readings
+
+    def _consume(self, count: int) -> None:
+        """Drops count bytes from the front of the buffer, moving the remaining bytes to the start."""
+        remaining = self.length - count
+        if remaining > 0 and count > 0:
+            self.buffer[0:remaining] = self.view[count:self.length]
+        self.length = max(remaining, 0)
+
+    def reset(self) -> None:
+        """Throws away any partially received frame."""
+        self.length = 0
+
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames,
+            'resyncs': self.resyncs,
+            'checksum_failures': self.checksum_failures,
+            'bytes_discarded': self.bytes_discarded
+        }
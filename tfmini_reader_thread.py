@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import selectors
+import threading
+import time
+
+import serial
+
+from base_thread import BaseThread
+from metrics import REGISTRY
+from tfmini_parser import TfminiParser
+
+RETRY_SECONDS = 5.0  # between attempts to open a port that failed
+RATE_WINDOW = 5.0  # seconds frame rates are averaged over
+
+
+class TfminiSensor:
+    """One TFmini-S read by a TfminiReaderThread.  Like a TfminisThread, the latest reading is available from read()
+    and each valid reading is passed on to listeners as it arrives, so a stall can use either.  The bytes read are
+    passed on to data_listeners before they are parsed."""
+    def __init__(self, sensor_id: str, port: str, baud: int = 115200, timeout: float = 10.0):
+        """
+        Parameters
+        ----------
+        sensor_id - str - name of the sensor, added to its readings as 'sensor' and to its metrics
+        port - str - serial port the TFmini-S is connected to
+        baud - int - TFmini-S baud rate, defaults to 115200
+        timeout - float - seconds without a frame before the last reading is discarded, defaults to 10 seconds
+        """
+        self.sensor_id = sensor_id
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        self.serial_port = None
+        self.fileno = None
+        self.reading = None
+        self.listeners = list()
+        self.data_listeners = list()
+        self.parser = TfminiParser()
+        self.waiting = 0  # bytes that were waiting the last time the port was read
+        self.retry_at = 0.0
+        now = time.monotonic()
+        self._marks = ((now, 0), (now, 0))
+        labels = {'sensor': sensor_id}
+        REGISTRY.gauge('garage_serial_bytes_waiting', 'Bytes received from the TFmini-S that were not read yet',
+                       lambda: self.waiting, **labels)
+        REGISTRY.gauge('garage_parser_bytes_buffered', 'Bytes of an incomplete TFmini-S frame held by the parser',
+                       lambda: self.parser.length, **labels)
+        REGISTRY.gauge('garage_tfmini_frame_rate', 'TFmini-S frames received per second', self.frame_rate, **labels)
+        REGISTRY.counter('garage_tfmini_frames_total', 'TFmini-S frames received', lambda: self.parser.frames,
+                         **labels)
+        REGISTRY.counter('garage_tfmini_resyncs_total', 'Times the TFmini-S parser lost and found the frame start',
+                         lambda: self.parser.resyncs, **labels)
+        REGISTRY.counter('garage_tfmini_checksum_failures_total', 'TFmini-S frames with a bad checksum',
+                         lambda: self.parser.checksum_failures, **labels)
+
+    def read(self):
+        return self.reading
+
+    def handle_data(self, data: bytes) -> list:
+        """Parses bytes received from the TFmini-S, passes every reading found on to listeners and returns them.
+        Each reading gets the 'sensor' and a 'received' time.monotonic() timestamp that later stages measure their
+        latency from."""
+        started = time.monotonic()
+        self.waiting = len(data)
+        for listener in self.data_listeners:
+            listener(data)
+        readings = self.parser.feed(data, time.time())
+        for reading in readings:
+            reading['sensor'] = self.sensor_id
+            reading['received'] = started
+            self.reading = reading
+            for listener in self.listeners:
+                listener(reading)
+        return readings
+
+    def expires(self, now: float):
+        """Discards the last reading once it is older than timeout, returns seconds until it will be or None."""
+        if self.reading is None:
+            return None
+        remaining = self.reading['time'] + self.timeout - now
+        if remaining <= 0:
+            self.reading = None
+            return None
+        return remaining
+
+    def frame_rate(self) -> float:
+        """Returns the frames per second received over the last RATE_WINDOW to 2 * RATE_WINDOW seconds."""
+        now = time.monotonic()
+        frames = self.parser.frames
+        if now - self._marks[1][0] >= RATE_WINDOW:
+            self._marks = (self._marks[1], (now, frames))
+        since, counted = self._marks[0]
+        return (frames - counted) / (now - since) if now > since else 0.0
+
+    def stats(self) -> dict:
+        stats = self.parser.stats()
+        parsed = stats['frames'] + stats['checksum_failures']
+        stats.update({
+            'port': self.port,
+            'open': self.serial_port is not None,
+            'frame_rate': round(self.frame_rate(), 1),
+            'checksum_failure_rate': stats['checksum_failures'] / parsed if parsed > 0 else 0.0,
+            'bytes_waiting': self.waiting,
+            'bytes_buffered': self.parser.length
+        })
+        return stats
+
+
+class TfminiReaderThread(BaseThread):
+    """Reads any number of TFmini-S sensors, added with add(), from one thread.
+
+    Every serial port is registered with a selector and read only when it has bytes waiting, all of them in one
+    read, so the thread sleeps in select() between frames however many sensors there are instead of each sensor
+    blocking a thread of its own.  Readings are passed on to the listeners of their TfminiSensor and to the
+    listeners of this thread, with the sensor_id under 'sensor'.
+
+    A port that cannot be opened or fails is closed and opened again RETRY_SECONDS later without disturbing the other
+    sensors.  With run_async() the ports are watched by the event loop instead of the selector."""
+    def __init__(self):
+        super(TfminiReaderThread, self).__init__()
+        self.sensors = {}  # sensor_id -> TfminiSensor
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        # notify() writes here so select() returns for add() and shutdown()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+    def add(self, sensor_id: str, port: str, baud: int = 115200, timeout: float = 10.0) -> TfminiSensor:
+        """Adds the TFmini-S on port and returns it, its port is opened by this thread.  Safe to call from any thread,
+        before or after start().
+
+        Parameters
+        ----------
+        sensor_id - str - unique name of the sensor, such as the name of its stall
+        port - str - serial port the TFmini-S is connected to
+        baud - int - TFmini-S baud rate, defaults to 115200
+        timeout - float - seconds without a frame before the last reading is discarded, defaults to 10 seconds
+        """
+        with self.lock:
+            if sensor_id in self.sensors:
+                raise ValueError(f'there already is a TFmini-S called {sensor_id}')
+            if any(sensor.port == port for sensor in self.sensors.values()):
+                raise ValueError(f'a TFmini-S is already read on {port}')
+            sensor = TfminiSensor(sensor_id, port, baud, timeout)
+            self.sensors[sensor_id] = sensor
+        self.notify()
+        return sensor
+
+    def read(self, sensor_id: str):
+        """Returns the latest reading of the sensor, or None."""
+        sensor = self.sensors.get(sensor_id)
+        return sensor.read() if sensor is not None else None
+
+    def notify(self, *args) -> None:
+        super().notify()
+        if self._wakeup_write is not None and self._event_loop is None:
+            try:
+                os.write(self._wakeup_write, b'\0')
+            except BlockingIOError:
+                pass  # select() will return anyway
+
+    def loop(self):
+        timeout = self._housekeeping()
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                self._drain()
+            else:
+                self._read(key.data)
+
+    async def run_async(self, executor=None):
+        """Reads the ports when the event loop reports them readable instead of in this thread."""
+        self._attach(asyncio.get_running_loop())
+        try:
+            while self.running:
+                # readings are handled by _read(), this opens new ports and expires stale readings
+                await self.wait_async(self._housekeeping())
+                self.wakeups += 1
+        finally:
+            for sensor in self._sensors():
+                self._close(sensor)
+
+    def _sensors(self) -> list:
+        with self.lock:
+            return list(self.sensors.values())
+
+    def _housekeeping(self):
+        """Opens the ports that are due, discards stale readings and returns seconds until it is needed again."""
+        now = time.monotonic()
+        wall = time.time()
+        due = []
+        for sensor in self._sensors():
+            if sensor.serial_port is None:
+                if sensor.retry_at <= now:
+                    self._open(sensor)
+                if sensor.serial_port is None:
+                    due.append(sensor.retry_at - now)
+                    continue
+            remaining = sensor.expires(wall)
+            if remaining is not None:
+                due.append(remaining)
+        return max(min(due), 0.0) if due else None
+
+    def _open(self, sensor: TfminiSensor) -> None:
+        try:
+            sensor.serial_port = serial.Serial(sensor.port, sensor.baud, timeout=0)
+        except (serial.SerialException, OSError) as e:
+            logging.warning(f'Unable to open TFmini-S {sensor.sensor_id} on {sensor.port}, retrying in '
+                            f'{RETRY_SECONDS:g} seconds: {e}')
+            sensor.retry_at = time.monotonic() + RETRY_SECONDS
+            return
+        logging.info(f'getting distance from TFmini-S {sensor.sensor_id} on port {sensor.port}')
+        sensor.fileno = sensor.serial_port.fileno()
+        if self._event_loop is not None:
+            self._event_loop.add_reader(sensor.fileno, self._read, sensor)
+        else:
+            self.selector.register(sensor.fileno, selectors.EVENT_READ, sensor)
+
+    def _close(self, sensor: TfminiSensor) -> None:
+        if sensor.serial_port is None:
+            return
+        if self._event_loop is not None:
+            self._event_loop.remove_reader(sensor.fileno)
+        else:
+            self.selector.unregister(sensor.fileno)
+        sensor.serial_port.close()
+        sensor.serial_port = None
+        sensor.fileno = None
+        sensor.parser.reset()
+        sensor.reading = None
+        sensor.waiting = 0
+
+    def _read(self, sensor: TfminiSensor) -> None:
+        started = time.monotonic()
+        try:
+            # the port is non-blocking, this returns everything waiting up to the parser's capacity
+            data = os.read(sensor.fileno, len(sensor.parser.buffer))
+            if not data:
+                raise OSError('end of file')
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.warning(f'Unable to read TFmini-S {sensor.sensor_id} on {sensor.port}, reopening in '
+                            f'{RETRY_SECONDS:g} seconds: {e}')
+            self._close(sensor)
+            sensor.retry_at = started + RETRY_SECONDS
+            self.notify()
+            return
+        for reading in sensor.handle_data(data):
+            for listener in self.listeners:
+                listener(reading)
+        self.step_seconds.observe(time.monotonic() - started)
+
+    def _drain(self) -> None:
+        try:
+            while os.read(self._wakeup_read, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def stats(self) -> dict:
+        return {sensor.sensor_id: sensor.stats() for sensor in self._sensors()}
+
+    def shutdown(self):
+        super().shutdown()
+        if self._event_loop is None:
+            for sensor in self._sensors():
+                self._close(sensor)
+        if self._wakeup_write is None:
+            return  # already shut down
+        self.selector.close()
+        wakeup_write = self._wakeup_write
+        self._wakeup_write = None
+        os.close(self._wakeup_read)
+        os.close(wakeup_write)
@@ -1,58 +1,110 @@
+import asyncio
 import logging
 import time
+import traceback
 
-import numpy as np
 import serial
 
 from base_thread import BaseThread
+from metrics import REGISTRY
+from tfmini_parser import TfminiParser
 
 
 class TfminisThread(BaseThread):
+    """Reads every frame the TFmini-S sends over its serial port.  The latest reading is available from read() and
+    each valid reading is passed on to listeners as it arrives.  The bytes read are passed on to data_listeners
+    before they are parsed, e.g. to record them with a SessionRecorder."""
     def __init__(self, port='/dev/ttyS0', baud=115200, timeout=10.0):
+        """
+        Parameters
+        ----------
+        port - str - serial port the TFmini-S is connected to, defaults to /dev/ttyS0
+        baud - int - TFmini-S baud rate, defaults to 115200
+        timeout - float - seconds without a frame before the last reading is discarded, defaults to 10 seconds
+        """
         super(TfminisThread, self).__init__()
         self.serial_port = None
         self.reading = None
         self.timeout = timeout
         self.port = port
         self.baud = baud
+        self.parser = TfminiParser()
+        self.data_listeners = list()
+        REGISTRY.gauge('garage_serial_bytes_waiting', 'Bytes received from the TFmini-S that were not read yet',
+                       lambda: self.serial_port.in_waiting if self.serial_port is not None else None)
+        REGISTRY.gauge('garage_parser_bytes_buffered', 'Bytes of an incomplete TFmini-S frame held by the parser',
+                       lambda: self.parser.length)
+        REGISTRY.counter('garage_tfmini_frames_total', 'TFmini-S frames received', lambda: self.parser.frames)
+        REGISTRY.counter('garage_tfmini_resyncs_total', 'Times the TFmini-S parser lost and found the frame start',
+                         lambda: self.parser.resyncs)
 
     def read(self):
         return self.reading
 
     def run(self):
         logging.info(f'getting distance to vehicle from TFmini-S on port {self.port}')
-        self.serial_port = serial.Serial(self.port, self.baud)
+        self.serial_port = serial.Serial(self.port, self.baud, timeout=self.timeout)
         if not self.serial_port.is_open:
             self.serial_port.open()
         super().run()
 
     def loop(self):
         try:
-            count = self.serial_port.in_waiting
-            if count > 8:
-                recv = np.frombuffer(self.serial_port.read(9), dtype=np.uint8)
-                self.serial_port.reset_input_buffer()
-                if recv[0] == 89 and recv[1] == 89: # 0x59 is 'Y'
-                    checksum = np.sum(recv[:8]) & 0xff
-                    if checksum == recv[8]:
-                        distance = recv[2] + recv[3] * 256
-                        strength = recv[4] + recv[5] * 256
-                        logging.debug(f'distance={distance} strength={strength}')
-                        self.reading = { 'time': time.time(), 'distance':distance, 'strength':strength }
-                    else:
-                        logging.warning('Bad checksum from TFMini-S')
-                        self.reading = None
-                else:
-                    self.reading = None
-            else:
-                if self.reading is not None and time.time() - self.reading['time'] > self.timeout:
-                    self.reading = None
-        except Exception as ex:
-            logging.warning('Unable to read TFMini-S', traceback.format_exc())
+            # read everything waiting, or block until at least one byte arrives, timeout expires or shutdown()
+            self.handle_data(self.serial_port.read(max(self.serial_port.in_waiting, 1)))
+        except Exception:
+            logging.warning(f'Unable to read TFMini-S {traceback.format_exc()}')
+            self.parser.reset()
             self.reading = None
-              
+            self.sleep(1.0)
+
+    def handle_data(self, data: bytes) -> None:
+        """Parses bytes received from the TFmini-S and passes every reading found on to listeners.  Each reading
+        gets a 'received' time.monotonic() timestamp that later stages measure their latency from."""
+        if len(data) > 0:
+            started = time.monotonic()
+            for listener in self.data_listeners:
+                listener(data)
+            for reading in self.parser.feed(data, time.time()):
+                reading['received'] = started
+                self.reading = reading
+                for listener in self.listeners:
+                    listener(reading)
+            self.step_seconds.observe(time.monotonic() - started)
+        if self.reading is not None and time.time() - self.reading['time'] > self.timeout:
+            self.reading = None
+
+    async def run_async(self, executor=None):
+        """Reads the serial port when the event loop reports it readable instead of blocking a thread on it."""
+        event_loop = asyncio.get_running_loop()
+        self._attach(event_loop)
+        logging.info(f'getting distance to vehicle from TFmini-S on port {self.port}')
+        self.serial_port = serial.Serial(self.port, self.baud, timeout=0)
+        fileno = self.serial_port.fileno()
+
+        def readable():
+            try:
+                self.handle_data(self.serial_port.read(self.serial_port.in_waiting or 1))
+            except Exception:
+                logging.warning(f'Unable to read TFMini-S {traceback.format_exc()}')
+                self.parser.reset()
+                self.reading = None
+
+        event_loop.add_reader(fileno, readable)
+        try:
+            while self.running:
+                # readings are handled by readable(), this only expires a stale reading
+                await self.wait_async(self.timeout)
+                self.handle_data(b'')
+        finally:
+            event_loop.remove_reader(fileno)
+
     def shutdown(self):
+        # stop looping first, otherwise the loop can start another read right after the cancelled one returned
+        self.running = False
+        if self.serial_port is not None:
+            self.serial_port.cancel_read()
+        super().shutdown()
         if self.serial_port is not None:
             self.serial_port.close()
         self.serial_port = None
-        super().shutdown()
@@ -1,48 +1,252 @@
+import re
+import subprocess
+import threading
 import time
+from collections import deque
 
 import wifi.exceptions
 from wifi import Cell
 import logging
-from base_thread import BaseThread
+from base_thread import SamplingThread
 
 
-class WifiScanThread(BaseThread):
+class IwEventMonitor:
+    """Runs one long-lived 'iw event' process and calls on_scan_results whenever the kernel has new scan results
+    for the interface.  Scans started by wpa_supplicant or anyone else are reported too, so their results can be
+    read with scan_dump() without another scan keeping the radio busy."""
+    def __init__(self, interface: str, on_scan_results):
+        """
+        Parameters
+        ----------
+        interface - str - interface to watch, e.g. 'wlan0'
+        on_scan_results - function() - called from the monitor's thread when new scan results are available
+        """
+        self.interface = interface
+        self.on_scan_results = on_scan_results
+        self.process = None
+        self.thread = None
+        self.results_time = None
+        self.scan_started_time = None
+        self.last_scan_duration = None
+
+    def start(self) -> bool:
+        """Starts 'iw event', returns False if iw is not available."""
+        try:
+            self.process = subprocess.Popen(['iw', 'event'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                            text=True, bufsize=1)
+        except OSError as e:
+            logging.info(f'iw event not available, Wifi scans are timed only: {e}')
+            return False
+        self.thread = threading.Thread(target=self._read_events, name='iw-event', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(1.0)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def _read_events(self) -> None:
+        prefix = f'{self.interface} '
+        for line in self.process.stdout:
+            if not line.startswith(prefix):
+                continue
+            if line.endswith('scan started\n'):
+                self.scan_started_time = time.monotonic()
+            elif line.endswith('new scan results\n'):
+                self.results_time = time.monotonic()
+                if self.scan_started_time is not None:
+                    self.last_scan_duration = self.results_time - self.scan_started_time
+                    self.scan_started_time = None
+                self.on_scan_results()
+            elif line.endswith('scan aborted\n'):
+                self.scan_started_time = None
+
+
+_bss_re = re.compile(r'^BSS ([0-9a-f:]{17})', re.MULTILINE)
+
+
+def scan_dump(interface: str) -> list:
+    """Returns the kernel's cached results of the last scan as wifi.Cell objects without starting a new scan."""
+    output = subprocess.run(['iw', 'dev', interface, 'scan', 'dump'], capture_output=True, text=True,
+                            check=True).stdout
+    cells = []
+    sections = _bss_re.split(output)
+    for address, section in zip(sections[1::2], sections[2::2]):
+        cell = Cell()
+        cell.address = address.upper()
+        cell.ssid = ''
+        for line in section.splitlines():
+            key, _, value = line.strip().partition(': ')
+            if key == 'SSID':
+                cell.ssid = value
+            elif key == 'signal':
+                cell.signal = int(float(value.split()[0]))
+            elif key == 'freq':
+                cell.frequency = f'{float(value) / 1000:g} GHz'
+            elif key == 'capability':
+                cell.encrypted = 'Privacy' in value
+            elif key == 'DS Parameter set':
+                cell.channel = int(value.split()[-1])
+        cells.append(cell)
+    return cells
+
+
+class WifiScanThread(SamplingThread):
     """Thread that uses the Wifi library to scan for Wifi networks and notify listeners if
-    networks are found."""
-    
-    def __init__(self, ssids: dict[str,str], interface: str='wlan0'):
+    networks are found.
+
+    A scan keeps the radio that also serves the web interface and MQTT busy for seconds, so scans are scheduled:
+    every period seconds while fast, every slow_period seconds otherwise (the car is parked and the door is closed).
+    set_fast() switches between the two and scan_now() asks for a scan right away.  When 'iw event' is available,
+    results of scans done by anyone else are picked up as they arrive and count as a scan."""
+
+    def __init__(self, ssids: dict[str,str], interface: str='wlan0', period: float = 1.0, slow_period: float = 30.0,
+                 events: bool = True, scan = None):
         """Scan for ssids that are the keys in the ssids dictionary.
 
         Parameters
         ----------
         ssid - dict[str,str] - dict of ssid to password mappings
         interface - str - interface to use for scanning, defaults to 'wlan0'
+        period - float - seconds between scans while scanning fast, defaults to 1 second
+        slow_period - float - seconds between scans after backing off, defaults to 30 seconds
+        events - bool - True to watch 'iw event' for scan results, defaults to True
+        scan - function(interface) - returns the cells a scan finds, defaults to wifi.Cell.all
         """
-        super(WifiScanThread, self).__init__()
+        super(WifiScanThread, self).__init__(period)
         self.ssids = ssids
         self.interface = interface
         self.cells = None
+        self.scan = scan if scan is not None else Cell.all
+        self.fast_period = period
+        self.slow_period = slow_period
+        self.fast = True
+        self.fast_requests = {}  # whoever called set_fast() -> what they asked for
+        self.event_monitor = IwEventMonitor(interface, self.notify) if events else None
+        self.last_results = 0.0
+        self.scan_requested = False
+        self.scans = 0
+        self.scans_skipped = 0
+        self.passive_results = 0
+        self.last_scan_duration = None
+        self.total_scan_duration = 0.0
+        self.recent_scans = deque()  # monotonic time of the scans in the last minute
+
+    def set_fast(self, fast: bool, requester = None) -> None:
+        """Scans every period seconds if fast is True, every slow_period seconds otherwise.  Switching to fast
+        scans right away.  Stalls sharing the scanner pass themselves as requester, it scans fast while any of them
+        asks for it."""
+        self.fast_requests[requester] = fast
+        fast = any(self.fast_requests.values())
+        if fast == self.fast:
+            return
+        self.fast = fast
+        self.period = self.fast_period if fast else self.slow_period
+        logging.info(f'Wifi scans every {self.period} seconds')
+        if fast:
+            self.notify()
+
+    def scan_now(self) -> None:
+        """Asks for a scan as soon as possible."""
+        self.scan_requested = True
+        self.notify()
 
-    def loop(self) -> None:
+    def sample(self) -> list:
+        now = time.monotonic()
+        monitor = self.event_monitor
+        if not self.scan_requested and monitor is not None and monitor.results_time is not None and \
+                monitor.results_time > self.last_results:
+            # someone else scanned, or the results of our own scan arrived after Cell.all() returned
+            self.last_results = now
+            try:
+                cells = scan_dump(self.interface)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.info(f'Wifi scan dump failed: {e}')
+                return None
+            self.passive_results += 1
+            return cells
+        if not self.scan_requested and now - self.last_results < self.period:
+            # woken up early by results that were already read
+            self.scans_skipped += 1
+            return None
         try:
-            self.cells = list(Cell.all(self.interface))
-            self.inform_listeners(self.cells)
-            #logging.info(f'Wifi networks found {[cell.ssid for cell in self.cells]}')
+            cells = list(self.scan(self.interface))
         except wifi.exceptions.InterfaceError:
             logging.info('WiFi busy - scan skipped')
-        time.sleep(1.0)
+            return None
+        finished = time.monotonic()
+        self.last_results = finished
+        self.scan_requested = False
+        self._count_scan(now, finished)
+        return cells
+
+    def _count_scan(self, started: float, finished: float) -> None:
+        self.scans += 1
+        self.last_scan_duration = finished - started
+        self.total_scan_duration += self.last_scan_duration
+        self.recent_scans.append(finished)
+        while self.recent_scans and self.recent_scans[0] < finished - 60.0:
+            self.recent_scans.popleft()
+
+    def scans_per_minute(self) -> int:
+        """Returns the number of scans this thread started in the last minute."""
+        while self.recent_scans and self.recent_scans[0] < time.monotonic() - 60.0:
+            self.recent_scans.popleft()
+        return len(self.recent_scans)
+
+    def stats(self) -> dict:
+        return {
+            'scans': self.scans,
+            'scans_per_minute': self.scans_per_minute(),
+            'scans_skipped': self.scans_skipped,
+            'passive_results': self.passive_results,
+            'last_scan_duration': self.last_scan_duration,
+            'radio_scan_duration': self.event_monitor.last_scan_duration if self.event_monitor else None,
+            'average_scan_duration': self.total_scan_duration / self.scans if self.scans > 0 else None,
+            'period': self.period
+        }
+
+    def update(self, cells: list) -> None:
+        self.cells = cells
+        self.inform_listeners(self.cells)
+        #logging.info(f'Wifi networks found {[cell.ssid for cell in self.cells]}')
 
-    def found(self) -> list[str]:
+    def found(self, ssids: list = None) -> list[str]:
         """Checks to see if one of the given ssids is in the list of Wifi networks found.
 
+        Parameters
+        ----------
+        ssids - list(str) - ssids to look for, such as the car of one stall, defaults to all ssids scanned for
+
         Returns
         -------
         list of ssids found, empty if nothing was found
         """
         if self.cells is None:
             return []
-        return [cell for cell in self.cells if (cell.ssid in self.ssids)]
+        if ssids is None:
+            ssids = self.ssids
+        return [cell for cell in self.cells if (cell.ssid in ssids)]
+
+    def _start_events(self) -> None:
+        if self.event_monitor is not None and not self.event_monitor.start():
+            self.event_monitor = None
 
     def run(self) -> None:
         logging.info(f'scanning wifi {self.interface} for {self.ssids}')
+        self._start_events()
         super().run()
+
+    async def run_async(self, executor=None) -> None:
+        logging.info(f'scanning wifi {self.interface} for {self.ssids}')
+        self._start_events()
+        await super().run_async(executor)
+
+    def shutdown(self) -> None:
+        if self.event_monitor is not None:
+            self.event_monitor.stop()
+        super().shutdown()